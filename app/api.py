@@ -36,11 +36,30 @@
 '''
 
 import os
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, request
 from flask_cors import CORS
 from flask_pymongo import PyMongo
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import time
 import tasks
+import cache
+import compression
+import instrumentation
+import dispatch
+import leaderboard
+import leases
+import metrics
+import migrate
+import pagination
+import revisions
+from schema import assignment, build_data, build_document, \
+    build_documents, build_prediction, claim_order, claim_params, \
+    claim_queries, duplicates, fields_projection, heartbeat_params, \
+    inserted_documents, learndone, list_collection, list_query, \
+    next_model_start, positive_int, preddone, private_projection, \
+    related_problems, updated_perf, valid_claim
+from serializer import jsonify
 from flask_httpauth import HTTPBasicAuth
 
 app = Flask(__name__)
@@ -60,8 +79,52 @@ else:
     app.config['MONGO_DBNAME'] = 'orchestrator'
 
 mongo_host = os.environ.get('MONGO_HOST', "localhost")
-app.config['MONGO_HOST'] = mongo_host
-mongo = PyMongo(app)
+# Maximum number of connections to MongoDB of a process
+mongo_pool_size = int(os.environ.get('MONGO_POOL_SIZE', 100))
+# The client connects at its first command, so it can be created before a
+# fork as long as it is not used (see create_app)
+app.config['MONGO_URI'] = 'mongodb://%s/%s?maxPoolSize=%d&connect=false' % (
+    mongo_host, app.config['MONGO_DBNAME'], mongo_pool_size)
+mongo = PyMongo()
+# Add the number of MongoDB commands of a request (and the time spent in
+# them, in ms) to its response, as in debug mode
+app.config['MONGO_DEBUG_HEADERS'] = \
+    os.environ.get('MONGO_DEBUG_HEADERS', "F") == "T"
+
+
+@app.before_request
+def start_request():
+    # attribute to the request the commands sent to MongoDB
+    instrumentation.start_request('%s %s' % (request.method, request.path))
+    g.start_time = time.time()
+
+
+@app.after_request
+def report_mongo_commands(response):
+    # log slow commands and requests over budget, and in debug mode tell
+    # the client how many commands were sent
+    n_commands, duration = instrumentation.end_request(mongo.cx)
+    if app.debug or app.config['MONGO_DEBUG_HEADERS']:
+        response.headers['X-Mongo-Commands'] = str(n_commands)
+        response.headers['X-Mongo-Time'] = '%.3f' % (duration * 1000)
+    return response
+
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.REQUESTS.labels(request.method, route,
+                            response.status_code).inc()
+    metrics.REQUEST_DURATION.labels(request.method, route).observe(
+        time.time() - g.start_time)
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    # compress large JSON responses if the client accepts it
+    return compression.compress_response(response)
+
 
 auth = HTTPBasicAuth()
 users = {os.environ.get('USER_AUTH'): os.environ.get('PWD_AUTH')}
@@ -76,23 +139,63 @@ def get_pw(username):
 
 # Compute url to push new task to it (should be removed in phase 1.2)
 compute_url = os.environ.get('COMPUTE_URL')
+# Counts of uplets exposed in /metrics
+uplet_collector = None
+
 
-# Document fields to be added
-# data: uuid can be one element or a list, in this case all element have same
-# problems
-post_document = {
-    'problem': ['uuid', 'workflow', 'test_dataset', 'size_train_dataset'],
-    'algo': ['uuid', 'problem', 'name'],
-    'data': ['uuid', 'problems'],
-}
-# Existing collections
-list_collection = list(post_document.keys()) + ['learnuplet', 'preduplet']
-# Requirements for other post requests
-post_request = {'prediction': ['data', 'problem']}
+def create_app():
+    """
+    Initialize the app in the current process: create its MongoDB client and
+    start its background threads. Neither survive a fork, so when gunicorn
+    preloads the app (PRELOAD_APP=T), the master process only imports this
+    module and each worker calls this function after fork (see
+    gunicorn_config.py). Otherwise it is called at import.
+
+    :return: the initialized app
+    :rtype: flask.Flask
+    """
+    global uplet_collector
+    if 'MONGO' in app.extensions.get('pymongo', {}):
+        return app
+    mongo.init_app(app)
+    with app.app_context():
+        # Post uplets of the dispatch queue to Compute in background
+        if compute_url:
+            dispatch.start(mongo.db)
+        uplet_collector = metrics.UpletCollector(mongo.db,
+                                                 dispatch.DISPATCH_COLLECTION)
+        # Put back to todo uplets of dead workers in background
+        if testing != "T":
+            leases.start(mongo.db, compute_url)
+    return app
+
+
+def requested_projection():
+    """
+    Mongo projection of the fields requested with the *fields* parameter
+    (comma separated field names), None to get all fields
+    """
+    return fields_projection(request.args.get('fields'))
+
+
+@app.route('/metrics', methods=['GET'])
+@auth.login_required
+def get_metrics():
+    """
+    Get metrics in the Prometheus text format: requests and their duration
+    by route, MongoDB commands and their duration, posts of uplets to
+    Compute, numbers of uplets by problem and status, and lookups in the
+    caches of documents.
+    With several gunicorn workers, the environment variable
+    *prometheus_multiproc_dir* has to be set to aggregate their metrics.
+    """
+    data, content_type = metrics.latest(uplet_collector)
+    return Response(data, content_type=content_type), 200
 
 
 @app.route('/<collection_name>', methods=['GET'])
 @auth.login_required
+@cache.cached
 def get_all_documents(collection_name):
     """
     - (*collection_name*) : **problem**, **algo**, **data**, **learnuplet**,
@@ -101,21 +204,90 @@ def get_all_documents(collection_name):
     Get all the documents corresponding to the (*collection_name*).
     Possible to add filter to your request (e.g. **/learnuplet?uuid=blabla**)
 
+    **Optional parameters**:
+        - *limit* : maximum number of documents to return. The response then
+          contains a *next* cursor (null on the last page)
+        - *after* : *next* cursor of the previous page
+        - *fields* : comma separated list of fields to return (e.g.
+          **fields=uuid,status,rank,perf**)
+        - *stream* : **json** to stream the response instead of building it
+          in memory, or **ndjson** to stream one document per line (also
+          selected with header *Accept: application/x-ndjson*)
+
     **Success Response content**:
         - *problems/algos/datas/learnuplets/preduplets*: list of corresponding
         documents
+        - *next*: cursor of the next page, only if *limit* or *stream* is used
+
+    Responses which are not streamed are cached, with an *ETag* header
+    (**304** response if it matches the *If-None-Match* header).
     """
     if collection_name in list_collection:
         collection = mongo.db[collection_name]
-        output = [{k: v for k, v in d.items() if k != '_id'}
-                  for d in collection.find(request.args)]
-        return jsonify({'%ss' % collection_name: output}), 200
+        try:
+            query, limit, paginated = list_query(request.args.to_dict())
+        except ValueError:
+            return jsonify({'Error': 'wrong pagination parameters'}), 400
+        stream = request.args.get('stream')
+        if request.accept_mimetypes.best == 'application/x-ndjson':
+            stream = 'ndjson'
+        documents = collection.find(query, requested_projection())
+        if paginated:
+            # keyset pagination on the _id index
+            documents = documents.sort('_id', 1).limit(limit)
+        key = '%ss' % collection_name
+        if stream == 'ndjson':
+            return Response(pagination.ndjson_stream(documents),
+                            mimetype='application/x-ndjson'), 200
+        elif stream == 'json':
+            return Response(pagination.json_stream(key, documents, limit),
+                            mimetype='application/json'), 200
+        return jsonify(pagination.page(key, list(documents), limit,
+                                       paginated)), 200
     else:
         return jsonify({'Error': 'Page does not exist'}), 404
 
 
+@app.route('/<collection_name>/changes', methods=['GET'])
+@auth.login_required
+def get_changes(collection_name):
+    """
+    - (*collection_name*) : **problem**, **algo**, **data**, **learnuplet**,
+    or **preduplet**
+
+    Get the documents of the (*collection_name*) created or modified since
+    a previous call, in the order of their modification. To mirror a
+    collection, call it first without *since*, then with the *next* token
+    of the previous response.
+
+    **Optional parameters**:
+        - *since* : *next* token of the previous response
+        - *limit* : maximum number of documents to return (default 1000)
+        - *fields* : comma separated list of fields to return (e.g.
+          **fields=uuid,status,rank,perf**)
+
+    **Success Response content**:
+        - *problems/algos/datas/learnuplets/preduplets*: list of documents
+          modified since the token (their last version)
+        - *next*: token to get the following changes (same as *since* if
+          there is no new change)
+    """
+    if collection_name not in list_collection:
+        return jsonify({'Error': 'Page does not exist'}), 404
+    try:
+        since, limit = revisions.changes_params(request.args)
+        documents, next_token = revisions.changes(
+            mongo.db[collection_name], since, limit, requested_projection())
+    except ValueError:
+        return jsonify({'Error': 'wrong since or limit parameters'}), 400
+    return jsonify(revisions.changes_page(collection_name, documents,
+                                          next_token,
+                                          request.args.get('since'))), 200
+
+
 @app.route('/<collection_name>/<document_uuid>', methods=['GET'])
 @auth.login_required
+@cache.cached
 def get_document(collection_name, document_uuid):
     """
     - (*collection_name*) : **problem**, **algo**, **data**, **learnuplet**,
@@ -124,23 +296,84 @@ def get_document(collection_name, document_uuid):
 
     Get a document of a collection
 
+    **Optional parameters**:
+        - *fields* : comma separated list of fields to return (e.g.
+          **fields=uuid,status,rank,perf**)
+
     **Success Response content**:
         - document elements
+
+    Responses are cached, with an *ETag* header (**304** response if it
+    matches the *If-None-Match* header).
     """
     if collection_name in list_collection:
         collection = mongo.db[collection_name]
-        d = collection.find_one({"uuid": document_uuid})
-        output = {k: v for k, v in d.items() if k != '_id'}
-        return jsonify(output), 200
+        d = collection.find_one({"uuid": document_uuid},
+                                requested_projection())
+        if not d:
+            return jsonify({'Error': 'Document does not exist'}), 404
+        return jsonify(pagination.clean_document(d)), 200
     else:
         return jsonify({'Error': 'Page does not exist'}), 404
 
 
+@app.route('/leaderboard/<problem_uuid>', methods=['GET'])
+@auth.login_required
+def get_leaderboard(problem_uuid):
+    """
+    - (*problem_uuid*) : **UUID** of the problem
+
+    Get the best models of a problem (the best model of each algo), by
+    decreasing performance.
+
+    **Optional parameters**:
+        - *k* : number of models to return (default 10)
+
+    **Success Response content**:
+        - *leaderboard*: list of models, with *algo*, *perf*, *model_end* and
+          *learnuplet* (UUID of the learnuplet which trained the model)
+    """
+    try:
+        k = positive_int(request.args.get('k', 10))
+    except ValueError:
+        return jsonify({'Error': 'k should be a positive integer'}), 400
+    return jsonify(
+        {'leaderboard': leaderboard.top(mongo.db, problem_uuid, k)}), 200
+
+
+def insert_documents(collection_name, list_data, related_problems=None):
+    """
+    Add several documents with one unordered insert_many. Invalid documents
+    are reported without preventing the insertion of the other ones.
+
+    :param collection_name: problem or algo
+    :param list_data: posted documents
+    :param related_problems: UUIDs of existing problems, to check the
+        problem of algos
+    :type collection_name: string
+    :type list_data: list
+    :type related_problems: set
+    :return: inserted documents, and errors with the index of the
+        corresponding posted document
+    :rtype: tuple
+    """
+    new_docs, indices, errors = build_documents(collection_name, list_data,
+                                                related_problems)
+    failed = set()
+    if new_docs:
+        try:
+            mongo.db[collection_name].insert_many(new_docs, ordered=False)
+        except BulkWriteError as e:
+            failed = duplicates(e)
+    return inserted_documents(collection_name, new_docs, indices, errors,
+                              failed)
+
+
 @app.route('/problem', methods=['POST'])
 @auth.login_required
 def add_problem():
     """
-    Add a new problem
+    Add a new problem, or several problems if a list is posted
 
     **Data to post**:
         - *uuid* : problem UUID
@@ -150,28 +383,41 @@ def add_problem():
 
     **Success Response content**:
         - *new_problem*: new problem
+        - if a list is posted, *new_problems*: list of new problems, and
+          *errors*: list of errors, with the *index* of the corresponding
+          posted problem
     """
     collection = mongo.db['problem']
+    request_data = request.get_json()
+    if isinstance(request_data, list):
+        new_docs, errors = insert_documents('problem', request_data)
+        for new_doc in new_docs:
+            cache.problem_cache.put(new_doc)
+        cache.response_cache.invalidate('problem')
+        return jsonify({'new_problems': new_docs, 'errors': errors}), \
+            201 if new_docs else 400
     try:
-        request_data = request.get_json()
         # TODO: validation on fields + check element does not exist
         # TODO: check element exists on Storage
-        new_doc = {k: request_data[k] for k in post_document['problem']}
-        new_doc['timestamp_upload'] = int(time.time())
+        new_doc = build_document('problem', request_data)
     except KeyError:
         return jsonify({'Error': 'wrong key in posted data'}), 400
     # put doc in db
-    inserted_id = collection.insert_one(new_doc).inserted_id
-    inserted_doc = collection.find_one({'_id': inserted_id})
-    inserted_doc.pop('_id')
-    return jsonify({'new_problem': inserted_doc}), 201
+    try:
+        collection.insert_one(new_doc)
+    except DuplicateKeyError:
+        return jsonify({'Error': 'problem %s already exists' %
+                        new_doc['uuid']}), 400
+    cache.problem_cache.put(new_doc)
+    cache.response_cache.invalidate('problem')
+    return jsonify({'new_problem': pagination.clean_document(new_doc)}), 201
 
 
 @app.route('/algo', methods=['POST'])
 @auth.login_required
 def add_algo():
     """
-    Add a new algorithm
+    Add a new algorithm, or several algorithms if a list is posted
 
     **Data to post**:
         - *uuid* : algo UUID
@@ -181,27 +427,44 @@ def add_algo():
     **Success Response content**:
         - *new_algo*: new algorithm
         - *new_learnuplets*: number of newly created learnuplets
+        - if a list is posted, *new_algos*: list of new algorithms, and
+          *errors*: list of errors, with the *index* of the corresponding
+          posted algorithm
     """
-    n_learnuplets = 0
     collection = mongo.db['algo']
+    request_data = request.get_json()
+    if isinstance(request_data, list):
+        # Check associated problems exist, in at most one query
+        problems = cache.problem_cache.get_many(
+            mongo.db, related_problems(request_data))
+        new_docs, errors = insert_documents('algo', request_data,
+                                            set(problems))
+        n_learnuplets = tasks.algos_learnuplet(new_docs)
+        cache.response_cache.invalidate('algo', 'learnuplet')
+        return jsonify({'new_algos': new_docs, 'errors': errors,
+                        'new_learnuplets': n_learnuplets}), \
+            201 if new_docs else 400
     try:
-        request_data = request.get_json()
         # TODO: validation on fields + check element does not exist
         # TODO: check element exists on Storage
         # Check associated problem exists
-        problem = mongo.db['problem'].\
-            find_one({'uuid': request_data['problem']})
+        if not isinstance(request_data['problem'], str):
+            return jsonify({'Error': 'non-existing related problem'}), 400
+        problem = cache.problem_cache.get(mongo.db, request_data['problem'])
         if not problem:
             return jsonify({'Error': 'non-existing related problem'}), 400
-        new_doc = {k: request_data[k] for k in post_document['algo']}
-        new_doc['timestamp_upload'] = int(time.time())
+        new_doc = build_document('algo', request_data)
     except KeyError:
         return jsonify({'Error': 'wrong key in posted data'}), 400
     # put doc in db
-    inserted_id = collection.insert_one(new_doc).inserted_id
-    inserted_doc = collection.find_one({'_id': inserted_id})
-    inserted_doc.pop('_id')
-    n_learnuplets += tasks.algo_learnuplet(inserted_doc['uuid'])
+    try:
+        collection.insert_one(new_doc)
+    except DuplicateKeyError:
+        return jsonify({'Error': 'algo %s already exists' %
+                        new_doc['uuid']}), 400
+    inserted_doc = pagination.clean_document(new_doc)
+    n_learnuplets = tasks.algos_learnuplet([inserted_doc])
+    cache.response_cache.invalidate('algo', 'learnuplet')
     return jsonify({'new_algo': inserted_doc,
                     'new_learnuplets': n_learnuplets}), 201
 
@@ -216,6 +479,8 @@ def add_data():
         - *uuid* : data UUID or list of data UUIDs
         - *problems* : UUID or list of UUID of associated problems
 
+    Data which already exist are ignored.
+
     **Success Response content**:
         - *new_datas*: list of new data
         - *new_learnuplets*: number of newly created learnuplets
@@ -223,38 +488,31 @@ def add_data():
     n_learnuplets = 0
     collection = mongo.db['data']
     try:
-        request_data = request.get_json()
-        timestamp = int(time.time())
         # TODO: validation on fields + check element does not exist
         # TODO: check element exists on Storage
-        # Check associated problems exists
-        for pb in request_data['problems']:
-            problem = mongo.db['problem'].find_one({'uuid': pb})
-            if not problem:
-                return jsonify({'Error': 'non-existing related problem'}), 400
-        new_docs = []
-        if type(request_data["uuid"]) is not list:
-            list_uuids = [request_data["uuid"]]
-        else:
-            list_uuids = request_data["uuid"]
-        for uuid in list_uuids:
-            new_doc = {k: request_data[k] for k in
-                       post_document['data'] if k != "uuid"}
-            new_doc['uuid'] = uuid
-            new_doc['timestamp_upload'] = timestamp
-            new_docs.append(new_doc)
+        list_problems, new_docs = build_data(request.get_json())
     except KeyError:
         return jsonify({'Error': 'wrong key in posted data'}), 400
-    # put docs in db
-    inserted_ids = collection.insert_many(new_docs).inserted_ids
-    # find back created document(s)
-    uuid_new_docs = collection.find({'_id': {"$in": inserted_ids}}).\
-        distinct("uuid")
-    new_docs = [{k: v for k, v in d.items() if k != '_id'}
-                for d in collection.find({'_id': {"$in": inserted_ids}})]
+    # Check associated problems exists, in at most one query
+    existing_problems = cache.problem_cache.get_many(mongo.db, list_problems)
+    if set(existing_problems) != set(list_problems):
+        return jsonify({'Error': 'non-existing related problem'}), 400
+    # put docs in db, in one round-trip. Already existing data are left
+    # untouched (unique uuid index), so posting the same data twice is
+    # harmless
+    failed = set()
+    try:
+        collection.insert_many(new_docs, ordered=False)
+    except BulkWriteError as e:
+        failed = duplicates(e)
+    new_docs = [pagination.clean_document(new_doc)
+                for i, new_doc in enumerate(new_docs) if i not in failed]
+    uuid_new_docs = [new_doc['uuid'] for new_doc in new_docs]
     # create learnuplets
-    for pb_uuid in request_data["problems"]:
-        n_learnuplets += tasks.data_learnuplet(pb_uuid, uuid_new_docs)
+    if uuid_new_docs:
+        for pb_uuid in list_problems:
+            n_learnuplets += tasks.data_learnuplet(pb_uuid, uuid_new_docs)
+        cache.response_cache.invalidate('data', 'learnuplet')
     return jsonify({'new_datas': new_docs,
                     'new_learnuplets': n_learnuplets}), 201
 
@@ -273,15 +531,14 @@ def request_prediction():
         - *preduplet*: preduplet created and posted to compute
     """
     try:
-        request_data = request.get_json()
         # Check that fields are valid
-        if not isinstance(request_data['data'], str):
+        try:
+            new_preduplet = build_prediction(request.get_json())
+        except ValueError:
             return jsonify({'Error': 'data field should be an UUID'}), 400
         # Create preduplet
-        new_preduplet = {k: request_data[k]
-                         for k in post_request['prediction']}
-        new_preduplet['timestamp_request'] = int(time.time())
         preduplet_created = tasks.create_preduplet(new_preduplet)
+        cache.response_cache.invalidate('preduplet')
         if preduplet_created:
             return jsonify(preduplet_created), 201
         else:
@@ -290,6 +547,75 @@ def request_prediction():
         return jsonify({'Error': 'wrong key in posted data'}), 400
 
 
+@app.route('/worker/claim', methods=['POST'])
+@auth.login_required
+def claim_uplets():
+    """
+    Assign to a worker uplets which are ready to be processed (*todo*
+    learnuplets with a *model_start*, or *todo* preduplets), oldest first,
+    and change their status to pending (only exposed to the Compute).
+    Each uplet is assigned atomically, so it is never given to two workers.
+    The worker gets a lease on its uplets at its first
+    **/worker/heartbeat**, to be extended until it reports its results.
+
+    **Data to post**:
+        - *worker* : worker UUID
+        - *uplet_type* : **learnuplet** or **preduplet**
+        - *n* : maximum number of uplets to claim (default 1, at most 100)
+
+    **Success Response content**:
+        - *learnuplets/preduplets*: list of claimed uplets (empty if there is
+          no uplet to process)
+    """
+    try:
+        worker, uplet_type, n = claim_params(request.get_json())
+    except (KeyError, ValueError, TypeError):
+        return jsonify({'Error': 'wrong key in posted data'}), 400
+    if not valid_claim(uplet_type, n):
+        return jsonify({'Error': 'wrong value in posted data'}), 400
+    claimed = []
+    for _ in range(n):
+        uplet = mongo.db[uplet_type].find_one_and_update(
+            claim_queries[uplet_type], assignment(worker),
+            projection=private_projection,
+            sort=claim_order[uplet_type],
+            return_document=ReturnDocument.AFTER)
+        if not uplet:
+            break
+        claimed.append(uplet)
+    cache.response_cache.invalidate(uplet_type)
+    return jsonify({'%ss' % uplet_type: claimed}), 200
+
+
+@app.route('/worker/heartbeat', methods=['POST'])
+@auth.login_required
+def heartbeat():
+    """
+    Take or extend the leases of a worker on its pending learnuplets and
+    preduplets (only exposed to the Compute). Uplets whose lease expires
+    are put back to todo, to be processed by another worker. Uplets of
+    workers which never send heartbeats have no lease and stay pending.
+
+    **Data to post**:
+        - *worker* : worker UUID
+        - *uplets* : optional list of UUIDs of learnuplets and preduplets
+          still processed by the worker (all its pending uplets if not given)
+
+    **Success Response content**:
+        - *lease_expires*: new expiry time of the leases (UNIX timestamp)
+        - *learnuplets/preduplets*: number of extended leases
+    """
+    try:
+        worker, uplet_uuids = heartbeat_params(request.get_json())
+    except KeyError:
+        return jsonify({'Error': 'wrong key in posted data'}), 400
+    except ValueError:
+        return jsonify({'Error': 'uplets field should be a list'}), 400
+    expiry, extended = leases.extend(mongo.db, worker, uplet_uuids)
+    cache.response_cache.invalidate(*extended)
+    return jsonify(leases.heartbeat_output(expiry, extended)), 200
+
+
 @app.route('/worker/<uplet_type>/<uplet_uuid>', methods=['POST'])
 @auth.login_required
 def set_uplet_worker(uplet_type, uplet_uuid):
@@ -299,6 +625,8 @@ def set_uplet_worker(uplet_type, uplet_uuid):
 
     Update the worker of a learnuplet or preduplet and change its status to
     pending (only exposed to the Compute).
+    The worker gets a lease on the uplet at its first
+    **/worker/heartbeat**, to be extended until it reports its results.
 
     **Data to post**:
         - *worker* : worker UUID
@@ -313,8 +641,8 @@ def set_uplet_worker(uplet_type, uplet_uuid):
             request_data = request.get_json()
             updated = collection.update_one(
                 {'uuid': uplet_uuid, 'status': 'todo'},
-                {'$set': {'status': 'pending',
-                          'worker': request_data['worker']}})
+                assignment(request_data['worker']))
+            cache.response_cache.invalidate(uplet_type)
             if updated.modified_count == 1:
                 return jsonify({'%s_worker_set' % uplet_type: uplet_uuid}), 200
             else:
@@ -350,47 +678,44 @@ def report_perf_learnuplet(learnuplet_uuid):
     """
     # TODO: check identity of worker
     try:
-        request_data = request.get_json()
-        # update status in current learnuplet
-        updated_status = mongo.db.learnuplet.update_one(
-            {'uuid': learnuplet_uuid},
-            {'$set': {'status': request_data["status"]}})
-        # update perf in current learnuplet if learning has been done
-        if request_data["status"] == 'done':
-            updated_perf = mongo.db.learnuplet.update_one(
-                {'uuid': learnuplet_uuid},
-                {'$set': {'perf': request_data["perf"],
-                          'train_perf': request_data["train_perf"],
-                          'test_perf': request_data["test_perf"]}})
-            if updated_perf.modified_count == 1:
-                learnuplet_perf = mongo.db.learnuplet.find_one(
-                    {'uuid': learnuplet_uuid})
-                # find learnuplet with best performance
-                best_learnuplet = mongo.db.learnuplet.find_one(
-                    {"perf": {"$exists": True},
-                     "algo": learnuplet_perf['algo']},
-                    sort=[("perf", -1)])
-                # change model start in next learnuplet
-                next_model_start = best_learnuplet['model_end']
-                next_learnuplet = mongo.db.learnuplet.update_one(
-                    {'rank': learnuplet_perf['rank'] + 1,
-                     'algo': learnuplet_perf['algo']},
-                    {'$set': {'model_start': next_model_start}})
-                # push it to compute
-                if next_learnuplet.modified_count == 1 and compute_url:
-                    new_learnuplet = mongo.db.learnuplet.find_one(
-                        {'rank': learnuplet_perf['rank'] + 1,
-                         'algo': learnuplet_perf['algo']})
-                    new_learnuplet.pop('_id')
-                    tasks.post_uplet([new_learnuplet], compute_url, 'learn')
-        if updated_status.modified_count == 1:
-            # return updated learnupets
-            return jsonify({'updated_learnuplet': learnuplet_uuid}), 200
-        else:
-            return jsonify(
-                {'Error': 'no update of learnuplet %s' % learnuplet_uuid}), 400
+        query, update = learndone(learnuplet_uuid, request.get_json())
     except KeyError:
         return jsonify({'Error': 'wrong key in posted data'}), 400
+    # update status and perf in one round-trip, the previous version of the
+    # learnuplet tells what has been modified (not found if nothing changes)
+    previous_learnuplet = mongo.db.learnuplet.find_one_and_update(
+        query, revisions.stamped({'$set': update}),
+        return_document=ReturnDocument.BEFORE)
+    if not previous_learnuplet:
+        return jsonify(
+            {'Error': 'no update of learnuplet %s' % learnuplet_uuid}), 400
+    cache.response_cache.invalidate('learnuplet')
+    learnuplet_perf = dict(previous_learnuplet, **update)
+    if updated_perf(previous_learnuplet, update):
+        # find model with best performance
+        if learnuplet_perf['perf'] is not None:
+            best_model = leaderboard.record(mongo.db, learnuplet_perf)['best']
+        else:
+            best_model = leaderboard.best_model(
+                mongo.db, learnuplet_perf['problem'], learnuplet_perf['algo'])
+        # change model start in next learnuplet (no best model if perf is
+        # not a number)
+        model_start = (best_model or learnuplet_perf)['model_end']
+        next_learnuplet = mongo.db.learnuplet.find_one_and_update(
+            *next_model_start(learnuplet_perf, model_start),
+            projection=private_projection,
+            return_document=ReturnDocument.BEFORE)
+        # push it to compute
+        if next_learnuplet and compute_url:
+            next_learnuplet['model_start'] = model_start
+            tasks.post_uplet([next_learnuplet], compute_url, 'learn')
+        cache.response_cache.invalidate('learnuplet')
+    if previous_learnuplet['status'] != update['status']:
+        # return updated learnupets
+        return jsonify({'updated_learnuplet': learnuplet_uuid}), 200
+    else:
+        return jsonify(
+            {'Error': 'no update of learnuplet %s' % learnuplet_uuid}), 400
 
 
 @app.route('/preddone/<preduplet_uuid>', methods=['POST'])
@@ -411,27 +736,23 @@ def update_preduplet(preduplet_uuid):
         - *updated_preduplet*: uuid of updated preduplet
     """
     try:
-        request_data = request.get_json()
-        # update status in current preduplet
-        updated_status = mongo.db.preduplet.update_one(
-            {'uuid': preduplet_uuid},
-            {'$set': {'status': request_data["status"]}})
-        # update perf in current preduplet if learning has been done
-        if request_data["status"] == 'done':
-            mongo.db.preduplet.update_one(
-                {'uuid': preduplet_uuid},
-                {'$set': {
-                    'status': request_data['status'],
-                    'timestamp_done': int(time.time()),
-                    'prediction_storage_uuid': request_data['prediction_storage_uuid']}})
-        if updated_status.modified_count == 1:
-            return jsonify({'updated_preduplet': preduplet_uuid}), 200
-        else:
-            return jsonify(
-                {'Error': 'no update of preduplet %s' % preduplet_uuid}), 400
+        query, update = preddone(preduplet_uuid, request.get_json())
     except KeyError:
         return jsonify({'Error': 'wrong key in posted data'}), 400
+    # a preduplet already in this status is left untouched
+    updated_status = mongo.db.preduplet.update_one(query, update)
+    cache.response_cache.invalidate('preduplet')
+    if updated_status.modified_count == 1:
+        return jsonify({'updated_preduplet': preduplet_uuid}), 200
+    else:
+        return jsonify(
+            {'Error': 'no update of preduplet %s' % preduplet_uuid}), 400
+
 
+if os.environ.get('PRELOAD_APP', "F") != "T":
+    create_app()
 
 if __name__ == '__main__':
+    with app.app_context():
+        migrate.prepare_db(mongo.db)
     app.run(debug=True, host='0.0.0.0')
@@ -0,0 +1,702 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+
+ Asyncio variant of the API of api.py: same routes, documents, errors, caches
+ and metrics, with motor to access MongoDB and httpx to post uplets to
+ Compute, for high-concurrency I/O-bound traffic (e.g. callbacks of Compute
+ workers). It can run side by side with the Flask app, on the same database.
+
+ Requires starlette, motor and httpx, and an ASGI server (see
+ requirements-asgi.txt), e.g. from the app folder:
+     uvicorn asgi_api:app --port 5001 --workers 4
+
+ Unlike api.py, MongoDB commands are not attributed to requests (no
+ X-Mongo-Commands header nor log of requests over MONGO_QUERY_BUDGET).
+'''
+
+import functools
+import json
+import os
+import time
+from base64 import b64decode
+from contextlib import asynccontextmanager
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag, \
+    unquote_etag
+import asgi_tasks
+import cache
+import compression
+import dispatch
+import leases
+import metrics
+import migrate
+import pagination
+import revisions
+from schema import assignment, build_data, build_document, \
+    build_documents, build_prediction, claim_order, claim_params, \
+    claim_queries, duplicates, fields_projection, heartbeat_params, \
+    inserted_documents, learndone, list_collection, list_query, \
+    next_model_start, positive_int, preddone, private_projection, \
+    related_problems, updated_perf, valid_claim
+import serializer
+
+# Same configuration as api.py
+testing = os.environ.get('TESTING', "F")
+db_name = 'test_orchestrator' if testing == "T" else 'orchestrator'
+mongo_host = os.environ.get('MONGO_HOST', "localhost")
+mongo_pool_size = int(os.environ.get('MONGO_POOL_SIZE', 100))
+mongo_uri = 'mongodb://%s/%s?maxPoolSize=%d' % (mongo_host, db_name,
+                                                mongo_pool_size)
+compute_url = os.environ.get('COMPUTE_URL')
+users = {os.environ.get('USER_AUTH'): os.environ.get('PWD_AUTH')}
+
+# Database of the process, created at startup in its event loop
+db = None
+# Database with the synchronous driver, for helpers run in a thread out of
+# the path of requests (indexes at startup, counts of uplets in /metrics)
+sync_db = None
+# Counts of uplets exposed in /metrics
+uplet_collector = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global db, sync_db, uplet_collector
+    client = AsyncIOMotorClient(mongo_uri)
+    sync_client = MongoClient(mongo_uri, connect=False)
+    db = client[db_name]
+    sync_db = sync_client[db_name]
+    uplet_collector = metrics.UpletCollector(sync_db,
+                                             dispatch.DISPATCH_COLLECTION)
+    # idempotent, so each worker can do it at startup
+    await run_in_threadpool(migrate.prepare_db, sync_db)
+    # Post uplets to Compute and put back to todo uplets of dead workers in
+    # background
+    asgi_tasks.start(db, compute_url, sweep=testing != "T")
+    try:
+        yield
+    finally:
+        await asgi_tasks.stop()
+        client.close()
+        sync_client.close()
+
+
+def authorized(request):
+    """
+    Check the HTTP basic authentication of a request (USER_AUTH and
+    PWD_AUTH)
+    """
+    try:
+        scheme, credentials = request.headers['authorization'].split(None, 1)
+        username, password = b64decode(credentials).decode().split(':', 1)
+    except (KeyError, ValueError, UnicodeError):
+        return False
+    return scheme.lower() == 'basic' and username in users and \
+        users[username] == password
+
+
+def jsonify(obj):
+    """JSON response, encoded by serializer.dumps"""
+    return Response(serializer.dumps(obj), media_type='application/json')
+
+
+async def get_json(request):
+    """
+    Posted JSON document, None if the request is not JSON (as
+    flask.Request.get_json)
+    """
+    content_type = request.headers.get('content-type', '')
+    if content_type.split(';')[0].strip() != 'application/json':
+        return None
+    try:
+        return json.loads((await request.body()).decode())
+    except ValueError:
+        raise HTTPException(400, 'Failed to decode JSON object')
+
+
+def best_mimetype(request):
+    return parse_accept_header(request.headers.get('accept'),
+                               MIMEAccept).best
+
+
+def requested_projection(request):
+    """
+    Mongo projection of the fields requested with the *fields* parameter
+    (comma separated field names), None to get all fields
+    """
+    return fields_projection(request.query_params.get('fields'))
+
+
+async def compress_stream(chunks, encoding):
+    """Compress an asynchronous stream, as compression.compress_stream"""
+    compressor = compression.COMPRESSORS[encoding]()
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress_response(request, response):
+    """
+    Compress a JSON response with the preferred encoding of the client, as
+    compression.compress_response
+    """
+    mimetype = response.headers.get('content-type', '').split(';')[0]
+    if response.status_code != 200 or \
+            mimetype not in compression.COMPRESSED_MIMETYPES or \
+            'content-encoding' in response.headers:
+        return response
+    response.headers.add_vary_header('Accept-Encoding')
+    encoding = parse_accept_header(
+        request.headers.get('accept-encoding')).best_match(
+            compression.ENCODINGS)
+    if not encoding:
+        return response
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = compress_stream(response.body_iterator,
+                                                 encoding)
+    else:
+        if len(response.body) < compression.COMPRESSION_MIN_SIZE:
+            return response
+        response.body = compression.compress(response.body, encoding)
+        response.headers['Content-Length'] = str(len(response.body))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = unquote_etag(response.headers.get('etag'))
+    if etag and not weak:
+        response.headers['ETag'] = quote_etag(
+            compression.encoded_etag(etag, encoding))
+    return response
+
+
+routes = []
+
+
+def route(rule, methods):
+    """
+    Register a view for a rule of api.py (e.g. /<collection_name>), with
+    basic authentication. Views are coroutines taking the request and the
+    variables of the rule, and returning a response and its status code.
+    Their responses are compressed and recorded in metrics, as in api.py.
+    Views are registered in the order of api.py, and their rules are
+    matched in the order of match_order.
+    """
+    def decorator(view):
+        async def endpoint(request):
+            start = time.time()
+            if authorized(request):
+                response, status = await view(request, **request.path_params)
+                response.status_code = status
+            else:
+                response = Response('Unauthorized Access', 401, headers={
+                    'WWW-Authenticate':
+                    'Basic realm="Authentication Required"'})
+            metrics.REQUESTS.labels(request.method, rule,
+                                    response.status_code).inc()
+            metrics.REQUEST_DURATION.labels(request.method, rule).observe(
+                time.time() - start)
+            return compress_response(request, response)
+        path = rule.replace('<', '{').replace('>', '}')
+        routes.append(Route(path, endpoint, methods=methods))
+        return view
+    return decorator
+
+
+def match_order(route):
+    """
+    Sort key of routes, matching urls with the rule Flask would choose (as
+    werkzeug.routing.Rule.match_compare_key): rules without variables
+    first, then rules with more parts, then static parts before variables.
+    E.g. /leaderboard/changes is matched by /leaderboard/<problem_uuid>,
+    not by /<collection_name>/changes.
+    """
+    parts = route.path.strip('/').split('/')
+    weights = [(1, 0) if part.startswith('{') else (0, -len(part))
+               for part in parts]
+    return '{' in route.path, -len(weights), weights
+
+
+def cached(view):
+    """
+    Decorator of GET views taking a *collection_name*, serving their
+    successful responses from cache.response_cache, as cache.cached
+    """
+    @functools.wraps(view)
+    async def wrapper(request, collection_name, **kwargs):
+        response_cache = cache.response_cache
+        if response_cache.max_bytes <= 0 or \
+                'stream' in request.query_params or \
+                best_mimetype(request) == 'application/x-ndjson':
+            return await view(request, collection_name, **kwargs)
+        key = (request.url.path,
+               tuple(sorted(request.query_params.multi_items())))
+        entry = response_cache.get(key)
+        if entry is None:
+            generation = response_cache.generation(collection_name)
+            response, status = await view(request, collection_name,
+                                          **kwargs)
+            if status != 200:
+                return response, status
+            entry = response_cache.put(key, collection_name, generation,
+                                       response.body, response.media_type)
+        etag = compression.matching_etag(
+            parse_etags(request.headers.get('if-none-match')), entry.etag)
+        if etag:
+            return Response(headers={'ETag': quote_etag(etag)}), 304
+        return Response(entry.body, media_type=entry.mimetype,
+                        headers={'ETag': quote_etag(entry.etag)}), 200
+    return wrapper
+
+
+def query_args(request):
+    """
+    Parameters of a request, with the first value of each (as
+    werkzeug.datastructures.MultiDict.to_dict)
+    """
+    args = {}
+    for k, v in request.query_params.multi_items():
+        args.setdefault(k, v)
+    return args
+
+
+async def ndjson_stream(documents):
+    """Generate documents one per line, as pagination.ndjson_stream"""
+    async for d in documents:
+        yield pagination.ndjson_line(d)
+
+
+async def json_stream(key, documents, limit=0):
+    """
+    Generate the JSON object {key: [documents], "next": cursor} chunk by
+    chunk, as pagination.json_stream
+    """
+    stream = pagination.JSONStream(key, limit)
+    yield stream.start()
+    async for d in documents:
+        yield stream.document(d)
+    yield stream.end()
+
+
+@route('/metrics', methods=['GET'])
+async def get_metrics(request):
+    """
+    Get metrics in the Prometheus text format (see api.py)
+    """
+    data, content_type = await run_in_threadpool(metrics.latest,
+                                                 uplet_collector)
+    return Response(data, headers={'Content-Type': content_type}), 200
+
+
+@route('/<collection_name>', methods=['GET'])
+@cached
+async def get_all_documents(request, collection_name):
+    """
+    Get all the documents corresponding to the (*collection_name*), with the
+    parameters of api.get_all_documents
+    """
+    if collection_name in list_collection:
+        collection = db[collection_name]
+        args = query_args(request)
+        try:
+            query, limit, paginated = list_query(args)
+        except ValueError:
+            return jsonify({'Error': 'wrong pagination parameters'}), 400
+        stream = args.get('stream')
+        if best_mimetype(request) == 'application/x-ndjson':
+            stream = 'ndjson'
+        documents = collection.find(query, requested_projection(request))
+        if paginated:
+            # keyset pagination on the _id index
+            documents = documents.sort('_id', 1).limit(limit)
+        key = '%ss' % collection_name
+        if stream == 'ndjson':
+            return StreamingResponse(ndjson_stream(documents),
+                                     media_type='application/x-ndjson'), 200
+        elif stream == 'json':
+            return StreamingResponse(json_stream(key, documents, limit),
+                                     media_type='application/json'), 200
+        return jsonify(pagination.page(key, await documents.to_list(None),
+                                       limit, paginated)), 200
+    else:
+        return jsonify({'Error': 'Page does not exist'}), 404
+
+
+@route('/<collection_name>/changes', methods=['GET'])
+async def get_changes(request, collection_name):
+    """
+    Get the documents of the (*collection_name*) created or modified since
+    a previous call, as api.get_changes
+    """
+    if collection_name not in list_collection:
+        return jsonify({'Error': 'Page does not exist'}), 404
+    args = query_args(request)
+    try:
+        since, limit = revisions.changes_params(args)
+        query, projection = revisions.changes_query(
+            since, requested_projection(request))
+    except ValueError:
+        return jsonify({'Error': 'wrong since or limit parameters'}), 400
+    documents = await db[collection_name].find(query, projection).sort(
+        revisions.CHANGES_ORDER).limit(limit).to_list(None)
+    return jsonify(revisions.changes_page(
+        collection_name, documents, revisions.changes_token(documents),
+        args.get('since'))), 200
+
+
+@route('/<collection_name>/<document_uuid>', methods=['GET'])
+@cached
+async def get_document(request, collection_name, document_uuid):
+    """
+    Get a document of a collection, as api.get_document
+    """
+    if collection_name in list_collection:
+        d = await db[collection_name].find_one(
+            {"uuid": document_uuid}, requested_projection(request))
+        if not d:
+            return jsonify({'Error': 'Document does not exist'}), 404
+        return jsonify(pagination.clean_document(d)), 200
+    else:
+        return jsonify({'Error': 'Page does not exist'}), 404
+
+
+@route('/leaderboard/<problem_uuid>', methods=['GET'])
+async def get_leaderboard(request, problem_uuid):
+    """
+    Get the best models of a problem, as api.get_leaderboard
+    """
+    try:
+        k = positive_int(request.query_params.get('k', 10))
+    except ValueError:
+        return jsonify({'Error': 'k should be a positive integer'}), 400
+    return jsonify(
+        {'leaderboard': await asgi_tasks.top(db, problem_uuid, k)}), 200
+
+
+async def insert_documents(collection_name, list_data, related_problems=None):
+    """
+    Add several documents with one unordered insert_many, as
+    api.insert_documents
+
+    :return: inserted documents, and errors with the index of the
+        corresponding posted document
+    :rtype: tuple
+    """
+    new_docs, indices, errors = build_documents(collection_name, list_data,
+                                                related_problems)
+    failed = set()
+    if new_docs:
+        try:
+            await db[collection_name].insert_many(new_docs, ordered=False)
+        except BulkWriteError as e:
+            failed = duplicates(e)
+    return inserted_documents(collection_name, new_docs, indices, errors,
+                              failed)
+
+
+@route('/problem', methods=['POST'])
+async def add_problem(request):
+    """
+    Add a new problem, or several problems if a list is posted, as
+    api.add_problem
+    """
+    request_data = await get_json(request)
+    if isinstance(request_data, list):
+        new_docs, errors = await insert_documents('problem', request_data)
+        for new_doc in new_docs:
+            cache.problem_cache.put(new_doc)
+        cache.response_cache.invalidate('problem')
+        return jsonify({'new_problems': new_docs, 'errors': errors}), \
+            201 if new_docs else 400
+    try:
+        new_doc = build_document('problem', request_data)
+    except KeyError:
+        return jsonify({'Error': 'wrong key in posted data'}), 400
+    try:
+        await db.problem.insert_one(new_doc)
+    except DuplicateKeyError:
+        return jsonify({'Error': 'problem %s already exists' %
+                        new_doc['uuid']}), 400
+    cache.problem_cache.put(new_doc)
+    cache.response_cache.invalidate('problem')
+    return jsonify({'new_problem': pagination.clean_document(new_doc)}), 201
+
+
+@route('/algo', methods=['POST'])
+async def add_algo(request):
+    """
+    Add a new algorithm, or several algorithms if a list is posted, as
+    api.add_algo
+    """
+    request_data = await get_json(request)
+    if isinstance(request_data, list):
+        # Check associated problems exist, in at most one query
+        problems = await asgi_tasks.get_problems(
+            db, related_problems(request_data))
+        new_docs, errors = await insert_documents('algo', request_data,
+                                                  set(problems))
+        n_learnuplets = await asgi_tasks.algos_learnuplet(db, new_docs,
+                                                          compute_url)
+        cache.response_cache.invalidate('algo', 'learnuplet')
+        return jsonify({'new_algos': new_docs, 'errors': errors,
+                        'new_learnuplets': n_learnuplets}), \
+            201 if new_docs else 400
+    try:
+        # Check associated problem exists
+        if not isinstance(request_data['problem'], str):
+            return jsonify({'Error': 'non-existing related problem'}), 400
+        problems = await asgi_tasks.get_problems(db,
+                                                 [request_data['problem']])
+        if not problems:
+            return jsonify({'Error': 'non-existing related problem'}), 400
+        new_doc = build_document('algo', request_data)
+    except KeyError:
+        return jsonify({'Error': 'wrong key in posted data'}), 400
+    try:
+        await db.algo.insert_one(new_doc)
+    except DuplicateKeyError:
+        return jsonify({'Error': 'algo %s already exists' %
+                        new_doc['uuid']}), 400
+    inserted_doc = pagination.clean_document(new_doc)
+    n_learnuplets = await asgi_tasks.algos_learnuplet(db, [inserted_doc],
+                                                      compute_url)
+    cache.response_cache.invalidate('algo', 'learnuplet')
+    return jsonify({'new_algo': inserted_doc,
+                    'new_learnuplets': n_learnuplets}), 201
+
+
+@route('/data', methods=['POST'])
+async def add_data(request):
+    """
+    Add data, as api.add_data
+    """
+    n_learnuplets = 0
+    try:
+        list_problems, new_docs = build_data(await get_json(request))
+    except KeyError:
+        return jsonify({'Error': 'wrong key in posted data'}), 400
+    # Check associated problems exists, in at most one query
+    existing_problems = await asgi_tasks.get_problems(db, list_problems)
+    if set(existing_problems) != set(list_problems):
+        return jsonify({'Error': 'non-existing related problem'}), 400
+    # put docs in db, in one round-trip. Already existing data are left
+    # untouched (unique uuid index), so posting the same data twice is
+    # harmless
+    failed = set()
+    try:
+        await db.data.insert_many(new_docs, ordered=False)
+    except BulkWriteError as e:
+        failed = duplicates(e)
+    new_docs = [pagination.clean_document(new_doc)
+                for i, new_doc in enumerate(new_docs) if i not in failed]
+    uuid_new_docs = [new_doc['uuid'] for new_doc in new_docs]
+    # create learnuplets
+    if uuid_new_docs:
+        for pb_uuid in list_problems:
+            n_learnuplets += await asgi_tasks.data_learnuplet(
+                db, pb_uuid, uuid_new_docs, compute_url)
+        cache.response_cache.invalidate('data', 'learnuplet')
+    return jsonify({'new_datas': new_docs,
+                    'new_learnuplets': n_learnuplets}), 201
+
+
+@route('/prediction', methods=['POST'])
+async def request_prediction(request):
+    """
+    Request a prediction on data for a given problem, as
+    api.request_prediction
+    """
+    try:
+        # Check that fields are valid
+        try:
+            new_preduplet = build_prediction(await get_json(request))
+        except ValueError:
+            return jsonify({'Error': 'data field should be an UUID'}), 400
+        preduplet_created = await asgi_tasks.create_preduplet(
+            db, new_preduplet, compute_url)
+        cache.response_cache.invalidate('preduplet')
+        if preduplet_created:
+            return jsonify(preduplet_created), 201
+        else:
+            return jsonify({'Error': 'no problem or trained model'}), 400
+    except KeyError:
+        return jsonify({'Error': 'wrong key in posted data'}), 400
+
+
+@route('/worker/claim', methods=['POST'])
+async def claim_uplets(request):
+    """
+    Assign to a worker uplets which are ready to be processed, as
+    api.claim_uplets
+    """
+    try:
+        worker, uplet_type, n = claim_params(await get_json(request))
+    except (KeyError, ValueError, TypeError):
+        return jsonify({'Error': 'wrong key in posted data'}), 400
+    if not valid_claim(uplet_type, n):
+        return jsonify({'Error': 'wrong value in posted data'}), 400
+    claimed = []
+    for _ in range(n):
+        uplet = await db[uplet_type].find_one_and_update(
+            claim_queries[uplet_type], assignment(worker),
+            projection=private_projection,
+            sort=claim_order[uplet_type],
+            return_document=ReturnDocument.AFTER)
+        if not uplet:
+            break
+        claimed.append(uplet)
+    cache.response_cache.invalidate(uplet_type)
+    return jsonify({'%ss' % uplet_type: claimed}), 200
+
+
+@route('/worker/heartbeat', methods=['POST'])
+async def heartbeat(request):
+    """
+    Extend the leases of a worker on its pending learnuplets and preduplets,
+    as api.heartbeat
+    """
+    try:
+        worker, uplet_uuids = heartbeat_params(await get_json(request))
+    except KeyError:
+        return jsonify({'Error': 'wrong key in posted data'}), 400
+    except ValueError:
+        return jsonify({'Error': 'uplets field should be a list'}), 400
+    expiry, extended = await asgi_tasks.extend_leases(db, worker,
+                                                      uplet_uuids)
+    cache.response_cache.invalidate(*extended)
+    return jsonify(leases.heartbeat_output(expiry, extended)), 200
+
+
+@route('/worker/<uplet_type>/<uplet_uuid>', methods=['POST'])
+async def set_uplet_worker(request, uplet_type, uplet_uuid):
+    """
+    Update the worker of a learnuplet or preduplet and change its status to
+    pending, as api.set_uplet_worker
+    """
+    if uplet_type in ['learnuplet', 'preduplet']:
+        try:
+            request_data = await get_json(request)
+            updated = await db[uplet_type].update_one(
+                {'uuid': uplet_uuid, 'status': 'todo'},
+                assignment(request_data['worker']))
+            cache.response_cache.invalidate(uplet_type)
+            if updated.modified_count == 1:
+                return jsonify({'%s_worker_set' % uplet_type: uplet_uuid}), 200
+            else:
+                return jsonify(
+                    {'Error':
+                     'worker not set for %s %s. Might be already pending' %
+                     (uplet_type, uplet_uuid)}), 400
+        except KeyError:
+            return jsonify({'Error': 'wrong key in posted data'}), 400
+    else:
+        return jsonify({'Error': 'Page does not exist'}), 404
+
+
+@route('/learndone/<learnuplet_uuid>', methods=['POST'])
+async def report_perf_learnuplet(request, learnuplet_uuid):
+    """
+    Post output of learning, which updates the corresponding learnuplet, as
+    api.report_perf_learnuplet
+    """
+    try:
+        query, update = learndone(learnuplet_uuid, await get_json(request))
+    except KeyError:
+        return jsonify({'Error': 'wrong key in posted data'}), 400
+    # update status and perf in one round-trip, the previous version of the
+    # learnuplet tells what has been modified (not found if nothing changes)
+    previous_learnuplet = await db.learnuplet.find_one_and_update(
+        query, revisions.stamped({'$set': update}),
+        return_document=ReturnDocument.BEFORE)
+    if not previous_learnuplet:
+        return jsonify(
+            {'Error': 'no update of learnuplet %s' % learnuplet_uuid}), 400
+    cache.response_cache.invalidate('learnuplet')
+    learnuplet_perf = dict(previous_learnuplet, **update)
+    if updated_perf(previous_learnuplet, update):
+        # find model with best performance
+        if learnuplet_perf['perf'] is not None:
+            best_model = (await asgi_tasks.record(db, learnuplet_perf))['best']
+        else:
+            best_model = await asgi_tasks.best_model(
+                db, learnuplet_perf['problem'], learnuplet_perf['algo'])
+        # change model start in next learnuplet (no best model if perf is
+        # not a number)
+        model_start = (best_model or learnuplet_perf)['model_end']
+        next_learnuplet = await db.learnuplet.find_one_and_update(
+            *next_model_start(learnuplet_perf, model_start),
+            projection=private_projection,
+            return_document=ReturnDocument.BEFORE)
+        # push it to compute
+        if next_learnuplet and compute_url:
+            next_learnuplet['model_start'] = model_start
+            await asgi_tasks.enqueue(db, [next_learnuplet], compute_url,
+                                     'learn')
+        cache.response_cache.invalidate('learnuplet')
+    if previous_learnuplet['status'] != update['status']:
+        return jsonify({'updated_learnuplet': learnuplet_uuid}), 200
+    else:
+        return jsonify(
+            {'Error': 'no update of learnuplet %s' % learnuplet_uuid}), 400
+
+
+@route('/preddone/<preduplet_uuid>', methods=['POST'])
+async def update_preduplet(request, preduplet_uuid):
+    """
+    Update status of a preduplet, as api.update_preduplet
+    """
+    try:
+        query, update = preddone(preduplet_uuid, await get_json(request))
+    except KeyError:
+        return jsonify({'Error': 'wrong key in posted data'}), 400
+    # a preduplet already in this status is left untouched
+    updated_status = await db.preduplet.update_one(query, update)
+    cache.response_cache.invalidate('preduplet')
+    if updated_status.modified_count == 1:
+        return jsonify({'updated_preduplet': preduplet_uuid}), 200
+    else:
+        return jsonify(
+            {'Error': 'no update of preduplet %s' % preduplet_uuid}), 400
+
+
+app = Starlette(routes=sorted(routes, key=match_order), lifespan=lifespan)
@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+
+ Asyncio counterparts of tasks.py, leaderboard.py, leases.py and dispatch.py
+ for asgi_api.py, on a motor database. Documents, queries and updates are the
+ same (see uplets.py and the helpers of these modules), so both APIs can
+ serve the same database, and their dispatchers drain the same queue.
+'''
+
+import asyncio
+import json
+import logging
+import time
+import httpx
+import pymongo
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+import cache
+import dispatch
+import leaderboard
+import leases
+import metrics
+import pagination
+import revisions
+from uplets import INSERT_CHUNK_SIZE, active_data, algo_learnuplets, \
+    build_preduplet, chain_learnuplets, chain_tails_pipeline, \
+    first_learnuplets
+
+logger = logging.getLogger(__name__)
+
+
+async def get_problems(db, problem_uuids):
+    """
+    Problems read through cache.problem_cache, as its get_many method
+
+    :param db: database of the orchestrator
+    :param problem_uuids: UUIDs of the problems
+    :type db: motor.motor_asyncio.AsyncIOMotorDatabase
+    :type problem_uuids: list
+    :return: existing problems (not to be modified), by UUID
+    :rtype: dictionary
+    """
+    problem_cache = cache.problem_cache
+    problems, missing = problem_cache.lookup(problem_uuids)
+    if missing:
+        async for problem in db[problem_cache.collection_name].find(
+                {'uuid': {'$in': missing}}):
+            problems[problem['uuid']] = problem_cache.put(problem)
+    return problems
+
+
+async def enqueue(db, list_uplet, worker_url, uplet_prefix):
+    """
+    Add uplets to the dispatch queue, as dispatch.enqueue
+
+    :return: number of queued uplets
+    :rtype: integer
+    """
+    items = dispatch.queue_items(list_uplet, worker_url, uplet_prefix)
+    if items:
+        await db[dispatch.DISPATCH_COLLECTION].insert_many(items,
+                                                           ordered=False)
+        if _dispatcher:
+            _dispatcher.wake_up()
+    return len(items)
+
+
+async def record(db, learnuplet):
+    """
+    Register the performance of a learnuplet in the leaderboard, as
+    leaderboard.record
+
+    :return: leaderboard entry of the algo after the update
+    :rtype: dictionary
+    """
+    query, update = leaderboard.record_update(learnuplet)
+    collection = db[leaderboard.LEADERBOARD_COLLECTION]
+    try:
+        return await collection.find_one_and_update(
+            query, update, upsert=True, return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        # entry concurrently created by another request, update it
+        return await collection.find_one_and_update(
+            query, update, return_document=ReturnDocument.AFTER)
+
+
+async def best_model(db, problem_uuid, algo_uuid=None):
+    """
+    Best model of a problem, or of an algo, as leaderboard.best_model
+
+    :return: *perf*, *model_end* and *learnuplet* UUID of the best model,
+        None if no model has been trained
+    :rtype: dictionary
+    """
+    query, learnuplet_query = leaderboard.best_queries(problem_uuid,
+                                                       algo_uuid)
+    entry = await db[leaderboard.LEADERBOARD_COLLECTION].find_one(
+        query, sort=leaderboard.BEST_ORDER)
+    if entry:
+        return entry['best']
+    learnuplet = await db.learnuplet.find_one(learnuplet_query,
+                                              sort=leaderboard.PERF_ORDER)
+    if learnuplet:
+        return (await record(db, learnuplet))['best']
+    return None
+
+
+async def top(db, problem_uuid, k):
+    """
+    k best models of a problem, as leaderboard.top
+
+    :rtype: list
+    """
+    entries = db[leaderboard.LEADERBOARD_COLLECTION].find(
+        {'problem': problem_uuid}, sort=leaderboard.BEST_ORDER, limit=k)
+    return [leaderboard.top_entry(entry) async for entry in entries]
+
+
+async def insert_learnuplets(db, list_learnuplets, start_ranks,
+                             compute_url=None):
+    """
+    Write learnuplets to db and push to Compute the ones which can be
+    trained right away, as tasks.insert_learnuplets
+
+    :return: number of inserted learnuplets
+    :rtype: integer
+    """
+    for learnuplet in list_learnuplets:
+        revisions.stamp(learnuplet)
+    for i in range(0, len(list_learnuplets), INSERT_CHUNK_SIZE):
+        await db.learnuplet.insert_many(
+            list_learnuplets[i: i + INSERT_CHUNK_SIZE], ordered=False)
+    if compute_url:
+        await enqueue(db, first_learnuplets(list_learnuplets, start_ranks),
+                      compute_url, 'learn')
+    return len(list_learnuplets)
+
+
+async def algos_learnuplet(db, list_algo, compute_url=None):
+    """
+    Create new learnuplets when adding new algos, as tasks.algos_learnuplet
+
+    :return: number of created learnuplets
+    :rtype: integer
+    """
+    problems = await get_problems(
+        db, list({algo["problem"] for algo in list_algo}))
+    train_data = {}
+    list_new_learnuplets = []
+    for algo in list_algo:
+        problem = problems.get(algo["problem"])
+        if not problem:
+            continue
+        if problem["uuid"] not in train_data:
+            train_data[problem["uuid"]] = active_data(
+                problem, await db.data.distinct(
+                    "uuid", {"problems": problem["uuid"]}))
+        list_new_learnuplets += algo_learnuplets(
+            algo, problem, train_data[problem["uuid"]])
+    return await insert_learnuplets(db, list_new_learnuplets,
+                                    {algo["uuid"]: 0 for algo in list_algo},
+                                    compute_url)
+
+
+async def data_learnuplet(db, problem_uuid, data_uuids, compute_url=None):
+    """
+    Create new learnuplets with new data of a problem, as
+    tasks.data_learnuplet
+
+    :return: number of created learnuplets
+    :rtype: integer
+    """
+    problem = (await get_problems(db, [problem_uuid]))[problem_uuid]
+    chain_tails = [last_learnuplet async for last_learnuplet in
+                   db.learnuplet.aggregate(chain_tails_pipeline(problem_uuid))]
+    list_new_learnuplets, start_ranks = chain_learnuplets(
+        problem, data_uuids, chain_tails)
+    return await insert_learnuplets(db, list_new_learnuplets, start_ranks,
+                                    compute_url)
+
+
+async def create_preduplet(db, new_preduplet, compute_url=None):
+    """
+    Create new preduplet, as tasks.create_preduplet
+
+    :return: the preduplet, 0 if no model found
+    """
+    model = await best_model(db, new_preduplet["problem"])
+    if not model:
+        return 0
+    problems = await get_problems(db, [new_preduplet["problem"]])
+    build_preduplet(new_preduplet, model, problems[new_preduplet["problem"]])
+    await db.preduplet.insert_one(revisions.stamp(new_preduplet))
+    if compute_url:
+        await enqueue(db, [new_preduplet], compute_url, 'pred')
+    return pagination.clean_document(new_preduplet)
+
+
+async def extend_leases(db, worker, uplet_uuids=None):
+    """
+    Extend the leases of a worker on its pending uplets, as leases.extend
+
+    :return: new expiry time and number of extended leases, by collection
+    :rtype: tuple
+    """
+    expiry, query, update = leases.extension(worker, uplet_uuids)
+    extended = {}
+    for uplet_type in leases.UPLET_PREFIXES:
+        result = await db[uplet_type].update_many(query, update)
+        extended[uplet_type] = result.matched_count
+    return expiry, extended
+
+
+async def reclaim_expired(db, compute_url=None):
+    """
+    Put back to todo the pending uplets whose lease has expired, as
+    leases.reclaim_expired
+
+    :return: number of reclaimed uplets
+    :rtype: integer
+    """
+    n = 0
+    query, update = leases.expiration(time.time())
+    for uplet_type, uplet_prefix in leases.UPLET_PREFIXES.items():
+        while True:
+            uplet = await db[uplet_type].find_one_and_update(
+                query, update, return_document=ReturnDocument.AFTER)
+            if not uplet:
+                break
+            logger.warning('lease of worker on %s %s expired', uplet_type,
+                           uplet['uuid'])
+            if compute_url:
+                await enqueue(db, [uplet], compute_url, uplet_prefix)
+            n += 1
+            cache.response_cache.invalidate(uplet_type)
+    return n
+
+
+class Dispatcher(object):
+    """
+    Task posting queued uplets to Compute with an asynchronous HTTP client,
+    as dispatch.Dispatcher (same queue, retries and batches)
+    """
+
+    def __init__(self, db, concurrency=dispatch.DISPATCH_CONCURRENCY,
+                 timeout=dispatch.DISPATCH_TIMEOUT,
+                 max_attempts=dispatch.DISPATCH_MAX_ATTEMPTS,
+                 backoff=dispatch.DISPATCH_BACKOFF,
+                 poll_interval=dispatch.DISPATCH_POLL_INTERVAL,
+                 batch_size=dispatch.DISPATCH_BATCH_SIZE,
+                 linger=dispatch.DISPATCH_LINGER):
+        self.queue = db[dispatch.DISPATCH_COLLECTION]
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.linger = linger
+        # urls of Compute which do not accept batches of uplets
+        self.unbatched_urls = set()
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=concurrency,
+                                max_keepalive_connections=concurrency))
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wake_up = asyncio.Event()
+        self._stopped = asyncio.Event()
+        self._task = None
+
+    async def claim(self, now):
+        """
+        Claim an uplet ready to be posted
+
+        :return: claimed queue item, None if there is none
+        """
+        query, update = dispatch.claim_update(now, self.timeout)
+        return await self.queue.find_one_and_update(
+            query, update, sort=[('next_attempt', pymongo.ASCENDING)])
+
+    async def post(self, url, payload):
+        """
+        Post a payload to Compute
+
+        :return: None if posted, error otherwise
+        :raise httpx.HTTPStatusError: if Compute rejects the payload (4xx)
+        """
+        start = time.time()
+        try:
+            async with self._semaphore:
+                r = await self.client.post(url, content=json.dumps(payload))
+        except httpx.HTTPError as e:
+            return str(e) or type(e).__name__
+        finally:
+            metrics.DISPATCH_DURATION.observe(time.time() - start)
+        if r.status_code >= 500:
+            return 'HTTP %s' % r.status_code
+        r.raise_for_status()
+        return None
+
+    async def send(self, item):
+        """
+        Post an uplet to Compute, then remove it from the queue or schedule
+        a new attempt
+        """
+        try:
+            error = await self.post(item['url'], item['uplet'])
+        except httpx.HTTPStatusError as e:
+            # rejected by Compute, no need to retry
+            await self.queue.update_one({'_id': item['_id']},
+                                        dispatch.reject_update(item, e))
+            return
+        if error:
+            await self.queue.update_one(
+                {'_id': item['_id']},
+                dispatch.retry_update(item, error, self.max_attempts,
+                                      self.backoff))
+        else:
+            await self.queue.delete_one({'_id': item['_id']})
+            dispatch.posted([item])
+
+    async def send_batch(self, items):
+        """
+        Post uplets for the same url in one request, then remove them from
+        the queue or schedule new attempts
+        """
+        url = items[0]['url']
+        if len(items) == 1 or url in self.unbatched_urls:
+            await asyncio.gather(*[self.send(item) for item in items])
+            return
+        try:
+            error = await self.post(url, [item['uplet'] for item in items])
+        except httpx.HTTPStatusError as e:
+            logger.info('%s does not accept batches (%s), post uplets one '
+                        'by one', url, e)
+            self.unbatched_urls.add(url)
+            await asyncio.gather(*[self.send(item) for item in items])
+            return
+        if error:
+            for item in items:
+                await self.queue.update_one(
+                    {'_id': item['_id']},
+                    dispatch.retry_update(item, error, self.max_attempts,
+                                          self.backoff))
+        else:
+            await self.queue.delete_many(
+                {'_id': {'$in': [item['_id'] for item in items]}})
+            dispatch.posted(items)
+
+    async def dispatch(self):
+        """
+        Post uplets ready to be posted, with at most *concurrency* requests
+        at a time
+
+        :return: number of processed uplets
+        :rtype: integer
+        """
+        n = 0
+        now = time.time()
+        while not self._stopped.is_set():
+            items = []
+            for _ in range(self.concurrency * self.batch_size):
+                item = await self.claim(now)
+                if not item:
+                    break
+                items.append(item)
+            if not items:
+                break
+            await asyncio.gather(*[
+                self.send_batch(batch)
+                for batch in dispatch.batches(items, self.batch_size)])
+            n += len(items)
+        return n
+
+    async def run(self):
+        while not self._stopped.is_set():
+            try:
+                await self.dispatch()
+            except PyMongoError as e:
+                logger.warning('dispatch queue unavailable: %s', e)
+            except Exception:
+                logger.exception('dispatch failed')
+            try:
+                await asyncio.wait_for(self._wake_up.wait(),
+                                       self.poll_interval)
+            except asyncio.TimeoutError:
+                continue
+            self._wake_up.clear()
+            # let uplets queued in the meantime join the same batches
+            await asyncio.sleep(self.linger)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self.run())
+        return self
+
+    def wake_up(self):
+        """Make the dispatcher look for new uplets right away"""
+        self._wake_up.set()
+
+    async def stop(self):
+        self._stopped.set()
+        self._wake_up.set()
+        if self._task:
+            await self._task
+        await self.client.aclose()
+
+
+class Sweeper(object):
+    """
+    Task reclaiming uplets whose lease has expired, as leases.Sweeper
+    """
+
+    def __init__(self, db, compute_url=None, interval=leases.SWEEP_INTERVAL):
+        self.db = db
+        self.compute_url = compute_url
+        self.interval = interval
+        self._stopped = asyncio.Event()
+        self._task = None
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._stopped.wait(), self.interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await reclaim_expired(self.db, self.compute_url)
+            except PyMongoError as e:
+                logger.warning('expired leases not reclaimed: %s', e)
+            except Exception:
+                logger.exception('expired leases not reclaimed')
+
+    def start(self):
+        self._task = asyncio.ensure_future(self.run())
+        return self
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task:
+            await self._task
+
+
+_dispatcher = None
+_sweeper = None
+
+
+def start(db, compute_url=None, sweep=True):
+    """
+    Start the dispatcher (if compute_url is given) and the sweeper of the
+    event loop
+
+    :param db: database of the orchestrator
+    :param compute_url: Compute url to which uplets are pushed
+    :param sweep: whether to reclaim expired leases
+    :type db: motor.motor_asyncio.AsyncIOMotorDatabase
+    :type compute_url: url
+    :type sweep: boolean
+    """
+    global _dispatcher, _sweeper
+    if compute_url:
+        _dispatcher = Dispatcher(db).start()
+    if sweep:
+        _sweeper = Sweeper(db, compute_url).start()
+
+
+async def stop():
+    """Stop the tasks started by start"""
+    global _dispatcher, _sweeper
+    for task in (_dispatcher, _sweeper):
+        if task:
+            await task.stop()
+    _dispatcher = _sweeper = None
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+"""
+Compare round-trips to MongoDB and time needed to write the learnuplets of a
+data upload one by one (insert_one) or with tasks.insert_learnuplets.
+
+Requires a running MongoDB (see MONGO_HOST). From the app folder:
+    python -m benchmarks.bulk_insert --n-data 10000 --n-algo 50
+"""
+
+import argparse
+import os
+import time
+
+os.environ['TESTING'] = "T"
+import api  # noqa: E402
+import tasks  # noqa: E402
+from instrumentation import command_counter  # noqa: E402
+
+
+def build_learnuplets(n_data, n_algo, sz_batch):
+    data = ['D%s' % i for i in range(n_data)]
+    list_learnuplets = []
+    for i in range(n_algo):
+        list_learnuplets += tasks.build_learnuplets(
+            data, sz_batch, ['DT0'], 'PB', 'PW', 'A%s' % i, 'M%s' % i, 1)
+    return list_learnuplets
+
+
+def insert_one_by_one(list_learnuplets):
+    for learnuplet in list_learnuplets:
+        api.mongo.db.learnuplet.insert_one(learnuplet)
+
+
+def insert_bulk(list_learnuplets):
+    tasks.insert_learnuplets(list_learnuplets,
+                             {learnuplet['algo']: 1
+                              for learnuplet in list_learnuplets})
+
+
+def run(name, insert, args):
+    list_learnuplets = build_learnuplets(args.n_data, args.n_algo,
+                                         args.sz_batch)
+    api.mongo.db.learnuplet.drop()
+    command_counter.reset()
+    start = time.time()
+    insert(list_learnuplets)
+    duration = time.time() - start
+    print('%-12s %8d learnuplets %8d round-trips %8.3f s' %
+          (name, len(list_learnuplets), command_counter.total(),
+           duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-data', type=int, default=10000)
+    parser.add_argument('--n-algo', type=int, default=50)
+    parser.add_argument('--sz-batch', type=int, default=10)
+    args = parser.parse_args()
+    # do not push anything to Compute
+    api.compute_url = None
+    with api.app.app_context():
+        run('insert_one', insert_one_by_one, args)
+        run('insert_many', insert_bulk, args)
+        api.mongo.cx.drop_database(api.app.config['MONGO_DBNAME'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+"""
+Load test of the API: seed the db with realistic volumes, launch the API
+with gunicorn (and optionally mongod), drive a mixed workload of
+concurrent clients, and report throughput and latency percentiles by
+endpoint. Results are written to a JSON file, to compare commits:
+    python -m benchmarks.load --output before.json
+    git checkout other_commit
+    python -m benchmarks.load --output after.json --baseline before.json
+
+Requires gunicorn, and a running MongoDB (see --mongo-host) or the path of a
+mongod binary (--mongod), in which case a temporary db is used.
+The test_orchestrator db is used, and dropped at the end unless --keep-db
+is given (to run again with --no-seed). From the app folder:
+    python -m benchmarks.load --n-learnuplet 1000000 --duration 60
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+# environment of the launched API, before test_api changes it
+SERVER_ENV = dict(os.environ)
+os.environ['TESTING'] = "T"
+import numpy as np  # noqa: E402
+import requests  # noqa: E402
+from pymongo import MongoClient  # noqa: E402
+import indexes  # noqa: E402
+import revisions  # noqa: E402
+from test_api import (generate_list_learnuplets,  # noqa: E402
+                      generate_list_preduplets)
+
+DB_NAME = 'test_orchestrator'
+AUTH = ('bench', 'bench')
+# Documents inserted at once while seeding
+SEED_CHUNK_SIZE = 10000
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until(ready, timeout, what):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if ready():
+                return
+        except Exception:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('%s not ready after %s s' % (what, timeout))
+
+
+def insert_chunks(collection, documents):
+    chunk = []
+    for document in documents:
+        chunk.append(revisions.stamp(document))
+        if len(chunk) == SEED_CHUNK_SIZE:
+            collection.insert_many(chunk, ordered=False)
+            chunk = []
+    if chunk:
+        collection.insert_many(chunk, ordered=False)
+
+
+def seed(db, args):
+    """
+    Fill the db with problems, algos, data, chains of learnuplets (one per
+    algo, the first ranks being done) and preduplets
+
+    :return: UUIDs of the seeded documents, used by the workload
+    :rtype: dictionary
+    """
+    start = time.time()
+    db.client.drop_database(DB_NAME)
+    indexes.ensure_indexes(db)
+    problems = ['P%s' % p for p in range(args.n_problem)]
+    algos_per_problem = max(1, args.n_algo // args.n_problem)
+    ranks = max(1, args.n_learnuplet // (args.n_problem * algos_per_problem))
+    test_data = ['DT%s' % i for i in range(args.n_test)]
+    insert_chunks(db.problem, (
+        {'uuid': problem, 'workflow': 'W%s' % problem,
+         'test_dataset': test_data, 'size_train_dataset': args.n_train,
+         'timestamp_upload': int(time.time())} for problem in problems))
+    insert_chunks(db.algo, (
+        {'uuid': 'A%s_%s_s' % (problem, j), 'problem': problem,
+         'name': 'algo %s' % j, 'timestamp_upload': int(time.time())}
+        for problem in problems for j in range(algos_per_problem)))
+    insert_chunks(db.data, (
+        {'uuid': 'D%s' % i, 'problems': [problems[i % len(problems)]],
+         'timestamp_upload': int(time.time())}
+        for i in range(args.n_data)))
+
+    def learnuplets():
+        for problem in problems:
+            for rank in range(ranks):
+                # first half of the chains is trained
+                done = rank < ranks // 2
+                model_prefix = 'A%s_' % problem if rank == 0 else \
+                    'M%s_%s_' % (problem, rank)
+                for learnuplet in generate_list_learnuplets(
+                        algos_per_problem, n_train=args.n_train,
+                        n_test=args.n_test, problem=problem,
+                        workflow='W%s' % problem,
+                        status='done' if done else 'todo',
+                        perf=list(np.random.rand(algos_per_problem))
+                        if done else None,
+                        algo_prefix='A%s_' % problem,
+                        model_prefix=model_prefix,
+                        uuid_prefix='L%s_%s_' % (problem, rank), rank=rank):
+                    if done:
+                        learnuplet['perf'] = float(learnuplet['perf'])
+                        learnuplet['train_perf'] = [
+                            float(p) for p in learnuplet['train_perf']]
+                        learnuplet['test_perf'] = [
+                            float(p) for p in learnuplet['test_perf']]
+                    yield learnuplet
+    insert_chunks(db.learnuplet, learnuplets())
+    insert_chunks(db.preduplet, (
+        preduplet for problem in problems
+        for preduplet in generate_list_preduplets(
+            args.n_preduplet // len(problems), problem=problem,
+            workflow='W%s' % problem, uuid_prefix='R%s_' % problem)))
+    print('seeded %s problems, %s algos, %s data, %s learnuplets, '
+          '%s preduplets in %.1f s' %
+          (len(problems), db.algo.count(), db.data.count(),
+           db.learnuplet.count(), db.preduplet.count(), time.time() - start))
+    return {'problems': problems,
+            'learnuplets': ['L%s_%s_%s' % (problem, rank, j)
+                            for problem in problems[:10]
+                            for rank in range(ranks)
+                            for j in range(min(algos_per_problem, 100))]}
+
+
+class Workload(object):
+    """
+    Mixed workload of readers (dashboards, mirrors) and writers (uploads of
+    data, workers of Compute)
+    """
+
+    def __init__(self, url, seeded):
+        self.url = url
+        self.problems = seeded['problems']
+        self.learnuplets = seeded['learnuplets']
+        self.worker = str(uuid.uuid4())
+        # (weight, endpoint, function returning the method, path and data)
+        self.operations = [
+            (20, 'GET /problem', lambda: ('GET', '/problem', None)),
+            (10, 'GET /algo?problem', lambda: (
+                'GET', '/algo?problem=%s' % random.choice(self.problems),
+                None)),
+            (15, 'GET /learnuplet?limit', lambda: (
+                'GET', '/learnuplet?limit=100', None)),
+            (15, 'GET /learnuplet/<uuid>', lambda: (
+                'GET', '/learnuplet/%s' % random.choice(self.learnuplets),
+                None)),
+            (5, 'GET /learnuplet/changes', lambda: (
+                'GET', '/learnuplet/changes?limit=100', None)),
+            (10, 'GET /leaderboard/<problem>', lambda: (
+                'GET', '/leaderboard/%s' % random.choice(self.problems),
+                None)),
+            (5, 'POST /data', lambda: (
+                'POST', '/data',
+                {'uuid': [str(uuid.uuid4()) for _ in range(10)],
+                 'problems': [random.choice(self.problems)]})),
+            (10, 'POST /worker/claim', lambda: (
+                'POST', '/worker/claim',
+                {'worker': self.worker, 'uplet_type': 'learnuplet', 'n': 1})),
+            (5, 'POST /learndone/<uuid>', lambda: (
+                'POST', '/learndone/%s' % random.choice(self.learnuplets),
+                {'status': 'done', 'perf': random.random(),
+                 'train_perf': [random.random()],
+                 'test_perf': [random.random()]})),
+            (5, 'POST /prediction', lambda: (
+                'POST', '/prediction',
+                {'data': str(uuid.uuid4()),
+                 'problem': random.choice(self.problems)})),
+        ]
+        total = float(sum(op[0] for op in self.operations))
+        self.cumulative_weights = np.cumsum(
+            [op[0] / total for op in self.operations])
+
+    def choose(self):
+        i = int(np.searchsorted(self.cumulative_weights, random.random()))
+        _, endpoint, build = self.operations[min(i,
+                                                 len(self.operations) - 1)]
+        return (endpoint,) + build()
+
+    def client(self, deadline, results):
+        session = requests.Session()
+        session.auth = AUTH
+        while time.time() < deadline:
+            endpoint, method, path, data = self.choose()
+            start = time.time()
+            try:
+                r = session.request(method, self.url + path, json=data,
+                                    headers={'Accept-Encoding': 'gzip'})
+                r.content
+                status = r.status_code
+            except requests.RequestException:
+                status = 0
+            results.append((endpoint, time.time() - start, status))
+
+    def run(self, concurrency, duration):
+        results = []
+        deadline = time.time() + duration
+        clients = [threading.Thread(target=self.client,
+                                    args=(deadline, results))
+                   for _ in range(concurrency)]
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        return results, time.time() - start
+
+
+def report(results, elapsed):
+    """
+    :return: count, errors (status 0 or 5xx), throughput (requests/s) and
+        latency percentiles (ms), by endpoint and for all requests
+    :rtype: dictionary
+    """
+    by_endpoint = defaultdict(list)
+    for endpoint, latency, status in results:
+        by_endpoint[endpoint].append((latency, status))
+        by_endpoint['all'].append((latency, status))
+    summary = {}
+    for endpoint, samples in sorted(by_endpoint.items()):
+        latencies = np.array([latency for latency, _ in samples]) * 1000
+        summary[endpoint] = {
+            'count': len(samples),
+            'errors': sum(1 for _, status in samples
+                          if status == 0 or status >= 500),
+            'throughput': len(samples) / elapsed,
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p95': float(np.percentile(latencies, 95)),
+            'p99': float(np.percentile(latencies, 99)),
+        }
+    return summary
+
+
+def print_summary(summary, baseline=None):
+    print('%-28s %7s %6s %9s %8s %8s %8s' %
+          ('endpoint', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+           'p99 ms'))
+    for endpoint, s in summary.items():
+        line = '%-28s %7d %6d %9.1f %8.1f %8.1f %8.1f' % (
+            endpoint, s['count'], s['errors'], s['throughput'], s['p50'],
+            s['p95'], s['p99'])
+        if baseline and endpoint in baseline:
+            line += '  p95 x%.2f' % (s['p95'] / baseline[endpoint]['p95'])
+        print(line)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--mongo-host', default=SERVER_ENV.get(
+        'MONGO_HOST', 'localhost'))
+    parser.add_argument('--mongod', help='path of mongod, to launch a '
+                        'temporary MongoDB')
+    parser.add_argument('--url', help='url of an already running API '
+                        '(seeded db and auth %s:%s)' % AUTH)
+    parser.add_argument('--workers', type=int, default=4,
+                        help='gunicorn workers')
+    parser.add_argument('--worker-class', default='gevent')
+    parser.add_argument('--n-problem', type=int, default=10)
+    parser.add_argument('--n-algo', type=int, default=2000)
+    parser.add_argument('--n-data', type=int, default=100000)
+    parser.add_argument('--n-learnuplet', type=int, default=100000)
+    parser.add_argument('--n-preduplet', type=int, default=10000)
+    parser.add_argument('--n-train', type=int, default=10)
+    parser.add_argument('--n-test', type=int, default=10)
+    parser.add_argument('--no-seed', action='store_true',
+                        help='reuse the db of a previous run')
+    parser.add_argument('--keep-db', action='store_true',
+                        help='do not drop the db at the end')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--output', default='load_results.json')
+    parser.add_argument('--baseline', help='results of a previous run')
+    args = parser.parse_args()
+
+    processes = []
+    tmp_dir = None
+    try:
+        mongo_host = args.mongo_host
+        if args.mongod:
+            tmp_dir = tempfile.mkdtemp()
+            mongo_port = free_port()
+            processes.append(subprocess.Popen(
+                [args.mongod, '--dbpath', tmp_dir, '--port', str(mongo_port),
+                 '--bind_ip', '127.0.0.1', '--quiet'],
+                stdout=subprocess.DEVNULL))
+            mongo_host = '127.0.0.1:%s' % mongo_port
+        client = MongoClient(mongo_host)
+        wait_until(lambda: client.admin.command('ping'), 30, 'MongoDB')
+        db = client[DB_NAME]
+        if args.no_seed:
+            seeded = {'problems': db.problem.distinct('uuid'),
+                      'learnuplets': [d['uuid'] for d in db.learnuplet.find(
+                          {}, {'uuid': 1}).limit(1000)]}
+        else:
+            seeded = seed(db, args)
+
+        url = args.url
+        if not url:
+            port = free_port()
+            env = dict(SERVER_ENV, TESTING='T', MONGO_HOST=mongo_host,
+                       LISTEN_PORT=str(port), USER_AUTH=AUTH[0],
+                       PWD_AUTH=AUTH[1], WORKERS=str(args.workers),
+                       WORKER_CLASS=args.worker_class)
+            processes.append(subprocess.Popen(
+                [sys.executable, '-m', 'gunicorn', '--config',
+                 'gunicorn_config.py', '--access-logfile', '/dev/null',
+                 'api:app'], env=env))
+            url = 'http://127.0.0.1:%s' % port
+        wait_until(lambda: requests.get(url + '/problem', auth=AUTH).ok, 60,
+                   'API')
+
+        results, elapsed = Workload(url, seeded).run(args.concurrency,
+                                                     args.duration)
+        summary = report(results, elapsed)
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)['endpoints']
+        print_summary(summary, baseline)
+        with open(args.output, 'w') as f:
+            json.dump({'commit': git_commit(),
+                       'timestamp': int(time.time()),
+                       'parameters': vars(args),
+                       'elapsed': elapsed,
+                       'endpoints': summary}, f, indent=2, sort_keys=True)
+        print('results written to %s' % args.output)
+        if not args.keep_db:
+            client.drop_database(DB_NAME)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+"""
+Time the learnuplet planning functions of tasks.py over grids of data count,
+mini-batch size and algo count, and report their time and memory
+allocations per created learnuplet:
+    build       tasks.build_learnuplets (no db)
+    create      tasks.create_learnuplet (build, insert and dispatch)
+    algo        tasks.algo_learnuplet, a new algo on n-data active data
+    data        tasks.data_learnuplet, n-data new data for n-algo algos
+
+Requires a running MongoDB (see MONGO_HOST), whose test database is
+dropped at the end. Uplets are queued for Compute but not posted (no
+dispatcher is started). From the app folder:
+    python -m benchmarks.planning --n-data 1000,10000 --sz-batch 10,100 \
+        --n-algo 1,10 --output planning.json
+"""
+
+import argparse
+import gc
+import itertools
+import json
+import os
+import time
+import tracemalloc
+
+os.environ['TESTING'] = "T"
+import api  # noqa: E402
+import cache  # noqa: E402
+import dispatch  # noqa: E402
+import tasks  # noqa: E402
+
+PROBLEM = 'P0'
+WORKFLOW = 'W0'
+TEST_DATA = ['DT%s' % i for i in range(10)]
+
+
+def data_uuids(n_data):
+    return ['D%s' % i for i in range(n_data)]
+
+
+def reset(db, n_data, sz_batch):
+    """Empty the db, with one problem of n_data data"""
+    for name in ('problem', 'algo', 'data', 'learnuplet',
+                 dispatch.DISPATCH_COLLECTION):
+        db[name].drop()
+    cache.problem_cache.clear()
+    db.problem.insert_one({'uuid': PROBLEM, 'workflow': WORKFLOW,
+                           'test_dataset': TEST_DATA,
+                           'size_train_dataset': sz_batch})
+    db.data.insert_many([{'uuid': uuid, 'problems': [PROBLEM],
+                          'timestamp_upload': i}
+                         for i, uuid in enumerate(data_uuids(n_data))])
+
+
+def case_build(db, n_data, sz_batch, n_algo):
+    """build_learnuplets of n_data data, for n_algo algos"""
+    new_data = data_uuids(n_data)
+
+    def run():
+        return sum(len(tasks.build_learnuplets(
+            new_data, sz_batch, TEST_DATA, PROBLEM, WORKFLOW, 'A%s' % i,
+            'A%s' % i, 0)) for i in range(n_algo))
+    return None, run
+
+
+def case_create(db, n_data, sz_batch, n_algo):
+    """create_learnuplet of n_data data, for n_algo algos"""
+    new_data = data_uuids(n_data)
+
+    def setup():
+        db.learnuplet.drop()
+        db[dispatch.DISPATCH_COLLECTION].drop()
+
+    def run():
+        return sum(len(tasks.create_learnuplet(
+            new_data, sz_batch, TEST_DATA, PROBLEM, WORKFLOW, 'A%s' % i,
+            'A%s' % i, 0)) for i in range(n_algo))
+    return setup, run
+
+
+def case_algo(db, n_data, sz_batch, n_algo):
+    """algo_learnuplet of n_algo new algos, on n_data active data"""
+    algos = [{'uuid': 'A%s' % i, 'problem': PROBLEM} for i in range(n_algo)]
+    db.algo.insert_many([dict(algo) for algo in algos])
+
+    def setup():
+        db.learnuplet.drop()
+        db[dispatch.DISPATCH_COLLECTION].drop()
+
+    def run():
+        return sum(tasks.algo_learnuplet(algo['uuid']) for algo in algos)
+    return setup, run
+
+
+def case_data(db, n_data, sz_batch, n_algo):
+    """data_learnuplet of n_data new data, for n_algo trained algos"""
+    new_data = data_uuids(n_data)
+
+    def setup():
+        db.learnuplet.drop()
+        db[dispatch.DISPATCH_COLLECTION].drop()
+        # one learnuplet done by algo, at the end of its chain
+        db.learnuplet.insert_many([
+            {'uuid': 'L%s' % i, 'problem': PROBLEM, 'algo': 'A%s' % i,
+             'rank': 0, 'model_end': 'M%s' % i, 'status': 'done'}
+            for i in range(n_algo)])
+
+    def run():
+        return tasks.data_learnuplet(PROBLEM, new_data)
+    return setup, run
+
+
+CASES = {'build': case_build,
+         'create': case_create,
+         'algo': case_algo,
+         'data': case_data}
+
+
+def measure(setup, run, n_repeat):
+    """
+    :return: number of learnuplets, best time (in seconds), peak and
+        retained memory (in bytes) of a call to run
+    :rtype: tuple
+    """
+    durations = []
+    for _ in range(n_repeat):
+        if setup:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        n = run()
+        durations.append(time.perf_counter() - start)
+    # allocations are traced on a separate call, tracemalloc being slow
+    if setup:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    run()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return n, min(durations), peak - before, current - before
+
+
+def parse_grid(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help='comma-separated cases to run')
+    parser.add_argument('--n-data', type=parse_grid, default='1000,10000')
+    parser.add_argument('--sz-batch', type=parse_grid, default='10,100')
+    parser.add_argument('--n-algo', type=parse_grid, default='1,10')
+    parser.add_argument('--n-repeat', type=int, default=3)
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args()
+    # uplets are queued for Compute, without dispatcher to post them
+    api.compute_url = 'http://compute.invalid'
+    results = []
+    print('%-7s %8s %6s %6s %10s %10s %12s %12s %12s' %
+          ('case', 'n_data', 'batch', 'algos', 'uplets', 'ms',
+           'us/uplet', 'peak B/uplet', 'kept B/uplet'))
+    with api.app.app_context():
+        db = api.mongo.db
+        for name in args.cases.split(','):
+            for n_data, sz_batch, n_algo in itertools.product(
+                    args.n_data, args.sz_batch, args.n_algo):
+                reset(db, n_data, sz_batch)
+                setup, run = CASES[name](db, n_data, sz_batch, n_algo)
+                n, duration, peak, kept = measure(setup, run, args.n_repeat)
+                per_uplet = max(n, 1)
+                print('%-7s %8d %6d %6d %10d %10.1f %12.1f %12d %12d' %
+                      (name, n_data, sz_batch, n_algo, n, duration * 1000,
+                       duration * 1e6 / per_uplet, peak / per_uplet,
+                       kept / per_uplet))
+                results.append({'case': name, 'n_data': n_data,
+                                'sz_batch': sz_batch, 'n_algo': n_algo,
+                                'learnuplets': n, 'seconds': duration,
+                                'peak_bytes': peak, 'kept_bytes': kept})
+        api.mongo.cx.drop_database(api.app.config['MONGO_DBNAME'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+"""
+Compare the throughput of the JSON serializers available to the API (see
+serializer.py) on a synthetic learnuplet collection, as returned by
+GET /learnuplet, with flask.jsonify as a baseline.
+
+Does not need MongoDB. From the app folder:
+    python -m benchmarks.serializers --n-learnuplet 10000
+"""
+
+import argparse
+import os
+import time
+
+os.environ['TESTING'] = "T"
+from flask import jsonify  # noqa: E402
+import api  # noqa: E402
+import pagination  # noqa: E402
+import serializer  # noqa: E402
+from test_api import generate_list_learnuplets  # noqa: E402
+
+
+def run(name, serialize, n_repeat):
+    start = time.time()
+    for _ in range(n_repeat):
+        size = len(serialize())
+    duration = (time.time() - start) / n_repeat
+    print('%-16s %10.1f ms %10.1f MB/s' %
+          (name, duration * 1000, size / duration / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-learnuplet', type=int, default=10000)
+    parser.add_argument('--n-train', type=int, default=20)
+    parser.add_argument('--n-repeat', type=int, default=10)
+    args = parser.parse_args()
+    learnuplets = generate_list_learnuplets(
+        args.n_learnuplet, n_train=args.n_train, status="done", perf=0.5)
+    # documents as read from MongoDB (train_perf of numpy floats)
+    for learnuplet in learnuplets:
+        learnuplet['train_perf'] = [float(p) for p in learnuplet['train_perf']]
+        learnuplet['test_perf'] = [float(p) for p in learnuplet['test_perf']]
+        learnuplet['_id'] = learnuplet['uuid']
+    with api.app.test_request_context():
+        run('flask.jsonify', lambda: jsonify(
+            {'learnuplets': [pagination.clean_document(d)
+                             for d in learnuplets]}).get_data(),
+            args.n_repeat)
+    for name in sorted(serializer.SERIALIZERS):
+        dumps = serializer.get_serializer(name)
+        run(name, lambda: dumps(
+            {'learnuplets': [pagination.clean_document(d)
+                             for d in learnuplets]}), args.n_repeat)
+        serializer.dumps = dumps
+        run('%s (stream)' % name, lambda: b''.join(
+            pagination.json_stream('learnuplets', learnuplets)),
+            args.n_repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from flask import Response, request
+import compression
+import metrics
+import pagination
+
+# Memory (in bytes) used by cached responses of a process
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES',
+                                              64 * 1024 * 1024))
+# Time (in seconds) during which a response is served from cache. Each
+# worker process has its own cache, only invalidated by the writes it
+# handles, so responses of the other workers can be stale for this time
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 5))
+# Number of problems kept in cache by a process
+PROBLEM_CACHE_SIZE = int(os.environ.get('PROBLEM_CACHE_SIZE', 1024))
+# Time (in seconds) during which a problem is read from cache
+PROBLEM_CACHE_TTL = float(os.environ.get('PROBLEM_CACHE_TTL', 300))
+
+
+class CachedResponse(object):
+    """
+    Serialized body of a GET response, with its strong ETag
+    """
+
+    def __init__(self, collection, body, mimetype, expires):
+        self.collection = collection
+        self.body = body
+        self.mimetype = mimetype
+        self.expires = expires
+        self.etag = hashlib.sha1(body).hexdigest()
+
+    def response(self):
+        """
+        Response to the current request, 304 Not Modified if its
+        *If-None-Match* header matches the ETag (or the ETag of the
+        compressed response, see compression.matching_etag)
+        """
+        etag = compression.matching_etag(request.if_none_match, self.etag)
+        if etag:
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        response = Response(self.body, mimetype=self.mimetype)
+        response.set_etag(self.etag)
+        return response
+
+
+class ResponseCache(object):
+    """
+    LRU cache of serialized responses, bounded by the size of their bodies.
+    Entries are invalidated by collection, after each write to it.
+    """
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES,
+                 ttl=RESPONSE_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        # incremented at each invalidation, so that a response built from
+        # data read before a write is not cached after it
+        self._generations = Counter()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def generation(self, collection):
+        with self._lock:
+            return self._generations[collection]
+
+    def get(self, key):
+        """
+        :return: cached response of key, None if missing or expired
+        :rtype: CachedResponse
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, collection, generation, body, mimetype):
+        """
+        Cache the body of a response built from data of collection
+
+        :param key: key of the request
+        :param collection: collection read to build the response
+        :param generation: generation of the collection before it was read
+        :param body: serialized response
+        :param mimetype: mimetype of the response
+        :type collection: string
+        :type generation: integer
+        :type body: bytes
+        :type mimetype: string
+        :return: the cached response
+        :rtype: CachedResponse
+        """
+        entry = CachedResponse(collection, body, mimetype,
+                               time.time() + self.ttl)
+        if len(body) > self.max_bytes:
+            return entry
+        with self._lock:
+            if generation != self._generations[collection]:
+                # collection modified meanwhile
+                return entry
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+        return entry
+
+    def invalidate(self, *collections):
+        """
+        Remove the cached responses built from data of collections
+        """
+        with self._lock:
+            for collection in collections:
+                self._generations[collection] += 1
+            for key in [key for key, entry in self._entries.items()
+                        if entry.collection in collections]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        self.size -= len(self._entries.pop(key).body)
+
+
+response_cache = ResponseCache()
+
+
+class DocumentCache(object):
+    """
+    Read-through LRU cache of documents of a collection, by UUID, for
+    documents which are not modified after their creation (e.g. problems).
+    Missing documents are not cached, as they can be created by another
+    process.
+    """
+
+    def __init__(self, collection_name, max_size, ttl):
+        self.collection_name = collection_name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, db, uuid):
+        """
+        :param db: database from which missing documents are read
+        :param uuid: UUID of the document
+        :type db: pymongo.database.Database
+        :return: the document (not to be modified), None if it does not exist
+        :rtype: dictionary
+        """
+        return self.get_many(db, [uuid]).get(uuid)
+
+    def get_many(self, db, uuids):
+        """
+        Get several documents, with one query for those which are not in
+        cache
+
+        :param db: database from which missing documents are read
+        :param uuids: UUIDs of the documents
+        :type db: pymongo.database.Database
+        :type uuids: list
+        :return: existing documents (not to be modified), by UUID
+        :rtype: dictionary
+        """
+        documents, missing = self.lookup(uuids)
+        if missing:
+            for document in db[self.collection_name].find(
+                    {'uuid': {'$in': missing}}):
+                documents[document['uuid']] = self.put(document)
+        return documents
+
+    def lookup(self, uuids):
+        """
+        Get the documents which are in cache, without reading the db (e.g.
+        to read the missing ones with another driver)
+
+        :param uuids: UUIDs of the documents
+        :type uuids: list
+        :return: cached documents by UUID, and UUIDs of the missing ones
+        :rtype: tuple
+        """
+        documents = {}
+        now = time.time()
+        with self._lock:
+            for uuid in set(uuids):
+                entry = self._entries.get(uuid)
+                if entry is None or entry[1] <= now:
+                    continue
+                self._entries.move_to_end(uuid)
+                documents[uuid] = entry[0]
+            self.hits += len(documents)
+            missing = [uuid for uuid in set(uuids) if uuid not in documents]
+            self.misses += len(missing)
+        metrics.DOCUMENT_CACHE_LOOKUPS.labels(self.collection_name,
+                                              'hit').inc(len(documents))
+        metrics.DOCUMENT_CACHE_LOOKUPS.labels(self.collection_name,
+                                              'miss').inc(len(missing))
+        return documents, missing
+
+    def put(self, document):
+        """
+        Cache a document, e.g. when it is created (write-through)
+
+        :return: the cached document, without its private fields
+        :rtype: dictionary
+        """
+        document = pagination.clean_document(document)
+        if self.max_size <= 0:
+            return document
+        with self._lock:
+            self._entries.pop(document['uuid'], None)
+            self._entries[document['uuid']] = (document,
+                                               time.time() + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return document
+
+    def invalidate(self, *uuids):
+        with self._lock:
+            for uuid in uuids:
+                self._entries.pop(uuid, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+problem_cache = DocumentCache('problem', PROBLEM_CACHE_SIZE,
+                              PROBLEM_CACHE_TTL)
+
+
+def cached(view):
+    """
+    Decorator of GET views taking a *collection_name*, serving their
+    successful responses from response_cache, with a strong ETag.
+    Streamed responses are not cached.
+    """
+    @functools.wraps(view)
+    def wrapper(collection_name, *args, **kwargs):
+        if response_cache.max_bytes <= 0 or 'stream' in request.args or \
+                request.accept_mimetypes.best == 'application/x-ndjson':
+            return view(collection_name, *args, **kwargs)
+        key = (request.path, tuple(sorted(request.args.items(multi=True))))
+        entry = response_cache.get(key)
+        if entry is None:
+            generation = response_cache.generation(collection_name)
+            response, status = view(collection_name, *args, **kwargs)
+            if status != 200:
+                return response, status
+            entry = response_cache.put(key, collection_name, generation,
+                                       response.get_data(), response.mimetype)
+        return entry.response()
+    return wrapper
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+import os
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Buffered responses smaller than this size (in bytes) are not compressed
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+# Compression level of gzip and deflate (1 to 9)
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 6))
+# Quality of brotli (0 to 11), low enough to compress as fast as gzip
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+# Compressed mimetypes
+COMPRESSED_MIMETYPES = ['application/json', 'application/x-ndjson']
+
+
+class ZlibCompressor(object):
+    """Compressor of gzip (wbits=31) or deflate (zlib format) encodings"""
+
+    def __init__(self, wbits):
+        self._compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED,
+                                            wbits)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor(object):
+    """Compressor of br encoding, with the same interface"""
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+# Supported encodings, in order of preference
+ENCODINGS = ['gzip', 'deflate']
+COMPRESSORS = {
+    'gzip': lambda: ZlibCompressor(16 + zlib.MAX_WBITS),
+    'deflate': lambda: ZlibCompressor(zlib.MAX_WBITS),
+}
+if brotli:
+    ENCODINGS.insert(0, 'br')
+    COMPRESSORS['br'] = BrotliCompressor
+
+
+def compress(data, encoding):
+    """
+    :param data: data to compress
+    :param encoding: one of ENCODINGS
+    :type data: bytes
+    :type encoding: string
+    :return: compressed data
+    :rtype: bytes
+    """
+    compressor = COMPRESSORS[encoding]()
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks, encoding):
+    """
+    Compress a stream of chunks, without keeping it in memory. Compressed
+    data are produced as soon as the compressor has enough input.
+
+    :param chunks: iterable of bytes
+    :param encoding: one of ENCODINGS
+    :type encoding: string
+    """
+    compressor = COMPRESSORS[encoding]()
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def encoded_etag(etag, encoding):
+    """
+    Strong ETag of a response compressed with an encoding, e.g.
+    *<etag>-gzip*, as it is not byte-for-byte identical to the
+    uncompressed one
+
+    :type etag: string
+    :type encoding: string
+    :rtype: string
+    """
+    return '%s-%s' % (etag, encoding)
+
+
+def matching_etag(if_none_match, etag):
+    """
+    ETag of the *If-None-Match* header of a request which matches the ETag
+    of a response, compressed or not. Tags are compared with the weak
+    comparison, whatever the version of werkzeug.
+
+    :param if_none_match: parsed *If-None-Match* header
+    :param etag: ETag of the uncompressed response
+    :type if_none_match: werkzeug.datastructures.ETags
+    :type etag: string
+    :return: the matching ETag, None if none matches
+    :rtype: string
+    """
+    for tag in [etag] + [encoded_etag(etag, encoding)
+                         for encoding in ENCODINGS]:
+        if if_none_match.contains_weak(tag):
+            return tag
+    return None
+
+
+def compress_response(response):
+    """
+    Compress a JSON response with the preferred encoding of the client
+    (*Accept-Encoding* header). Streamed responses are compressed on the
+    fly, buffered ones only if they are large enough.
+    A strong ETag gets the suffix of the encoding (see encoded_etag).
+
+    :param response: response of the current request
+    :type response: flask.Response
+    :return: the response
+    :rtype: flask.Response
+    """
+    if response.status_code != 200 or \
+            response.mimetype not in COMPRESSED_MIMETYPES or \
+            'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if not encoding:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.iter_encoded(),
+                                            encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(encoded_etag(etag, encoding))
+    return response
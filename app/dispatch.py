@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import pymongo
+from pymongo.errors import PyMongoError
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+import pagination
+
+logger = logging.getLogger(__name__)
+
+# Collection used as outbox of uplets to be posted to Compute
+DISPATCH_COLLECTION = 'dispatch'
+# Maximum number of simultaneous requests to Compute
+DISPATCH_CONCURRENCY = int(os.environ.get('DISPATCH_CONCURRENCY', 4))
+# Timeout (in seconds) of a request to Compute
+DISPATCH_TIMEOUT = float(os.environ.get('DISPATCH_TIMEOUT', 10))
+# Number of attempts before giving up posting an uplet
+DISPATCH_MAX_ATTEMPTS = int(os.environ.get('DISPATCH_MAX_ATTEMPTS', 5))
+# Delay (in seconds) before the first retry, doubled at each attempt
+DISPATCH_BACKOFF = float(os.environ.get('DISPATCH_BACKOFF', 1))
+# Delay (in seconds) between two polls of an empty queue
+DISPATCH_POLL_INTERVAL = float(os.environ.get('DISPATCH_POLL_INTERVAL', 1))
+# Maximum number of uplets posted in one request (1 to disable batches)
+DISPATCH_BATCH_SIZE = int(os.environ.get('DISPATCH_BATCH_SIZE', 1))
+# Delay (in seconds) to wait for other uplets before posting new ones
+DISPATCH_LINGER = float(os.environ.get('DISPATCH_LINGER', 0))
+
+
+def clean_uplet(uplet):
+    """
+    Make an uplet JSON serializable: remove its private fields and convert
+    its UUIDs
+    """
+    clean = pagination.clean_document(uplet)
+    for k, v in clean.items():
+        if isinstance(v, uuid.UUID):
+            clean[k] = str(v)
+    return clean
+
+
+def make_executor(concurrency):
+    """
+    Pool running at most *concurrency* posts at a time: a pool of greenlets
+    if gevent patched the standard library (e.g. in gevent gunicorn
+    workers), of threads otherwise
+
+    :type concurrency: integer
+    :return: pool with a map method
+    """
+    try:
+        from gevent import monkey
+        from gevent.pool import Pool
+    except ImportError:
+        return ThreadPoolExecutor(concurrency)
+    if monkey.is_module_patched('socket'):
+        return Pool(concurrency)
+    return ThreadPoolExecutor(concurrency)
+
+
+def queue_items(list_uplet, worker_url, uplet_prefix):
+    """
+    Items of the dispatch queue posting uplets to Compute (see enqueue)
+
+    :rtype: list
+    """
+    now = time.time()
+    return [{'uplet': clean_uplet(uplet),
+             'url': '%s/%s' % (worker_url, uplet_prefix),
+             'status': 'queued',
+             'attempts': 0,
+             'next_attempt': now,
+             'timestamp_creation': int(now)}
+            for uplet in list_uplet]
+
+
+def claim_update(now, timeout):
+    """
+    Query and update claiming an item of the dispatch queue scheduled before
+    now, to be posted with this timeout
+
+    :type now: float
+    :type timeout: float
+    :rtype: tuple
+    """
+    # timeout applies to both connection and response, so an uplet not
+    # posted after twice the timeout can be claimed again
+    return ({'status': {'$in': ['queued', 'sending']},
+             'next_attempt': {'$lte': now}},
+            {'$set': {'status': 'sending',
+                      'next_attempt': time.time() + 2 * timeout}})
+
+
+def retry_update(item, error, max_attempts, backoff):
+    """
+    Update of a queue item whose post failed: new attempt with exponential
+    backoff, or failure after max_attempts
+
+    :rtype: dictionary
+    """
+    attempts = item['attempts'] + 1
+    if attempts >= max_attempts:
+        logger.warning('uplet %s not posted to %s after %s attempts: %s',
+                       item['uplet'].get('uuid'), item['url'], attempts,
+                       error)
+        update = {'status': 'failed'}
+        metrics.DISPATCH_POSTS.labels('failed').inc()
+    else:
+        update = {'status': 'queued',
+                  'next_attempt': time.time() + backoff * 2 ** (attempts - 1)}
+        metrics.DISPATCH_POSTS.labels('error').inc()
+    update.update({'attempts': attempts, 'error': error})
+    return {'$set': update}
+
+
+def reject_update(item, error):
+    """Update of a queue item rejected by Compute, not to be retried"""
+    logger.warning('uplet %s rejected by %s: %s',
+                   item['uplet'].get('uuid'), item['url'], error)
+    metrics.DISPATCH_POSTS.labels('rejected').inc()
+    return {'$set': {'status': 'failed', 'error': str(error)},
+            '$inc': {'attempts': 1}}
+
+
+def posted(items):
+    """Record metrics of posted items"""
+    now = time.time()
+    metrics.DISPATCH_POSTS.labels('posted').inc(len(items))
+    for item in items:
+        metrics.DISPATCH_DELAY.observe(now - item['timestamp_creation'])
+
+
+def batches(items, batch_size):
+    """
+    Group items by url, in batches of at most batch_size
+
+    :rtype: list
+    """
+    by_url = {}
+    for item in items:
+        by_url.setdefault(item['url'], []).append(item)
+    return [url_items[i: i + batch_size]
+            for url_items in by_url.values()
+            for i in range(0, len(url_items), batch_size)]
+
+
+def enqueue(db, list_uplet, worker_url, uplet_prefix):
+    """
+    Add uplets to the dispatch queue, from which they are posted to Compute
+    by a Dispatcher
+
+    :param db: database of the orchestrator
+    :param list_uplet: list of learnuplets/preduplets
+    :param worker_url: worker url
+    :param uplet_prefix: pred or learn
+    :type db: pymongo.database.Database
+    :type list_uplet: list
+    :type worker_url: url
+    :type uplet_prefix: string
+    :return: number of queued uplets
+    :rtype: integer
+    """
+    items = queue_items(list_uplet, worker_url, uplet_prefix)
+    if items:
+        db[DISPATCH_COLLECTION].insert_many(items, ordered=False)
+        if _dispatcher:
+            _dispatcher.wake_up()
+    return len(items)
+
+
+class Dispatcher(threading.Thread):
+    """
+    Background thread posting queued uplets to Compute, over a pool of
+    keep-alive connections.
+    Uplets are claimed atomically in the queue, so several dispatchers (e.g.
+    one per gunicorn worker) can drain the same queue. An uplet whose post
+    failed is retried with exponential backoff, and a claimed uplet which is
+    not posted in time (e.g. dispatcher killed) is claimed again.
+    If batch_size > 1, uplets for the same url are posted together as a JSON
+    array, unless Compute rejects arrays, in which case they are posted one
+    by one to this url.
+    """
+
+    def __init__(self, db, concurrency=DISPATCH_CONCURRENCY,
+                 timeout=DISPATCH_TIMEOUT, max_attempts=DISPATCH_MAX_ATTEMPTS,
+                 backoff=DISPATCH_BACKOFF,
+                 poll_interval=DISPATCH_POLL_INTERVAL,
+                 batch_size=DISPATCH_BATCH_SIZE, linger=DISPATCH_LINGER):
+        super(Dispatcher, self).__init__(name='dispatcher', daemon=True)
+        self.queue = db[DISPATCH_COLLECTION]
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.linger = linger
+        # urls of Compute which do not accept batches of uplets
+        self.unbatched_urls = set()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=concurrency,
+                              pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = make_executor(concurrency)
+        self._wake_up = threading.Event()
+        self._stopped = threading.Event()
+
+    def claim(self, now):
+        """
+        Claim an uplet ready to be posted
+
+        :param now: claim uplets scheduled before this time
+        :type now: float
+        :return: claimed queue item, None if there is none
+        """
+        query, update = claim_update(now, self.timeout)
+        return self.queue.find_one_and_update(
+            query, update, sort=[('next_attempt', pymongo.ASCENDING)])
+
+    def post(self, url, payload):
+        """
+        Post a payload to Compute
+
+        :return: None if posted, error otherwise
+        :raise requests.HTTPError: if Compute rejects the payload (4xx)
+        """
+        start = time.time()
+        try:
+            r = self.session.post(url, data=json.dumps(payload),
+                                  timeout=self.timeout)
+        except requests.RequestException as e:
+            return str(e)
+        finally:
+            metrics.DISPATCH_DURATION.observe(time.time() - start)
+        if r.status_code >= 500:
+            return 'HTTP %s' % r.status_code
+        r.raise_for_status()
+        return None
+
+    def retry(self, item, error):
+        """
+        Schedule a new attempt to post an item, or give up after
+        max_attempts
+        """
+        self.queue.update_one(
+            {'_id': item['_id']},
+            retry_update(item, error, self.max_attempts, self.backoff))
+
+    def send(self, item):
+        """
+        Post an uplet to Compute, then remove it from the queue or schedule
+        a new attempt
+        """
+        try:
+            error = self.post(item['url'], item['uplet'])
+        except requests.HTTPError as e:
+            # rejected by Compute, no need to retry
+            self.queue.update_one({'_id': item['_id']},
+                                  reject_update(item, e))
+            return
+        if error:
+            self.retry(item, error)
+        else:
+            self.queue.delete_one({'_id': item['_id']})
+            posted([item])
+
+    def send_batch(self, items):
+        """
+        Post uplets for the same url in one request, then remove them from
+        the queue or schedule new attempts
+        """
+        url = items[0]['url']
+        if len(items) == 1 or url in self.unbatched_urls:
+            for item in items:
+                self.send(item)
+            return
+        try:
+            error = self.post(url, [item['uplet'] for item in items])
+        except requests.HTTPError as e:
+            logger.info('%s does not accept batches (%s), post uplets one '
+                        'by one', url, e)
+            self.unbatched_urls.add(url)
+            for item in items:
+                self.send(item)
+            return
+        if error:
+            for item in items:
+                self.retry(item, error)
+        else:
+            self.queue.delete_many(
+                {'_id': {'$in': [item['_id'] for item in items]}})
+            posted(items)
+
+    def dispatch(self):
+        """
+        Post uplets ready to be posted, with at most *concurrency* requests
+        at a time. Failed posts are retried at the next call.
+
+        :return: number of processed uplets
+        :rtype: integer
+        """
+        n = 0
+        now = time.time()
+        while not self._stopped.is_set():
+            items = []
+            for _ in range(self.concurrency * self.batch_size):
+                item = self.claim(now)
+                if not item:
+                    break
+                items.append(item)
+            if not items:
+                break
+            list(self.executor.map(self.send_batch,
+                                   batches(items, self.batch_size)))
+            n += len(items)
+        return n
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.dispatch()
+            except PyMongoError as e:
+                logger.warning('dispatch queue unavailable: %s', e)
+            except Exception:
+                # e.g. a bad document in the queue: keep dispatching the
+                # other uplets
+                logger.exception('dispatch failed')
+            if self._wake_up.wait(self.poll_interval):
+                self._wake_up.clear()
+                # let uplets queued in the meantime join the same batches
+                self._stopped.wait(self.linger)
+
+    def wake_up(self):
+        """Make the dispatcher look for new uplets right away"""
+        self._wake_up.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake_up.set()
+
+
+_dispatcher = None
+
+
+def start(db, **kwargs):
+    """
+    Start the Dispatcher of the process, if not already started
+
+    :param db: database of the orchestrator
+    :type db: pymongo.database.Database
+    :return: the running dispatcher
+    :rtype: Dispatcher
+    """
+    global _dispatcher
+    if not _dispatcher or not _dispatcher.is_alive():
+        _dispatcher = Dispatcher(db, **kwargs)
+        _dispatcher.start()
+    return _dispatcher
@@ -36,8 +36,17 @@
 '''
 
 # stl
+import multiprocessing
 import os
 
+worker_class = os.getenv("WORKER_CLASS", "gevent")
+# With gevent workers, patch the standard library before anything else (e.g.
+# the app, pymongo and requests when the app is preloaded) is imported, so
+# that their blocking I/O yields to the other requests of the worker
+if worker_class == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
 # Sample Gunicorn configuration file.
 
 #
@@ -106,12 +115,27 @@ backlog = 2048
 #
 #       A positive integer. Generally set in the 1-5 seconds range.
 #
+#   preload_app - Load the application in the master process before
+#       forking the workers, which share its memory and start faster.
+#
+#       True or False
+#
+#   The number of workers is given by the environment variable WORKERS
+#   (default: number of cores), their class by WORKER_CLASS (default:
+#   gevent) and their connections by WORKER_CONNECTIONS (default: 1000).
+#   A gevent worker uses at most MONGO_POOL_SIZE connections to MongoDB
+#   (see api.py), other requests wait for one of them.
+#   With PRELOAD_APP=T, the master process imports api.py without
+#   connecting to MongoDB, and each worker creates its own MongoDB client
+#   and background threads after fork (see post_fork).
+#   Code changes then need a restart of the master, not only of the workers.
+#
 
-workers = 1
-worker_class = 'gevent'
-worker_connections = 1000
+workers = int(os.getenv("WORKERS", multiprocessing.cpu_count()))
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", 1000))
 timeout = 30
 keepalive = 2
+preload_app = os.getenv("PRELOAD_APP", "F") == "T"
 
 #
 #   spew - Install a trace function that spews every line of Python
@@ -201,4 +225,41 @@ access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"
 
 proc_name = None
 
+#
+# Server hooks
+#
+#   on_starting - Called just before the master process is initialized.
+#       The db is prepared there, once for all workers (see migrate.py).
+#
+#   post_fork - Called just after a worker has been forked.
+#
+#   child_exit - Called just after a worker has been exited, in the master
+#       process.
+#
+#   Metrics of the workers are aggregated in the directory given by the
+#   environment variable prometheus_multiproc_dir (see metrics.py), which
+#   is emptied at start, and from which metrics of dead workers are removed.
+#
+
+
+def on_starting(server):
+    import migrate
+    migrate.main()
+    multiproc_dir = os.environ.get('prometheus_multiproc_dir')
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for name in os.listdir(multiproc_dir):
+            if name.endswith('.db'):
+                os.remove(os.path.join(multiproc_dir, name))
+
+
+def post_fork(server, worker):
+    if preload_app:
+        import api
+        api.create_app()
+
 
+def child_exit(server, worker):
+    if os.environ.get('prometheus_multiproc_dir'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
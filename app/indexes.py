@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+import logging
+import pymongo
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Changes of documents, listed by revision (see revisions.py)
+REVISION_INDEX = ([('revision', pymongo.ASCENDING),
+                   ('_id', pymongo.ASCENDING)], {})
+
+# Indexes required by the queries of api.py and tasks.py
+# Each entry is (keys, options) as expected by pymongo create_index
+INDEXES = {
+    'problem': [
+        ([('uuid', pymongo.ASCENDING)], {'unique': True}),
+        REVISION_INDEX,
+    ],
+    'algo': [
+        ([('uuid', pymongo.ASCENDING)], {'unique': True}),
+        ([('problem', pymongo.ASCENDING)], {}),
+        REVISION_INDEX,
+    ],
+    'data': [
+        ([('uuid', pymongo.ASCENDING)], {'unique': True}),
+        ([('problems', pymongo.ASCENDING),
+          ('timestamp_upload', pymongo.ASCENDING)], {}),
+        REVISION_INDEX,
+    ],
+    'learnuplet': [
+        ([('uuid', pymongo.ASCENDING)], {'unique': True}),
+        ([('algo', pymongo.ASCENDING), ('rank', pymongo.ASCENDING)], {}),
+        ([('problem', pymongo.ASCENDING), ('algo', pymongo.ASCENDING),
+          ('rank', pymongo.ASCENDING)], {}),
+        ([('algo', pymongo.ASCENDING), ('perf', pymongo.DESCENDING)], {}),
+        ([('problem', pymongo.ASCENDING), ('perf', pymongo.DESCENDING)], {}),
+        # queue of learnuplets to be claimed by workers
+        ([('status', pymongo.ASCENDING),
+          ('timestamp_creation', pymongo.ASCENDING)], {}),
+        # pending learnuplets whose lease expired
+        ([('status', pymongo.ASCENDING),
+          ('lease_expires', pymongo.ASCENDING)], {}),
+        # counts of learnuplets in metrics.py
+        ([('problem', pymongo.ASCENDING), ('status', pymongo.ASCENDING)], {}),
+        REVISION_INDEX,
+    ],
+    'preduplet': [
+        ([('uuid', pymongo.ASCENDING)], {'unique': True}),
+        # queue of preduplets to be claimed by workers
+        ([('status', pymongo.ASCENDING),
+          ('timestamp_request', pymongo.ASCENDING)], {}),
+        # pending preduplets whose lease expired
+        ([('status', pymongo.ASCENDING),
+          ('lease_expires', pymongo.ASCENDING)], {}),
+        # counts of preduplets in metrics.py
+        ([('problem', pymongo.ASCENDING), ('status', pymongo.ASCENDING)], {}),
+        REVISION_INDEX,
+    ],
+    'leaderboard': [
+        ([('problem', pymongo.ASCENDING), ('algo', pymongo.ASCENDING)],
+         {'unique': True}),
+        ([('problem', pymongo.ASCENDING), ('best.perf', pymongo.DESCENDING)],
+         {}),
+    ],
+    'dispatch': [
+        ([('status', pymongo.ASCENDING),
+          ('next_attempt', pymongo.ASCENDING)], {}),
+    ],
+}
+
+
+def index_name(keys):
+    """
+    Name given by MongoDB to an index built on keys
+
+    :param keys: list of (field, direction) tuples
+    :type keys: list
+    :return: index name, e.g. *algo_1_rank_1*
+    :rtype: string
+    """
+    return '_'.join('%s_%s' % (field, direction) for field, direction in keys)
+
+
+def ensure_indexes(db):
+    """
+    Build all indexes declared in INDEXES. Creating an index which already
+    exists is a no-op, so it is safe to call it at each start of the app.
+    Indexes are built in background not to lock collections.
+
+    :param db: database in which to create the indexes
+    :type db: pymongo.database.Database
+    :return: names of indexes which could not be built, by collection
+    :rtype: dictionary
+    """
+    failed = {}
+    for collection_name, indexes in INDEXES.items():
+        collection = db[collection_name]
+        for keys, options in indexes:
+            try:
+                collection.create_index(keys, background=True, **options)
+            except OperationFailure as e:
+                # e.g. duplicated uuids prevent building a unique index
+                logger.warning('index %s not built on %s: %s',
+                               index_name(keys), collection_name, e)
+                failed.setdefault(collection_name, []).append(
+                    index_name(keys))
+    return failed
+
+
+def index_report(db):
+    """
+    Compare indexes existing in db with the ones declared in INDEXES
+
+    :param db: database to inspect
+    :type db: pymongo.database.Database
+    :return: for each collection, *missing* declared indexes, *unused*
+        indexes (no access since the start of mongod) and *undeclared*
+        indexes
+    :rtype: dictionary
+    """
+    report = {}
+    for collection_name, indexes in INDEXES.items():
+        collection = db[collection_name]
+        existing = set(collection.index_information()) - {'_id_'}
+        declared = {index_name(keys) for keys, _ in indexes}
+        try:
+            stats = collection.aggregate([{'$indexStats': {}}])
+            unused = sorted(s['name'] for s in stats
+                            if s['name'] != '_id_' and
+                            s['accesses']['ops'] == 0)
+        except OperationFailure:
+            # $indexStats requires MongoDB >= 3.2
+            unused = []
+        report[collection_name] = {
+            'missing': sorted(declared - existing),
+            'unused': unused,
+            'undeclared': sorted(existing - declared)}
+    return report
+
+
+if __name__ == '__main__':
+    import json
+    from api import app, mongo
+    with app.app_context():
+        print(json.dumps(index_report(mongo.db), indent=2))
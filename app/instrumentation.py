@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+import collections
+import logging
+import os
+import queue
+import threading
+from bson import SON, json_util
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Commands slower than this duration (in milliseconds) are logged, with
+# their filter and a summary of their query plan (0 to disable)
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+# A warning is logged for requests sending more commands than this budget
+# to MongoDB (0 to disable)
+MONGO_QUERY_BUDGET = int(os.environ.get('MONGO_QUERY_BUDGET', 50))
+# Maximum length of the filters written in the log
+MAX_FILTER_LENGTH = 500
+# Maximum number of slow commands waiting to be explained, further ones are
+# logged without their plan
+EXPLAIN_QUEUE_SIZE = 100
+# Commands which can be explained, with the fields holding their filter
+EXPLAINABLE_COMMANDS = {
+    'find': 'filter',
+    'count': 'query',
+    'distinct': 'query',
+    'findAndModify': 'query',
+    'aggregate': 'pipeline',
+    'update': 'updates',
+    'delete': 'deletes',
+}
+
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Count commands sent to MongoDB by the current thread, by command name
+    (one command is one round-trip), and the time spent in them
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @property
+    def commands(self):
+        if not hasattr(self._local, 'commands'):
+            self._local.commands = collections.Counter()
+        return self._local.commands
+
+    @property
+    def duration(self):
+        """Time (in seconds) spent in commands since the last reset"""
+        return getattr(self._local, 'duration', 0.)
+
+    def reset(self):
+        self.commands.clear()
+        self._local.duration = 0.
+
+    def total(self):
+        return sum(self.commands.values())
+
+    def started(self, event):
+        self.commands[event.command_name] += 1
+
+    def succeeded(self, event):
+        self._local.duration = self.duration + event.duration_micros / 1e6
+
+    def failed(self, event):
+        self._local.duration = self.duration + event.duration_micros / 1e6
+
+
+def command_filter(command_name, command):
+    """
+    Filter (or pipeline) of a command, as written in the log
+
+    :param command_name: name of the command, e.g. find
+    :param command: command document sent to MongoDB
+    :type command_name: string
+    :type command: dictionary
+    :return: truncated extended JSON of the filter
+    :rtype: string
+    """
+    query = command.get(EXPLAINABLE_COMMANDS.get(command_name, 'filter'))
+    if command_name in ['update', 'delete'] and query:
+        query = [statement.get('q') for statement in query]
+    filter_json = json_util.dumps(query)
+    if len(filter_json) > MAX_FILTER_LENGTH:
+        filter_json = filter_json[:MAX_FILTER_LENGTH] + '...'
+    return filter_json
+
+
+def plan_summary(explanation):
+    """
+    Summary of the winning plan of an explain output, e.g.
+    *LIMIT > FETCH > IXSCAN status_1_timestamp_creation_1*, or *COLLSCAN*
+    if no index is used
+
+    :param explanation: output of the explain command
+    :type explanation: dictionary
+    :rtype: string
+    """
+    def find_plan(d):
+        if isinstance(d, dict):
+            if 'winningPlan' in d:
+                return d['winningPlan']
+            values = d.values()
+        elif isinstance(d, list):
+            values = d
+        else:
+            return None
+        for v in values:
+            plan = find_plan(v)
+            if plan:
+                return plan
+        return None
+
+    stages = []
+    stage = find_plan(explanation)
+    while stage:
+        name = stage.get('stage', '?')
+        if 'indexName' in stage:
+            name = '%s %s' % (name, stage['indexName'])
+        stages.append(name)
+        children = stage.get('inputStages') or [stage.get('inputStage')]
+        if len(children) > 1:
+            stages.append('(%s)' % ', '.join(
+                plan_summary({'winningPlan': child}) for child in children))
+            break
+        stage = children[0]
+    return ' > '.join(stages) or 'unknown'
+
+
+class Explainer(threading.Thread):
+    """
+    Background thread explaining the slow commands of requests, and logging
+    them with a summary of their query plan (see SlowCommandLog)
+    """
+
+    def __init__(self, slow_command_log, queue_size=EXPLAIN_QUEUE_SIZE):
+        super(Explainer, self).__init__(name='explainer', daemon=True)
+        self.slow_command_log = slow_command_log
+        self.queue = queue.Queue(queue_size)
+
+    def submit(self, client, request, command_name, database_name, command,
+               duration_ms):
+        """
+        Queue a slow command to be explained and logged
+
+        :return: False if the queue is full
+        :rtype: boolean
+        """
+        try:
+            self.queue.put_nowait((client, request, command_name,
+                                   database_name, command, duration_ms))
+        except queue.Full:
+            return False
+        return True
+
+    def run(self):
+        while True:
+            client, request, command_name, database_name, command, \
+                duration_ms = self.queue.get()
+            try:
+                plan = self.slow_command_log.explain(
+                    client, database_name, command_name, command)
+                self.slow_command_log.log(request, command_name, command,
+                                          duration_ms, plan)
+            finally:
+                self.queue.task_done()
+
+
+class SlowCommandLog(monitoring.CommandListener):
+    """
+    Log commands slower than a threshold, with the request which sent them.
+    Commands of a request are logged after it, with a summary of their query
+    plan found with the explain command by an Explainer thread, so that
+    explaining them does not delay the request. Commands sent outside of
+    requests (e.g. by background threads) are logged right away, without
+    their plan.
+    """
+
+    def __init__(self, threshold_ms=SLOW_QUERY_MS):
+        self.threshold_ms = threshold_ms
+        self._local = threading.local()
+        # started at the first slow request of the process, so that it runs
+        # in gunicorn workers and not in the master before fork
+        self.explainer = None
+
+    @property
+    def _state(self):
+        if not hasattr(self._local, 'started'):
+            self._local.request = None
+            self._local.started = {}
+            self._local.slow_commands = []
+            # slow commands are logged at the end of the request
+            self._local.deferred = False
+            self._local.explaining = False
+        return self._local
+
+    @property
+    def request(self):
+        """
+        Description of the current (or last) request of the thread, None
+        for background threads
+        """
+        return self._state.request
+
+    def start_request(self, request):
+        """
+        :param request: description of the request, e.g. *GET /problem*
+        :type request: string
+        """
+        state = self._state
+        state.request = request
+        state.deferred = True
+        state.started.clear()
+        del state.slow_commands[:]
+
+    def started(self, event):
+        if self.threshold_ms <= 0 or self._state.explaining:
+            return
+        self._state.started[(event.connection_id, event.request_id)] = (
+            event.database_name, event.command)
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        state = self._state
+        started = state.started.pop((event.connection_id, event.request_id),
+                                    None)
+        duration_ms = event.duration_micros / 1000.
+        if started is None or duration_ms < self.threshold_ms:
+            return
+        database_name, command = started
+        if state.deferred:
+            state.slow_commands.append((event.command_name, database_name,
+                                        command, duration_ms))
+        else:
+            # background thread, or streamed response
+            self.log(state.request, event.command_name, command,
+                     duration_ms)
+
+    def log(self, request, command_name, command, duration_ms, plan=None):
+        logger.warning('slow MongoDB command %s on %s (%.1f ms) sent by %s, '
+                       'filter %s, plan %s', command_name,
+                       command.get(command_name), duration_ms,
+                       request or 'background thread',
+                       command_filter(command_name, command),
+                       plan or 'not explained')
+
+    def explain(self, client, database_name, command_name, command):
+        """
+        :return: summary of the query plan of a command, None if it cannot
+            be explained
+        :rtype: string
+        """
+        if command_name not in EXPLAINABLE_COMMANDS:
+            return None
+        # remove fields added by the driver
+        command = SON((k, v) for k, v in command.items()
+                      if not k.startswith('$') and k != 'lsid')
+        state = self._state
+        state.explaining = True
+        try:
+            return plan_summary(client[database_name].command(
+                SON([('explain', command), ('verbosity', 'queryPlanner')])))
+        except PyMongoError as e:
+            return 'not explained (%s)' % e
+        finally:
+            state.explaining = False
+
+    def end_request(self, client=None):
+        """
+        Log the slow commands of the current request. Commands to be
+        explained are queued to the Explainer thread, which logs them.
+
+        :param client: MongoDB client used to explain the commands, they are
+            logged right away without their plan if None
+        :type client: pymongo.MongoClient
+        """
+        state = self._state
+        if client is not None and state.slow_commands and \
+                (not self.explainer or not self.explainer.is_alive()):
+            self.explainer = Explainer(self)
+            self.explainer.start()
+        for command_name, database_name, command, duration_ms in \
+                state.slow_commands:
+            if client is None or not self.explainer.submit(
+                    client, state.request, command_name, database_name,
+                    command, duration_ms):
+                self.log(state.request, command_name, command, duration_ms)
+        del state.slow_commands[:]
+        state.deferred = False
+
+
+# Have to be registered before the creation of the MongoDB client
+command_counter = CommandCounter()
+monitoring.register(command_counter)
+slow_command_log = SlowCommandLog()
+monitoring.register(slow_command_log)
+
+
+def start_request(request):
+    """
+    Attribute the next commands of the current thread to a request
+
+    :param request: description of the request, e.g. *GET /problem*
+    :type request: string
+    """
+    command_counter.reset()
+    slow_command_log.start_request(request)
+
+
+def end_request(client=None):
+    """
+    Log the slow commands of the current request, and a warning if it sent
+    more commands than MONGO_QUERY_BUDGET
+
+    :param client: MongoDB client used to explain slow commands
+    :type client: pymongo.MongoClient
+    :return: number of commands sent by the request, and time spent in them
+        (in seconds)
+    :rtype: tuple
+    """
+    n = command_counter.total()
+    duration = command_counter.duration
+    if MONGO_QUERY_BUDGET and n > MONGO_QUERY_BUDGET:
+        logger.warning('%s sent %s commands to MongoDB (budget %s): %s',
+                       slow_command_log.request, n,
+                       MONGO_QUERY_BUDGET, dict(command_counter.commands))
+    slow_command_log.end_request(client)
+    return n, duration
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+import pymongo
+from bson.son import SON
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# Collection with the best model of each algo, for each problem
+LEADERBOARD_COLLECTION = 'leaderboard'
+# Order of leaderboard entries, and of learnuplets, best first
+BEST_ORDER = [('best.perf', pymongo.DESCENDING)]
+PERF_ORDER = [('perf', pymongo.DESCENDING)]
+
+
+def best_entry(learnuplet):
+    """
+    Model of a learnuplet as recorded in the leaderboard, with *perf* first
+    so that entries are compared on it
+
+    :rtype: bson.son.SON
+    """
+    return SON([('perf', learnuplet['perf']),
+                ('model_end', learnuplet['model_end']),
+                ('learnuplet', learnuplet['uuid'])])
+
+
+def record_update(learnuplet):
+    """
+    Query and update of the leaderboard entry of the algo of a learnuplet
+    (see record)
+
+    :rtype: tuple
+    """
+    return ({'problem': learnuplet['problem'], 'algo': learnuplet['algo']},
+            {'$max': {'best': best_entry(learnuplet)}})
+
+
+def best_queries(problem_uuid, algo_uuid=None):
+    """
+    Queries of the leaderboard entries, and of the learnuplets with a perf,
+    of a problem or of an algo (see best_model)
+
+    :rtype: tuple
+    """
+    query = {'problem': problem_uuid}
+    if algo_uuid:
+        query['algo'] = algo_uuid
+    return query, dict(query, perf={'$ne': None})
+
+
+def top_entry(entry):
+    """Model of a leaderboard entry, with its algo (see top)"""
+    return dict(entry['best'], algo=entry['algo'])
+
+
+def record(db, learnuplet):
+    """
+    Register the performance of a learnuplet in the leaderboard, if it is
+    the best one of its algo.
+    The best model is kept with $max on the *best* sub-document, which is
+    compared on *perf* first, so the update is atomic. Learnuplets trained
+    before the leaderboard existed are recorded at startup (see rebuild).
+
+    :param db: database of the orchestrator
+    :param learnuplet: learnuplet with a perf
+    :type db: pymongo.database.Database
+    :type learnuplet: dictionary
+    :return: leaderboard entry of the algo after the update
+    :rtype: dictionary
+    """
+    query, update = record_update(learnuplet)
+    try:
+        return db[LEADERBOARD_COLLECTION].find_one_and_update(
+            query, update, upsert=True, return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        # entry concurrently created by another request, update it
+        return db[LEADERBOARD_COLLECTION].find_one_and_update(
+            query, update, return_document=ReturnDocument.AFTER)
+
+
+def best_model(db, problem_uuid, algo_uuid=None):
+    """
+    Best model of a problem, or of an algo if algo_uuid is given.
+    Problems whose learnuplets were trained before the leaderboard existed
+    are added to it at their first lookup (see also rebuild).
+
+    :param db: database of the orchestrator
+    :param problem_uuid: UUID of the problem
+    :param algo_uuid: UUID of the algo
+    :return: *perf*, *model_end* and *learnuplet* UUID of the best model,
+        None if no model has been trained
+    :rtype: dictionary
+    """
+    query, learnuplet_query = best_queries(problem_uuid, algo_uuid)
+    entry = db[LEADERBOARD_COLLECTION].find_one(query, sort=BEST_ORDER)
+    if entry:
+        return entry['best']
+    learnuplet = db.learnuplet.find_one(learnuplet_query, sort=PERF_ORDER)
+    if learnuplet:
+        return record(db, learnuplet)['best']
+    return None
+
+
+def top(db, problem_uuid, k):
+    """
+    k best models of a problem (the best one of each algo)
+
+    :param db: database of the orchestrator
+    :param problem_uuid: UUID of the problem
+    :param k: number of models
+    :type k: integer
+    :return: list of *algo*, *perf*, *model_end* and *learnuplet*, by
+        decreasing perf
+    :rtype: list
+    """
+    entries = db[LEADERBOARD_COLLECTION].find(
+        {'problem': problem_uuid}, sort=BEST_ORDER, limit=k)
+    return [top_entry(entry) for entry in entries]
+
+
+def rebuild(db):
+    """
+    Record in the leaderboard the best learnuplet of each algo, e.g. for
+    learnuplets trained before the leaderboard existed
+
+    :param db: database of the orchestrator
+    :type db: pymongo.database.Database
+    :return: number of algos in the leaderboard
+    :rtype: integer
+    """
+    best_learnuplets = db.learnuplet.aggregate([
+        {'$match': {'perf': {'$ne': None}}},
+        {'$sort': {'algo': 1, 'perf': -1}},
+        {'$group': {'_id': '$algo',
+                    'problem': {'$first': '$problem'},
+                    'algo': {'$first': '$algo'},
+                    'perf': {'$first': '$perf'},
+                    'model_end': {'$first': '$model_end'},
+                    'uuid': {'$first': '$uuid'}}}])
+    for learnuplet in best_learnuplets:
+        record(db, learnuplet)
+    return db[LEADERBOARD_COLLECTION].count_documents({})
+
+
+if __name__ == '__main__':
+    from api import app, mongo
+    with app.app_context():
+        print('%s algos in leaderboard' % rebuild(mongo.db))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+import logging
+import os
+import threading
+import time
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+import cache
+import dispatch
+import revisions
+
+logger = logging.getLogger(__name__)
+
+# Duration (in seconds) of the lease of a worker on a pending uplet
+LEASE_DURATION = float(os.environ.get('LEASE_DURATION', 60))
+# Delay (in seconds) between two searches of expired leases
+SWEEP_INTERVAL = float(os.environ.get('SWEEP_INTERVAL', 10))
+# Collections of uplets processed by workers, with their Compute url prefix
+UPLET_PREFIXES = {'learnuplet': 'learn', 'preduplet': 'pred'}
+
+
+def lease_expiry():
+    """Expiry time of a lease taken now"""
+    return time.time() + LEASE_DURATION
+
+
+def extension(worker, uplet_uuids=None):
+    """
+    Query and update extending the leases of a worker (see extend)
+
+    :return: new expiry time, query and update
+    :rtype: tuple
+    """
+    query = {'worker': worker, 'status': 'pending'}
+    if uplet_uuids is not None:
+        query['uuid'] = {'$in': uplet_uuids}
+    expiry = lease_expiry()
+    return expiry, query, revisions.stamped(
+        {'$set': {'lease_expires': expiry}})
+
+
+def heartbeat_output(expiry, extended):
+    """
+    Response to a heartbeat: new expiry time, and number of extended leases
+    by collection (see extend)
+
+    :rtype: dictionary
+    """
+    output = {'%ss' % uplet_type: n for uplet_type, n in extended.items()}
+    output['lease_expires'] = expiry
+    return output
+
+
+def expiration(now):
+    """
+    Query and update putting back to todo an uplet whose lease expired
+    before now (see reclaim_expired)
+
+    :type now: float
+    :rtype: tuple
+    """
+    return ({'status': 'pending', 'lease_expires': {'$lt': now}},
+            revisions.stamped({'$set': {'status': 'todo', 'worker': None},
+                               '$unset': {'lease_expires': ''}}))
+
+
+def extend(db, worker, uplet_uuids=None):
+    """
+    Extend the leases of a worker on its pending uplets
+
+    :param db: database of the orchestrator
+    :param worker: worker UUID
+    :param uplet_uuids: UUIDs of the uplets to extend, all pending uplets of
+        the worker if None
+    :type db: pymongo.database.Database
+    :type worker: UUID
+    :type uplet_uuids: list
+    :return: new expiry time and number of extended leases, by collection
+    :rtype: tuple
+    """
+    expiry, query, update = extension(worker, uplet_uuids)
+    extended = {uplet_type: db[uplet_type].update_many(query, update)
+                .matched_count for uplet_type in UPLET_PREFIXES}
+    return expiry, extended
+
+
+def reclaim_expired(db, compute_url=None):
+    """
+    Put back to todo the pending uplets whose lease has expired (e.g. their
+    worker died), and push them again to Compute if compute_url is given
+
+    :param db: database of the orchestrator
+    :param compute_url: Compute url
+    :type db: pymongo.database.Database
+    :type compute_url: url
+    :return: number of reclaimed uplets
+    :rtype: integer
+    """
+    n = 0
+    query, update = expiration(time.time())
+    for uplet_type, uplet_prefix in UPLET_PREFIXES.items():
+        while True:
+            uplet = db[uplet_type].find_one_and_update(
+                query, update, return_document=ReturnDocument.AFTER)
+            if not uplet:
+                break
+            logger.warning('lease of worker on %s %s expired', uplet_type,
+                           uplet['uuid'])
+            if compute_url:
+                dispatch.enqueue(db, [uplet], compute_url, uplet_prefix)
+            n += 1
+            cache.response_cache.invalidate(uplet_type)
+    return n
+
+
+class Sweeper(threading.Thread):
+    """
+    Background thread reclaiming uplets whose lease has expired
+    """
+
+    def __init__(self, db, compute_url=None, interval=SWEEP_INTERVAL):
+        super(Sweeper, self).__init__(name='sweeper', daemon=True)
+        self.db = db
+        self.compute_url = compute_url
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                reclaim_expired(self.db, self.compute_url)
+            except PyMongoError as e:
+                logger.warning('expired leases not reclaimed: %s', e)
+            except Exception:
+                logger.exception('expired leases not reclaimed')
+
+    def stop(self):
+        self._stopped.set()
+
+
+_sweeper = None
+
+
+def start(db, compute_url=None, **kwargs):
+    """
+    Start the Sweeper of the process, if not already started
+
+    :param db: database of the orchestrator
+    :param compute_url: Compute url to which reclaimed uplets are pushed
+    :type db: pymongo.database.Database
+    :type compute_url: url
+    :return: the running sweeper
+    :rtype: Sweeper
+    """
+    global _sweeper
+    if not _sweeper or not _sweeper.is_alive():
+        _sweeper = Sweeper(db, compute_url, **kwargs)
+        _sweeper.start()
+    return _sweeper
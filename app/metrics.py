@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+import os
+import threading
+import time
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+from pymongo import monitoring
+
+# Directory shared by gunicorn workers to aggregate their metrics. It has to
+# be set (and emptied) before the start of the workers
+MULTIPROC_DIR = os.environ.get('prometheus_multiproc_dir')
+# Time (in seconds) during which counts of uplets are reused between scrapes
+UPLET_COUNTS_TTL = float(os.environ.get('UPLET_COUNTS_TTL', 30))
+
+REQUESTS = Counter('orchestrator_requests_total',
+                   'Requests handled, by route and status',
+                   ['method', 'route', 'status'])
+REQUEST_DURATION = Histogram('orchestrator_request_duration_seconds',
+                             'Time to handle a request, by route',
+                             ['method', 'route'])
+MONGO_COMMANDS = Counter('orchestrator_mongo_commands_total',
+                         'Commands sent to MongoDB, by command and result',
+                         ['command', 'result'])
+MONGO_DURATION = Histogram('orchestrator_mongo_command_duration_seconds',
+                           'Duration of MongoDB commands, by command',
+                           ['command'])
+DISPATCH_POSTS = Counter('orchestrator_dispatch_posts_total',
+                         'Posts of uplets to Compute, by result (posted, '
+                         'error to be retried, rejected or failed after all '
+                         'attempts)', ['result'])
+DISPATCH_DURATION = Histogram('orchestrator_dispatch_post_duration_seconds',
+                              'Duration of posts of uplets to Compute')
+DISPATCH_DELAY = Histogram('orchestrator_dispatch_delay_seconds',
+                           'Time between the creation of an uplet and its '
+                           'post to Compute',
+                           buckets=(.1, .5, 1, 5, 10, 30, 60, 300, 900,
+                                    float('inf')))
+DOCUMENT_CACHE_LOOKUPS = Counter('orchestrator_document_cache_lookups_total',
+                                 'Lookups of documents in the caches of '
+                                 'documents by UUID, by collection and '
+                                 'result (hit or miss)',
+                                 ['collection', 'result'])
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+    Count MongoDB commands and observe their duration
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMANDS.labels(event.command_name, 'succeeded').inc()
+        MONGO_DURATION.labels(event.command_name).observe(
+            event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_COMMANDS.labels(event.command_name, 'failed').inc()
+        MONGO_DURATION.labels(event.command_name).observe(
+            event.duration_micros / 1e6)
+
+
+# Has to be registered before the creation of the MongoDB client
+monitoring.register(MongoCommandMetrics())
+
+
+def group_counts(collection, fields):
+    """
+    Number of documents of a collection by values of some fields. Documents
+    are sorted on the fields before being grouped, so that the counts are
+    read from an index starting with them (see indexes.py), without
+    reading the documents.
+
+    :param collection: collection to count
+    :param fields: names of the fields
+    :type collection: pymongo.collection.Collection
+    :type fields: list
+    :return: counts by tuple of values (as strings) of the fields
+    :rtype: dictionary
+    """
+    pipeline = [
+        {'$sort': {field: 1 for field in fields}},
+        {'$group': {'_id': {field: '$' + field for field in fields},
+                    'n': {'$sum': 1}}}]
+    return {tuple(str(group['_id'].get(field)) for field in fields):
+            group['n'] for group in collection.aggregate(pipeline)}
+
+
+class UpletCollector(object):
+    """
+    Gauges of the number of uplets by problem and status, and of the
+    dispatch queue by status, read from the db at scrape time (so that they
+    do not depend on the worker which handles the scrape)
+    """
+
+    def __init__(self, db, dispatch_collection, ttl=UPLET_COUNTS_TTL):
+        self.db = db
+        self.dispatch_collection = dispatch_collection
+        self.ttl = ttl
+        self._counts = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def counts(self):
+        """
+        :return: counts of uplets by (uplet type, problem, status), and of
+            queued uplets by status
+        :rtype: tuple
+        """
+        with self._lock:
+            if self._counts is None or self._expires <= time.time():
+                uplets = {}
+                for uplet_type in ['learnuplet', 'preduplet']:
+                    for labels, n in group_counts(
+                            self.db[uplet_type],
+                            ['problem', 'status']).items():
+                        uplets[(uplet_type,) + labels] = n
+                queue = {status: n for (status,), n in group_counts(
+                    self.db[self.dispatch_collection], ['status']).items()}
+                self._counts = uplets, queue
+                self._expires = time.time() + self.ttl
+            return self._counts
+
+    def families(self, uplets, queue):
+        uplet_family = GaugeMetricFamily(
+            'orchestrator_uplets', 'Uplets by type, problem and status',
+            labels=['type', 'problem', 'status'])
+        for labels, n in sorted(uplets.items()):
+            uplet_family.add_metric(labels, n)
+        queue_family = GaugeMetricFamily(
+            'orchestrator_dispatch_queue',
+            'Uplets in the queue of posts to Compute, by status',
+            labels=['status'])
+        for status, n in sorted(queue.items()):
+            queue_family.add_metric([status], n)
+        return [uplet_family, queue_family]
+
+    def describe(self):
+        return self.families({}, {})
+
+    def collect(self):
+        return self.families(*self.counts())
+
+
+def registry():
+    """
+    :return: registry of the metrics of all workers if MULTIPROC_DIR is set,
+        of the current process otherwise
+    :rtype: prometheus_client.CollectorRegistry
+    """
+    if not MULTIPROC_DIR:
+        return REGISTRY
+    multiprocess_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(multiprocess_registry)
+    return multiprocess_registry
+
+
+def latest(uplet_collector):
+    """
+    Metrics in the Prometheus text format
+
+    :param uplet_collector: collector of the counts of uplets
+    :type uplet_collector: UpletCollector
+    :return: metrics, and their content type
+    :rtype: tuple
+    """
+    uplet_registry = CollectorRegistry()
+    uplet_registry.register(uplet_collector)
+    return (generate_latest(registry()) + generate_latest(uplet_registry),
+            CONTENT_TYPE_LATEST)
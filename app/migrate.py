@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+import logging
+import os
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+import indexes
+import leaderboard
+import revisions
+from schema import list_collection
+
+logger = logging.getLogger(__name__)
+
+
+def prepare_db(db):
+    """
+    Prepare the db for the app, out of the path of requests: build the
+    indexes declared in indexes.py and log those which are missing, and
+    give a revision to documents written before revisions existed, and
+    record in the leaderboard the models trained before it existed (so
+    that leaderboard.record only needs one update).
+    It is idempotent, and run once at startup by the gunicorn master (see
+    on_starting in gunicorn_config.py), by the asyncio app (see
+    asgi_api.py), by `python api.py`, or with `python migrate.py` before
+    starting the app in another way.
+
+    :param db: database of the orchestrator
+    :type db: pymongo.database.Database
+    """
+    indexes.ensure_indexes(db)
+    for collection_name, report in sorted(indexes.index_report(db).items()):
+        if report['missing']:
+            logger.warning('missing indexes on %s: %s', collection_name,
+                           ', '.join(report['missing']))
+        if report['unused'] or report['undeclared']:
+            logger.info('indexes of %s: unused %s, undeclared %s',
+                        collection_name, report['unused'],
+                        report['undeclared'])
+    n_stamped = revisions.stamp_missing(db, list_collection)
+    if n_stamped:
+        logger.info('%s documents without revision stamped', n_stamped)
+    logger.info('%s algos in leaderboard', leaderboard.rebuild(db))
+
+
+def main():
+    """
+    Prepare the db given by the environment variables of api.py (TESTING
+    and MONGO_HOST), with a client of its own
+    """
+    testing = os.environ.get('TESTING', "F")
+    db_name = 'test_orchestrator' if testing == "T" else 'orchestrator'
+    client = MongoClient(os.environ.get('MONGO_HOST', "localhost"))
+    try:
+        prepare_db(client[db_name])
+    except PyMongoError as e:
+        # e.g. MongoDB not started yet, the app can start anyway
+        logger.warning('db %s not prepared: %s', db_name, e)
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import binascii
+from bson import json_util
+import serializer
+
+# Fields of documents which are not returned by the API (the revision, see
+# revisions.py, is a BSON timestamp used to list changes)
+PRIVATE_FIELDS = ('_id', 'revision')
+
+
+def encode_cursor(*values):
+    """
+    Build an opaque cursor from values of the last returned document
+
+    :param values: values (e.g. ObjectId) from which to resume the listing
+    :return: url-safe cursor
+    :rtype: string
+    """
+    return urlsafe_b64encode(
+        json_util.dumps(list(values)).encode()).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Get back the values encoded in a cursor by encode_cursor
+
+    :param cursor: cursor given by encode_cursor
+    :type cursor: string
+    :return: list of values
+    :raise ValueError: if the cursor is not valid
+    """
+    try:
+        values = json_util.loads(urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeError, ValueError, TypeError):
+        raise ValueError('invalid cursor %s' % cursor)
+    if not isinstance(values, list):
+        raise ValueError('invalid cursor %s' % cursor)
+    return values
+
+
+def clean_document(d):
+    """
+    Remove private fields (*_id*, *revision*) from a document before
+    returning it
+    """
+    return {k: v for k, v in d.items() if k not in PRIVATE_FIELDS}
+
+
+def page(key, documents, limit=0, paginated=False):
+    """
+    Response listing documents, {key: [documents], "next": cursor} if they
+    are listed by page (see json_stream)
+
+    :param key: key of the list of documents
+    :param documents: documents, sorted by *_id* if paginated
+    :param limit: maximum number of documents in the page (0 for no limit)
+    :param paginated: whether to add the cursor of the next page
+    :type documents: list
+    :rtype: dictionary
+    """
+    output = {key: [clean_document(d) for d in documents]}
+    if paginated:
+        output['next'] = encode_cursor(documents[-1]['_id']) \
+            if limit and len(documents) == limit else None
+    return output
+
+
+def ndjson_line(d):
+    """Line of a document in a newline delimited JSON stream"""
+    return serializer.dumps(clean_document(d)) + b'\n'
+
+
+def ndjson_stream(documents):
+    """
+    Generate documents one per line (newline delimited JSON), without keeping
+    them in memory
+
+    :param documents: iterable of documents, e.g. a pymongo cursor
+    """
+    for d in documents:
+        yield ndjson_line(d)
+
+
+class JSONStream(object):
+    """
+    Chunks of the JSON object {key: [documents], "next": cursor}, produced
+    document by document (see json_stream)
+    """
+
+    def __init__(self, key, limit=0):
+        self.key = key
+        self.limit = limit
+        self.n = 0
+        self.last_id = None
+
+    def start(self):
+        return b'{' + serializer.dumps(self.key) + b':['
+
+    def document(self, d):
+        chunk = (b',' if self.n else b'') + serializer.dumps(clean_document(d))
+        self.last_id = d['_id']
+        self.n += 1
+        return chunk
+
+    def end(self):
+        next_cursor = encode_cursor(self.last_id) \
+            if self.limit and self.n == self.limit else None
+        return b'],"next":' + serializer.dumps(next_cursor) + b'}'
+
+
+def json_stream(key, documents, limit=0):
+    """
+    Generate the JSON object {key: [documents], "next": cursor} chunk by
+    chunk, without keeping the documents in memory.
+    *next* is the cursor of the next page if limit documents were produced
+    (None otherwise), so it can only be known once all documents are sent.
+
+    :param key: key of the list of documents
+    :param documents: iterable of documents sorted by *_id*
+    :param limit: maximum number of documents in the page (0 for no limit)
+    :type key: string
+    :type limit: integer
+    """
+    stream = JSONStream(key, limit)
+    yield stream.start()
+    for d in documents:
+        yield stream.document(d)
+    yield stream.end()
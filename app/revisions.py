@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+import os
+import time
+from bson import Timestamp
+import pagination
+
+# Field holding the revision of a document, a BSON timestamp set by MongoDB
+# at each write, which increases with each write
+REVISION_FIELD = 'revision'
+# Default maximum number of changes returned at once
+CHANGES_PAGE_SIZE = int(os.environ.get('CHANGES_PAGE_SIZE', 1000))
+# Delay (in seconds) before changes are returned, so that a write with a
+# lower revision, not yet visible, is not skipped by a client
+CHANGES_LAG = float(os.environ.get('CHANGES_LAG', 1))
+# Order in which changes are listed, on the (revision, _id) index
+CHANGES_ORDER = [(REVISION_FIELD, 1), ('_id', 1)]
+
+
+def stamp(document):
+    """
+    Give a new revision to a document to be inserted. MongoDB replaces an
+    empty timestamp by the current one, before MongoDB 5.0 only in the first
+    two top-level fields, so the revision is put first (after _id, which
+    pymongo always sends first)
+
+    :param document: document to be inserted, modified in place
+    :type document: dictionary
+    :return: the document
+    :rtype: dictionary
+    """
+    fields = [(k, v) for k, v in document.items() if k != REVISION_FIELD]
+    document.clear()
+    document[REVISION_FIELD] = Timestamp(0, 0)
+    document.update(fields)
+    return document
+
+
+def stamped(update):
+    """
+    Add to an update (or upsert) the change of the revision of the updated
+    documents
+
+    :param update: update operators, e.g. {'$set': {'status': 'done'}}
+    :type update: dictionary
+    :return: new update operators
+    :rtype: dictionary
+    """
+    current_date = dict(update.get('$currentDate', {}))
+    current_date[REVISION_FIELD] = {'$type': 'timestamp'}
+    return dict(update, **{'$currentDate': current_date})
+
+
+def stamp_missing(db, collection_names):
+    """
+    Give a revision to documents written before revisions were introduced
+
+    :param db: database of the orchestrator
+    :param collection_names: collections to update
+    :type db: pymongo.database.Database
+    :type collection_names: list
+    :return: number of updated documents
+    :rtype: integer
+    """
+    return sum(db[collection_name].update_many(
+        {REVISION_FIELD: None}, stamped({})).modified_count
+        for collection_name in collection_names)
+
+
+def changes_params(args):
+    """
+    Parameters of GET /<collection_name>/changes
+
+    :param args: parameters of the request
+    :return: values of the *since* token (None to list all changes), and
+        maximum number of documents
+    :rtype: tuple
+    :raise ValueError: if the token or the limit are not valid
+    """
+    since = args.get('since')
+    limit = int(args.get('limit', CHANGES_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError('limit should be positive')
+    return (pagination.decode_cursor(since) if since else None), limit
+
+
+def changes_page(collection_name, documents, next_token, since=None):
+    """
+    Response listing changes of a collection, with the token of the next
+    changes (since if there is no new change)
+
+    :rtype: dictionary
+    """
+    return {'%ss' % collection_name: [pagination.clean_document(d)
+                                      for d in documents],
+            'next': next_token or since}
+
+
+def changes_query(since=None, projection=None, lag=CHANGES_LAG):
+    """
+    Query and projection of the documents modified after a token, to be
+    sorted by CHANGES_ORDER (see changes)
+
+    :rtype: tuple
+    :raise ValueError: if the token is not valid
+    """
+    query = {}
+    if since is not None:
+        try:
+            revision, last_id = since
+        except (TypeError, ValueError):
+            raise ValueError('invalid token %s' % since)
+        if not isinstance(revision, Timestamp):
+            raise ValueError('invalid token %s' % since)
+        query['$or'] = [{REVISION_FIELD: {'$gt': revision}},
+                        {REVISION_FIELD: revision, '_id': {'$gt': last_id}}]
+    if lag > 0:
+        query[REVISION_FIELD] = {'$lt': Timestamp(int(time.time() - lag), 0)}
+    if projection:
+        projection = dict(projection, **{REVISION_FIELD: 1})
+    return query, projection
+
+
+def changes_token(documents):
+    """
+    Token of the last of the documents returned by changes, None if there is
+    no document
+    """
+    if not documents:
+        return None
+    return pagination.encode_cursor(
+        documents[-1][REVISION_FIELD], documents[-1]['_id'])
+
+
+def changes(collection, since=None, limit=CHANGES_PAGE_SIZE,
+            projection=None, lag=CHANGES_LAG):
+    """
+    Get documents modified after a token, by increasing revision, using the
+    (revision, _id) index
+
+    :param collection: collection of the documents
+    :param since: values of the token given by the previous call (decoded
+        with pagination.decode_cursor), None to get all documents
+    :param limit: maximum number of documents to return
+    :param projection: fields to return, all if None
+    :param lag: only documents modified more than lag seconds ago are
+        returned
+    :type collection: pymongo.collection.Collection
+    :type since: list
+    :type limit: integer
+    :type projection: dictionary
+    :type lag: float
+    :return: documents, and token of the last one (None if there is no
+        document)
+    :rtype: tuple
+    :raise ValueError: if the token is not valid
+    """
+    query, projection = changes_query(since, projection, lag)
+    documents = list(collection.find(query, projection)
+                     .sort(CHANGES_ORDER).limit(limit))
+    return documents, changes_token(documents)
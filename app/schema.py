@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+
+ Collections of the orchestrator and fields of their documents, and the
+ documents, queries and updates built from the requests, shared by the Flask
+ (api.py) and asyncio (asgi_api.py) implementations of the API
+'''
+
+from collections import OrderedDict
+import time
+import pagination
+import revisions
+
+# Document fields to be added
+# data: uuid can be one element or a list, in this case all element have same
+# problems
+post_document = {
+    'problem': ['uuid', 'workflow', 'test_dataset', 'size_train_dataset'],
+    'algo': ['uuid', 'problem', 'name'],
+    'data': ['uuid', 'problems'],
+}
+# Existing collections
+list_collection = list(post_document.keys()) + ['learnuplet', 'preduplet']
+# Requirements for other post requests
+post_request = {'prediction': ['data', 'problem']}
+# Uplets which can be claimed by workers, and order in which they are claimed
+claim_queries = {
+    'learnuplet': {'status': 'todo', 'model_start': {'$ne': None}},
+    'preduplet': {'status': 'todo'},
+}
+claim_order = {
+    'learnuplet': [('timestamp_creation', 1)],
+    'preduplet': [('timestamp_request', 1)],
+}
+# Maximum number of uplets claimed in one request
+max_claim = 100
+# Query parameters of GET requests which are not filters on documents
+reserved_args = ['limit', 'after', 'stream', 'fields']
+# Projection removing the private fields of documents
+private_projection = {field: False for field in pagination.PRIVATE_FIELDS}
+
+
+def fields_projection(fields):
+    """
+    Mongo projection of the fields requested with the *fields* parameter
+
+    :param fields: comma separated field names
+    :type fields: string
+    :return: projection, None to get all fields
+    :rtype: dictionary
+    """
+    if not fields:
+        return None
+    return {f: 1 for f in fields.split(',') if f}
+
+
+def positive_int(value):
+    """
+    :param value: parameter of a request
+    :rtype: integer
+    :raise ValueError: if value is not a positive integer
+    """
+    value = int(value)
+    if value < 1:
+        raise ValueError('%s is not positive' % value)
+    return value
+
+
+def list_query(args):
+    """
+    Filter of the documents listed by GET /<collection_name>
+
+    :param args: parameters of the request (first value of each)
+    :type args: dictionary
+    :return: filter, maximum number of documents (0 for no limit), and
+        whether the documents are listed by page (sorted by *_id*)
+    :rtype: tuple
+    :raise ValueError: if the pagination parameters are not valid
+    """
+    query = {k: v for k, v in args.items() if k not in reserved_args}
+    limit = int(args.get('limit', 0))
+    if limit < 0:
+        raise ValueError('negative limit')
+    if 'after' in args:
+        after_id, = pagination.decode_cursor(args['after'])
+        query['_id'] = {'$gt': after_id}
+    return query, limit, bool(limit or 'after' in args)
+
+
+def build_document(collection_name, request_data, timestamp=None):
+    """
+    Document to be inserted in a collection from posted data
+
+    :param collection_name: problem or algo
+    :param request_data: posted document
+    :type collection_name: string
+    :type request_data: dictionary
+    :rtype: dictionary
+    :raise KeyError: if a field is missing
+    :raise TypeError: if request_data is not a dictionary
+    """
+    new_doc = {k: request_data[k] for k in post_document[collection_name]}
+    new_doc['timestamp_upload'] = timestamp or int(time.time())
+    return revisions.stamp(new_doc)
+
+
+def build_documents(collection_name, list_data, related_problems=None):
+    """
+    Documents to be inserted in a collection from a list of posted data.
+    Invalid ones are reported with their index in list_data.
+
+    :param collection_name: problem or algo
+    :param list_data: posted documents
+    :param related_problems: UUIDs of existing problems, if documents have a
+        *problem* field
+    :type collection_name: string
+    :type list_data: list
+    :type related_problems: set
+    :return: documents, their index in list_data, and errors
+    :rtype: tuple
+    """
+    timestamp = int(time.time())
+    new_docs = []
+    indices = []
+    errors = []
+    for i, request_data in enumerate(list_data):
+        try:
+            new_doc = build_document(collection_name, request_data,
+                                     timestamp)
+        except (KeyError, TypeError):
+            errors.append({'index': i, 'Error': 'wrong key in posted data'})
+            continue
+        if related_problems is not None and \
+                (not isinstance(new_doc['problem'], str) or
+                 new_doc['problem'] not in related_problems):
+            errors.append({'index': i,
+                           'Error': 'non-existing related problem'})
+            continue
+        new_docs.append(new_doc)
+        indices.append(i)
+    return new_docs, indices, errors
+
+
+def related_problems(list_data):
+    """UUIDs of the problems of posted algos"""
+    return list({d['problem'] for d in list_data
+                 if isinstance(d, dict) and isinstance(d.get('problem'), str)})
+
+
+def duplicates(error):
+    """
+    Indexes of the documents of an unordered insert_many which already
+    exist (duplicate key on the unique uuid index)
+
+    :type error: pymongo.errors.BulkWriteError
+    :rtype: set
+    :raise BulkWriteError: error, if other documents were not inserted
+    """
+    if any(write_error['code'] != 11000
+           for write_error in error.details['writeErrors']):
+        raise error
+    return {write_error['index']
+            for write_error in error.details['writeErrors']}
+
+
+def inserted_documents(collection_name, new_docs, indices, errors, failed):
+    """
+    Inserted documents, and errors of the documents which already exist
+
+    :param new_docs: documents built by build_documents
+    :param indices: their index in the posted list
+    :param errors: errors of the posted documents which were not valid
+    :param failed: indexes in new_docs of the existing documents
+    :rtype: tuple
+    """
+    errors = errors + [{'index': indices[j],
+                        'Error': '%s %s already exists' %
+                        (collection_name, new_docs[j]['uuid'])}
+                       for j in failed]
+    errors.sort(key=lambda error: error['index'])
+    return [pagination.clean_document(new_doc)
+            for j, new_doc in enumerate(new_docs) if j not in failed], errors
+
+
+def build_data(request_data):
+    """
+    Data to be inserted from posted data, with one or several UUIDs
+
+    :param request_data: posted data (*uuid* and *problems*)
+    :type request_data: dictionary
+    :return: UUIDs of the problems of the data, and documents to be inserted
+    :rtype: tuple
+    :raise KeyError: if a field is missing
+    """
+    timestamp = int(time.time())
+    if type(request_data['problems']) is not list:
+        list_problems = [request_data['problems']]
+    else:
+        list_problems = request_data['problems']
+    if type(request_data["uuid"]) is not list:
+        list_uuids = [request_data["uuid"]]
+    else:
+        # remove duplicated uuids, keeping their order
+        list_uuids = list(OrderedDict.fromkeys(request_data["uuid"]))
+    new_docs = []
+    for uuid in list_uuids:
+        new_doc = {k: request_data[k] for k in
+                   post_document['data'] if k != "uuid"}
+        new_doc['uuid'] = uuid
+        new_doc['timestamp_upload'] = timestamp
+        new_docs.append(revisions.stamp(new_doc))
+    return list_problems, new_docs
+
+
+def build_prediction(request_data):
+    """
+    Requested preduplet, to be completed by uplets.build_preduplet
+
+    :rtype: dictionary
+    :raise KeyError: if a field is missing
+    :raise ValueError: if *data* is not a single UUID
+    """
+    if not isinstance(request_data['data'], str):
+        raise ValueError('data field should be an UUID')
+    new_preduplet = {k: request_data[k] for k in post_request['prediction']}
+    new_preduplet['timestamp_request'] = int(time.time())
+    return new_preduplet
+
+
+def claim_params(request_data):
+    """
+    :param request_data: posted data of /worker/claim
+    :return: worker, uplet type and number of uplets to claim
+    :rtype: tuple
+    :raise KeyError: if a field is missing
+    :raise ValueError: if *n* is not an integer
+    """
+    return (request_data['worker'], request_data['uplet_type'],
+            int(request_data.get('n', 1)))
+
+
+def valid_claim(uplet_type, n):
+    """Whether uplets of uplet_type can be claimed n at a time"""
+    return uplet_type in claim_queries and 0 < n <= max_claim
+
+
+def assignment(worker):
+    """Update giving a todo uplet to a worker"""
+    return revisions.stamped(
+        {'$set': {'status': 'pending', 'worker': worker}})
+
+
+def heartbeat_params(request_data):
+    """
+    :param request_data: posted data of /worker/heartbeat
+    :return: worker, and UUIDs of its uplets (None for all of them)
+    :rtype: tuple
+    :raise KeyError: if *worker* is missing
+    :raise ValueError: if *uplets* is not a list
+    """
+    worker = request_data['worker']
+    uplet_uuids = request_data.get('uplets')
+    if uplet_uuids is not None and not isinstance(uplet_uuids, list):
+        raise ValueError('uplets field should be a list')
+    return worker, uplet_uuids
+
+
+def learndone(learnuplet_uuid, request_data):
+    """
+    Query and update of a learnuplet with the output of its learning. The
+    query does not match the learnuplet if no field would change.
+
+    :param request_data: posted data of /learndone
+    :return: query, and fields to set
+    :rtype: tuple
+    :raise KeyError: if a field is missing
+    """
+    update = {'status': request_data["status"]}
+    # update perf in current learnuplet if learning has been done
+    if request_data["status"] == 'done':
+        update.update({'perf': request_data["perf"],
+                       'train_perf': request_data["train_perf"],
+                       'test_perf': request_data["test_perf"]})
+    return ({'uuid': learnuplet_uuid,
+             '$or': [{k: {'$ne': v}} for k, v in update.items()]}, update)
+
+
+def updated_perf(previous_learnuplet, update):
+    """Whether learndone changed the performances of a learnuplet"""
+    return any(previous_learnuplet.get(k) != v
+               for k, v in update.items() if k != 'status')
+
+
+def next_model_start(learnuplet, model_start):
+    """
+    Query and update of the learnuplet following a learnuplet in its chain,
+    to be trained from model_start. The query does not match it if it
+    already starts from model_start.
+
+    :rtype: tuple
+    """
+    return ({'rank': learnuplet['rank'] + 1, 'algo': learnuplet['algo'],
+             'model_start': {'$ne': model_start}},
+            revisions.stamped({'$set': {'model_start': model_start}}))
+
+
+def preddone(preduplet_uuid, request_data):
+    """
+    Query and update of a preduplet with the output of its prediction. The
+    query does not match a preduplet already in the posted status.
+
+    :param request_data: posted data of /preddone
+    :rtype: tuple
+    :raise KeyError: if a field is missing
+    """
+    update = {'status': request_data["status"]}
+    # update prediction in current preduplet if it has been done
+    if request_data["status"] == 'done':
+        update.update({'timestamp_done': int(time.time()),
+                       'prediction_storage_uuid':
+                       request_data['prediction_storage_uuid']})
+    return ({'uuid': preduplet_uuid, 'status': {'$ne': update['status']}},
+            revisions.stamped({'$set': update}))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+import json
+import logging
+import os
+from flask import Response
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+logger = logging.getLogger(__name__)
+
+# Encoder of JSON responses: orjson, ujson or json (standard library). By
+# default, the fastest installed one
+JSON_SERIALIZER = os.environ.get('JSON_SERIALIZER')
+
+# Values which are not JSON types (e.g. UUID) are converted as by Flask
+_flask_encoder = JSONEncoder()
+
+
+def json_dumps(obj):
+    """
+    Encode obj in compact JSON with the json module of the standard library
+
+    :return: UTF-8 encoded JSON
+    :rtype: bytes
+    """
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False,
+                      default=_flask_encoder.default).encode('utf-8')
+
+
+def orjson_dumps(obj):
+    """Encode obj in JSON with orjson, as json_dumps"""
+    return orjson.dumps(obj, default=_flask_encoder.default,
+                        option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def ujson_dumps(obj):
+    """Encode obj in JSON with ujson, as json_dumps"""
+    try:
+        return ujson.dumps(obj, ensure_ascii=False,
+                           escape_forward_slashes=False).encode('utf-8')
+    except (TypeError, OverflowError):
+        # types unknown to ujson
+        return json_dumps(obj)
+
+
+# Available serializers
+SERIALIZERS = {'json': json_dumps}
+if ujson:
+    SERIALIZERS['ujson'] = ujson_dumps
+if orjson:
+    SERIALIZERS['orjson'] = orjson_dumps
+
+
+def get_serializer(name=None):
+    """
+    :param name: name of the serializer, the fastest available one if None
+    :type name: string
+    :return: function encoding an object in JSON (bytes)
+    """
+    if not name:
+        for name in ['orjson', 'ujson', 'json']:
+            if name in SERIALIZERS:
+                break
+    elif name not in SERIALIZERS:
+        logger.warning('JSON serializer %s is not available, json is used',
+                       name)
+        name = 'json'
+    return SERIALIZERS[name]
+
+
+dumps = get_serializer(JSON_SERIALIZER)
+
+
+def jsonify(*args, **kwargs):
+    """
+    Replacement of flask.jsonify, encoding the response with dumps (compact,
+    never indented)
+
+    :return: JSON response
+    :rtype: flask.Response
+    """
+    if args and kwargs:
+        raise TypeError('jsonify takes either args or kwargs, not both')
+    if len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+    return Response(dumps(data), mimetype='application/json')
@@ -35,84 +35,65 @@
  knowledge of the CeCILL license and that you accept its terms.
 '''
 
-import time
-import numpy as np
-import uuid
-import requests
-import json
 import api
+import cache
+import dispatch
+import leaderboard
+import pagination
+import revisions
+from uplets import INSERT_CHUNK_SIZE, active_data, algo_learnuplets, \
+    build_learnuplets, build_preduplet, chain_learnuplets, \
+    chain_tails_pipeline, first_learnuplets
+
+
+def insert_learnuplets(list_learnuplets, start_ranks):
+    """
+    Write learnuplets to db with unordered bulk inserts of at most
+    INSERT_CHUNK_SIZE documents, and push to Compute the ones which can be
+    trained right away (i.e. which have a model_start).
+
+    :param list_learnuplets: learnuplets built by build_learnuplets
+    :param start_ranks: first rank of learnuplets for each algo
+    :type list_learnuplets: list
+    :type start_ranks: dictionary
+    :return: number of inserted learnuplets
+    :rtype: integer
+    """
+    for learnuplet in list_learnuplets:
+        revisions.stamp(learnuplet)
+    for i in range(0, len(list_learnuplets), INSERT_CHUNK_SIZE):
+        api.mongo.db.learnuplet.insert_many(
+            list_learnuplets[i: i + INSERT_CHUNK_SIZE], ordered=False)
+    # Remind learnuplet to be be sent to Compute (which has a model_start)
+    worker_url = api.compute_url
+    if worker_url:
+        post_uplet(first_learnuplets(list_learnuplets, start_ranks),
+                   worker_url, 'learn')
+    return len(list_learnuplets)
 
 
 def create_learnuplet(new_data, sz_batch, test_data, problem_uuid,
                       workflow_uuid, algo_uuid, model_uuid_start, start_rank):
     """
     Function used to create learnuplets and push them to Compute
+    Parameters are the ones of build_learnuplets
 
-    :param new_data: list of data UUIDs on which to do the training
-    :param sz_batch: mini-batch size
-    :param test_data: list of test data UUIDs
-    :param problem_uuid: UUID of the problem
-    :param workflow_uuid: UUID of the workflow
-    :param algo_uuid: UUID of the submitted algorithm (before any training)
-    :param model_uuid_start: UUID of model from which to start the training\
-        (equals algo_uuid if start_rank=0)
-    :param start_rank: first rank of newly created learnuplets
-
-    :type new_data: list of UUIDs
-    :type sz_batch: integer
-    :type test_data: list of UUIDs
-    :type problem_uuid: UUID
-    :type workflow_uuid: UUID
-    :type algo_uuid: UUID
-    :type model_uuid_start: UUID
-    :type start_rank: integer
+    :return: list of created learnuplets
+    :rtype: list
     """
-    # returns empty list of algo_uuid different from model_uuid_start and rank=0
-    if start_rank == 0 and model_uuid_start != algo_uuid:
-        return []
-    list_new_learnuplets = []
-    batchs_uuid = [list(np.array(new_data)[i: i + int(sz_batch)])
-                   for i in range(0, len(new_data), int(sz_batch))]
-    # for each batch of data create a learnuplet
-    for i, train_data in enumerate(batchs_uuid):
-        j = i + start_rank
-        # TODO create model_uuid_end function of model_uuid_start...
-        # for now we only generate random UUID....which has to be modified
-        model_uuid_end = str(uuid.uuid4())
-        if j == start_rank:
-            model_start = model_uuid_start
-        else:
-            model_start = None
-        new_learnuplet = {"uuid": str(uuid.uuid4()),
-                          "problem": problem_uuid,
-                          "workflow": workflow_uuid,
-                          "algo": algo_uuid,
-                          "model_start": model_start,
-                          "model_end": model_uuid_end,
-                          "train_data": train_data,
-                          "test_data": test_data,
-                          "worker": None,
-                          "perf": None,
-                          "train_perf": None,
-                          "test_perf": None,
-                          "status": 'todo',
-                          'rank': j,
-                          'timestamp_creation': int(time.time()),
-                          'timestamp_done': None}
-        # Add learnuplet to db
-        api.mongo.db.learnuplet.insert_one(new_learnuplet)
-        list_new_learnuplets.append(new_learnuplet)
-        model_uuid_start = model_uuid_end
-        # Remind learnuplet to be be sent to Compute (which has a model_start)
-        worker_url = api.compute_url
-        if worker_url and j == start_rank:
-            post_uplet([new_learnuplet], worker_url, 'learn')
+    list_new_learnuplets = build_learnuplets(
+        new_data, sz_batch, test_data, problem_uuid, workflow_uuid,
+        algo_uuid, model_uuid_start, start_rank)
+    insert_learnuplets(list_new_learnuplets, {algo_uuid: start_rank})
     return list_new_learnuplets
 
 
 def post_uplet(list_uplet, worker_url, uplet_prefix):
     """
     post learnuplet/preduplet to a list of workers (Compute)
+    Uplets are added to the dispatch queue in db, and posted in background
+    by the dispatcher (see dispatch.py)
+
     :param list_uplet: list of json containing learnuplets/preduplets
     :param worker_url: worker url
     :param uplet_prefix: pred or learn
@@ -120,13 +101,7 @@ def post_uplet(list_uplet, worker_url, uplet_prefix):
     :type worker_url: url
     :type uplet_prefix: string
     """
-    for uplet in list_uplet:
-        clean_uplet = {k: v for k, v in uplet.items() if k != '_id'}
-        for k, v in clean_uplet.items():
-            if type(v) == uuid.UUID:
-                clean_uplet[k] = str(v)
-        requests.post('%s/%s' % (worker_url, uplet_prefix),
-                      data=json.dumps(clean_uplet))
+    dispatch.enqueue(api.mongo.db, list_uplet, worker_url, uplet_prefix)
 
 
 def algo_learnuplet(algo_uuid):
@@ -141,24 +116,38 @@ def algo_learnuplet(algo_uuid):
     :rtype: integer
     """
     new_algo = api.mongo.db.algo.find_one({"uuid": algo_uuid})
-    problem = api.mongo.db.problem.find_one({"uuid": new_algo["problem"]})
+    return algos_learnuplet([new_algo])
 
+
+def algos_learnuplet(list_algo):
+    """
+    Create new learnuplets when adding new algos, as algo_learnuplet.
+    Problems and active data are queried once for all algos, and all
+    learnuplets are written at once.
+
+    :param list_algo: new algos, with their uuid and problem
+    :type list_algo: list
+    :return: number of created learnuplets
+    :rtype: integer
+    """
+    problem_uuids = list({algo["problem"] for algo in list_algo})
+    problems = cache.problem_cache.get_many(api.mongo.db, problem_uuids)
     # Find all active data associated to the same problem
-    new_learnuplets = []
-    if problem:
-        active_data = api.mongo.db.data.find({"problems": problem["uuid"]}). \
-            sort("timestamp_upload").distinct("uuid")
-        test_data = problem["test_dataset"]
-        # Filter out test data...
-        active_data = list(set(active_data) - set(test_data))
-        # Create learnuplet for each fold if enough data exist
-        sz_batch = problem["size_train_dataset"]
-        problem_uuid = problem["uuid"]
-        workflow_uuid = problem["workflow"]
-        new_learnuplets = create_learnuplet(
-            active_data, sz_batch, test_data, problem_uuid, workflow_uuid,
-            algo_uuid, algo_uuid, 0)
-    return len(new_learnuplets)
+    train_data = {}
+    list_new_learnuplets = []
+    for algo in list_algo:
+        problem = problems.get(algo["problem"])
+        if not problem:
+            continue
+        if problem["uuid"] not in train_data:
+            problem_data = api.mongo.db.data.find(
+                {"problems": problem["uuid"]}).sort("timestamp_upload").\
+                distinct("uuid")
+            train_data[problem["uuid"]] = active_data(problem, problem_data)
+        list_new_learnuplets += algo_learnuplets(
+            algo, problem, train_data[problem["uuid"]])
+    return insert_learnuplets(list_new_learnuplets,
+                              {algo["uuid"]: 0 for algo in list_algo})
 
 
 def data_learnuplet(problem_uuid, data_uuids):
@@ -173,28 +162,15 @@ def data_learnuplet(problem_uuid, data_uuids):
     :return: number of created learnuplets
     :rtype: integer
     """
-    n = 0  # new learnuplets
-    problem = api.mongo.db.problem.find_one({"uuid": problem_uuid})
-    sz_batch = problem["size_train_dataset"]
+    problem = cache.problem_cache.get(api.mongo.db, problem_uuid)
+    # find the last learnuplet of each algo of the same problem, in one query
+    chain_tails = api.mongo.db.learnuplet.aggregate(
+        chain_tails_pipeline(problem_uuid))
     # create new learnuplets for algo of the same problem
-    list_uuid_algo = api.mongo.db.learnuplet.find(
-        {"problem": problem_uuid}).distinct("algo")
-    if list_uuid_algo:
-        sz_batch = problem["size_train_dataset"]
-        test_data = problem["test_dataset"]
-        workflow_uuid = problem["workflow"]
-        for uuid_algo in list_uuid_algo:
-            last_learnuplet = api.mongo.db.learnuplet.find_one(
-                {"rank": {"$exists": True}, "algo": uuid_algo},
-                sort=[("rank", -1)])
-            last_rank = last_learnuplet["rank"]
-            # TODO modify. Problem: what if pending models????
-            last_model = last_learnuplet["model_end"]
-            new_learnuplets = create_learnuplet(
-                data_uuids, sz_batch, test_data, problem_uuid,
-                workflow_uuid, uuid_algo, last_model, last_rank + 1)
-            n += len(new_learnuplets)
-    return n
+    list_new_learnuplets, start_ranks = chain_learnuplets(
+        problem, data_uuids, chain_tails)
+    # write learnuplets of all algos at once
+    return insert_learnuplets(list_new_learnuplets, start_ranks)
 
 
 def create_preduplet(new_preduplet):
@@ -207,25 +183,17 @@ def create_preduplet(new_preduplet):
     :return: 1 if creation of a preduplet, 0 if no model found
     """
     # Find best model
-    learnuplet_best_model = api.mongo.db.learnuplet.find_one(
-        {"perf": {"$exists": True}, "problem": new_preduplet["problem"]},
-        sort=[("perf", -1)])
+    best_model = leaderboard.best_model(api.mongo.db,
+                                        new_preduplet["problem"])
     # Find associated problem
-    problem = api.mongo.db.problem.find_one({"uuid": new_preduplet["problem"]})
-    if learnuplet_best_model:
-        new_preduplet["uuid"] = str(uuid.uuid4())
-        new_preduplet["model"] = learnuplet_best_model["model_end"]
-        new_preduplet["status"] = "todo"
-        new_preduplet["worker"] = None
-        new_preduplet["timestamp_done"] = None
-        new_preduplet["workflow"] = problem["workflow"]
-        new_preduplet["prediction_storage_uuid"] = None
-        api.mongo.db.preduplet.insert_one(new_preduplet)
+    problem = cache.problem_cache.get(api.mongo.db, new_preduplet["problem"])
+    if best_model:
+        build_preduplet(new_preduplet, best_model, problem)
+        api.mongo.db.preduplet.insert_one(revisions.stamp(new_preduplet))
         # Push the new preduplet to Compute
         worker_url = api.compute_url
         if worker_url:
             post_uplet([new_preduplet], worker_url, 'pred')
-        clean_uplet = {k: v for k, v in new_preduplet.items() if k != '_id'}
-        return clean_uplet
+        return pagination.clean_document(new_preduplet)
     else:
         return 0
@@ -35,13 +35,21 @@
  knowledge of the CeCILL license and that you accept its terms.
 '''
 
+import gzip
 import os
+import subprocess
+import sys
 import unittest
+import unittest.mock
+import zlib
 import json
 import time
+import uuid
 import numpy as np
 from pymongo import MongoClient
 from base64 import b64encode
+from bson import Timestamp
+from collections import namedtuple
 
 
 # It is important that the next two line be in that order (sorry PEP8)
@@ -50,8 +58,25 @@ from base64 import b64encode
 os.environ['TESTING'] = "T"
 os.environ['USER_AUTH'] = "test"
 os.environ['PWD_AUTH'] = "test"
+os.environ['CHANGES_LAG'] = "0"
+os.environ['UPLET_COUNTS_TTL'] = "0"
 from api import app
 from api import list_collection
+import cache
+import compression
+import indexes
+import instrumentation
+import leaderboard
+import leases
+import migrate
+import pagination
+import revisions
+import serializer
+
+# Events received by pymongo command listeners
+CommandEvent = namedtuple('CommandEvent', [
+    'command_name', 'command', 'database_name', 'connection_id',
+    'request_id', 'duration_micros'])
 
 headers = {
     'Authorization': 'Basic %s' % b64encode(b"test:test").decode("ascii")
@@ -115,6 +140,9 @@ class APITestCase(unittest.TestCase):
         self.app = app.test_client()
         self.client = MongoClient()
         self.db = self.client[app.config["MONGO_DBNAME"]]
+        indexes.ensure_indexes(self.db)
+        cache.response_cache.clear()
+        cache.problem_cache.clear()
 
     def tearDown(self):
         self.client.drop_database(app.config["MONGO_DBNAME"])
@@ -148,6 +176,39 @@ class APITestCase(unittest.TestCase):
         rv = self.app.get('/problem/P1', headers=headers)
         self.assertEqual(rv.status_code, 200)
 
+    def test_prepare_db(self):
+        self.db.learnuplet.drop_indexes()
+        # missing indexes are logged
+        with unittest.mock.patch.object(indexes, 'ensure_indexes'), \
+                self.assertLogs('migrate', 'WARNING') as logs:
+            migrate.prepare_db(self.db)
+        self.assertIn('missing indexes on learnuplet', logs.output[0])
+        # documents written before revisions existed
+        self.db.problem.insert_one({"uuid": "PB", "workflow": "PW"})
+        migrate.prepare_db(self.db)
+        self.assertFalse(
+            indexes.index_report(self.db)['learnuplet']['missing'])
+        self.assertIsNotNone(
+            self.db.problem.find_one({"uuid": "PB"})[revisions.REVISION_FIELD])
+
+    def test_ensure_indexes(self):
+        self.assertFalse(indexes.ensure_indexes(self.db))
+        # building them twice is a no-op
+        self.assertFalse(indexes.ensure_indexes(self.db))
+        report = indexes.index_report(self.db)
+        for collection_name in list_collection:
+            self.assertFalse(report[collection_name]['missing'])
+        self.assertTrue(
+            self.db.learnuplet.index_information()['uuid_1']['unique'])
+        # uuid of a problem is unique
+        problem = {"uuid": "P0", "workflow": "W0", "test_dataset": ["TD1"],
+                   "size_train_dataset": 4}
+        for status_code in [201, 400]:
+            rv = self.app.post('/problem', data=json.dumps(problem),
+                               content_type='application/json',
+                               headers=headers)
+            self.assertEqual(rv.status_code, status_code)
+
     def test_create_algo(self):
         # add associated problem first
         rv = self.app.post('/problem',
@@ -177,6 +238,15 @@ class APITestCase(unittest.TestCase):
                            content_type='application/json',
                            headers=headers)
         self.assertEqual(rv.status_code, 400)
+        # try to add algo whose problem is not a UUID
+        for problem in [["P2"], {"uuid": "P2"}]:
+            rv = self.app.post('/algo',
+                               data=json.dumps({"uuid": "A",
+                                                "problem": problem,
+                                                "name": "listed"}),
+                               content_type='application/json',
+                               headers=headers)
+            self.assertEqual(rv.status_code, 400)
         # try to add algo with wrong key
         rv = self.app.post('/algo',
                            data=json.dumps({"uuid": "A", "problemo": "P2",
@@ -203,6 +273,49 @@ class APITestCase(unittest.TestCase):
                          find_one({"model_start": None,
                                    "rank": 1})["status"], "todo")
 
+    def test_create_problems_and_algos(self):
+        problems = [{"uuid": "P5%s" % i, "workflow": "W5",
+                     "test_dataset": ["DT1"], "size_train_dataset": 2}
+                    for i in range(3)]
+        self.db.problem.insert_one(dict(problems[2]))
+        rv = self.app.post('/problem',
+                           data=json.dumps(problems + [{"uuid": "P"}]),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 201)
+        output = json.loads(rv.get_data(as_text=True))
+        self.assertEqual([d["uuid"] for d in output["new_problems"]],
+                         ["P50", "P51"])
+        # already existing problem and missing key
+        self.assertEqual([e["index"] for e in output["errors"]], [2, 3])
+        self.db.data.insert_many([{"uuid": "D5%s" % i,
+                                   "problems": ["P50", "P51"]}
+                                  for i in range(4)])
+        algos = [{"uuid": "A5%s" % i, "name": "A", "problem": "P5%s" % (i % 2)}
+                 for i in range(4)]
+        algos.append({"uuid": "A5E", "name": "A", "problem": "EMPTY"})
+        algos.append({"uuid": "A5L", "name": "A", "problem": ["P50"]})
+        rv = self.app.post('/algo', data=json.dumps(algos),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 201)
+        output = json.loads(rv.get_data(as_text=True))
+        self.assertEqual(len(output["new_algos"]), 4)
+        self.assertEqual(output["errors"],
+                         [{"index": i,
+                           "Error": "non-existing related problem"}
+                          for i in [4, 5]])
+        # 2 learnuplets (4 data by batch of 2) for each algo
+        self.assertEqual(output["new_learnuplets"], 8)
+        self.assertEqual(self.db.learnuplet.find({"algo": "A51",
+                                                  "problem": "P51"}).count(),
+                         2)
+        # nothing inserted
+        rv = self.app.post('/algo', data=json.dumps(algos[:1]),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 400)
+
     def test_create_data(self):
         n_data = 10
         n_data_new = 10
@@ -265,6 +378,74 @@ class APITestCase(unittest.TestCase):
         rv = self.app.get('/data/D30', headers=headers)
         self.assertEqual(rv.status_code, 200)
 
+    def test_create_data_several_algos(self):
+        self.db.problem.insert_one({"uuid": "P4", "workflow": "W4",
+                                    "test_dataset": ["DT1"],
+                                    "size_train_dataset": 2})
+        # two algos whose chains of learnuplets end at different ranks
+        for rank in range(3):
+            model_prefix = "M%s_" % rank if rank else "A4"
+            self.db.learnuplet.insert_many(generate_list_learnuplets(
+                1, problem="P4", workflow="W4", status="done", rank=rank,
+                algo_prefix="A4", model_prefix=model_prefix,
+                uuid_prefix="idA%s_" % rank))
+        self.db.learnuplet.insert_many(generate_list_learnuplets(
+            1, problem="P4", workflow="W4", status="done", rank=0,
+            model_prefix="B4", uuid_prefix="idB_"))
+        rv = self.app.post('/data',
+                           data=json.dumps({"uuid": ["D4%s" % i
+                                                     for i in range(4)],
+                                            "problems": ["P4"]}),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(
+            json.loads(rv.get_data(as_text=True))["new_learnuplets"], 4)
+        # each chain is continued from its last learnuplet
+        self.assertEqual(self.db.learnuplet.find_one(
+            {"algo": "A40_s", "rank": 3})["model_start"], "M2_0_e")
+        self.assertEqual(self.db.learnuplet.find_one(
+            {"algo": "B40_s", "rank": 1})["model_start"], "B40_e")
+        self.assertEqual(self.db.learnuplet.find(
+            {"algo": "A40_s", "rank": 4, "model_start": None}).count(), 1)
+
+    def test_create_existing_data(self):
+        self.db.problem.insert_one({"uuid": "P6", "workflow": "W6",
+                                    "test_dataset": ["DT1"],
+                                    "size_train_dataset": 2})
+        self.db.learnuplet.insert_many(generate_list_learnuplets(
+            1, problem="P6", workflow="W6", status="done", model_prefix="A6"))
+        rv = self.app.post('/data',
+                           data=json.dumps({"uuid": ["D6%s" % i
+                                                     for i in range(4)],
+                                            "problems": "P6"}),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(
+            json.loads(rv.get_data(as_text=True))["new_learnuplets"], 2)
+        revision = self.db.data.find_one(
+            {"uuid": "D62"})[revisions.REVISION_FIELD]
+        # posting again existing data does not duplicate nor modify them
+        rv = self.app.post('/data',
+                           data=json.dumps({"uuid": ["D6%s" % i
+                                                     for i in range(2, 6)] +
+                                            ["D65"],
+                                            "problems": ["P6"]}),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 201)
+        output = json.loads(rv.get_data(as_text=True))
+        self.assertEqual([d["uuid"] for d in output["new_datas"]],
+                         ["D64", "D65"])
+        self.assertNotIn("_id", output["new_datas"][0])
+        self.assertEqual(output["new_learnuplets"], 1)
+        self.assertEqual(self.db.data.find({"problems": "P6"}).count(), 6)
+        self.assertEqual(self.db.data.find_one(
+            {"uuid": "D62"})[revisions.REVISION_FIELD], revision)
+        self.assertEqual(self.db.learnuplet.find({"problem": "P6"}).count(),
+                         4)
+
     def test_request_prediction(self):
         # add problem
         self.db.problem.insert_one({"uuid": "PP", "workflow": "WW",
@@ -333,6 +514,124 @@ class APITestCase(unittest.TestCase):
                            headers=headers)
         self.assertEqual(rv.status_code, 404)
 
+    def test_claim_uplets(self):
+        # only the first learnuplet of each chain can be trained
+        learnuplets = generate_list_learnuplets(3, rank=0)
+        learnuplets += generate_list_learnuplets(3, rank=1, model_prefix="N",
+                                                 uuid_prefix="idN_")
+        for learnuplet in learnuplets[3:]:
+            learnuplet["model_start"] = None
+        self.db.learnuplet.insert_many(learnuplets)
+        self.db.preduplet.insert_many(generate_list_preduplets(2))
+        rv = self.app.post('/worker/claim',
+                           data=json.dumps({"worker": "bobor", "n": 2,
+                                            "uplet_type": "learnuplet"}),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        claimed = json.loads(rv.get_data(as_text=True))["learnuplets"]
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual({d["status"] for d in claimed}, {"pending"})
+        self.assertEqual({d["worker"] for d in claimed}, {"bobor"})
+        # other workers get the remaining ones
+        rv = self.app.post('/worker/claim',
+                           data=json.dumps({"worker": "alice", "n": 5,
+                                            "uplet_type": "learnuplet"}),
+                           content_type='application/json',
+                           headers=headers)
+        claimed_again = json.loads(rv.get_data(as_text=True))["learnuplets"]
+        self.assertEqual(len(claimed_again), 1)
+        self.assertNotIn(claimed_again[0]["uuid"],
+                         [d["uuid"] for d in claimed])
+        self.assertEqual(self.db.learnuplet.find(
+            {"status": "pending", "rank": 0}).count(), 3)
+        rv = self.app.post('/worker/claim',
+                           data=json.dumps({"worker": "alice",
+                                            "uplet_type": "preduplet"}),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(
+            len(json.loads(rv.get_data(as_text=True))["preduplets"]), 1)
+        # wrong requests
+        for data in [{"uplet_type": "preduplet"},
+                     {"worker": "alice", "uplet_type": "uplet"},
+                     {"worker": "alice", "uplet_type": "preduplet", "n": 0}]:
+            rv = self.app.post('/worker/claim', data=json.dumps(data),
+                               content_type='application/json',
+                               headers=headers)
+            self.assertEqual(rv.status_code, 400)
+
+    def test_leases(self):
+        self.db.learnuplet.insert_many(generate_list_learnuplets(3))
+        self.db.preduplet.insert_many(generate_list_preduplets(1))
+        for uplet_uuid in ["id_0", "id_1"]:
+            rv = self.app.post('/worker/learnuplet/%s' % uplet_uuid,
+                               data=json.dumps({"worker": "bobor"}),
+                               content_type='application/json',
+                               headers=headers)
+            self.assertEqual(rv.status_code, 200)
+        rv = self.app.post('/worker/claim',
+                           data=json.dumps({"worker": "bobor",
+                                            "uplet_type": "preduplet"}),
+                           content_type='application/json',
+                           headers=headers)
+        # leases start at the first heartbeat of the worker
+        self.assertNotIn("lease_expires", json.loads(
+            rv.get_data(as_text=True))["preduplets"][0])
+        self.assertIsNone(self.db.learnuplet.find_one(
+            {"lease_expires": {"$exists": True}}))
+        # extend leases of all pending uplets of the worker
+        rv = self.app.post('/worker/heartbeat',
+                           data=json.dumps({"worker": "bobor"}),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        output = json.loads(rv.get_data(as_text=True))
+        self.assertEqual(output["learnuplets"], 2)
+        self.assertEqual(output["preduplets"], 1)
+        # or only some of them
+        rv = self.app.post('/worker/heartbeat',
+                           data=json.dumps({"worker": "bobor",
+                                            "uplets": ["id_1"]}),
+                           content_type='application/json',
+                           headers=headers)
+        output = json.loads(rv.get_data(as_text=True))
+        self.assertEqual(output["learnuplets"], 1)
+        self.assertEqual(output["preduplets"], 0)
+        rv = self.app.post('/worker/heartbeat',
+                           data=json.dumps({"uplets": ["id_1"]}),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 400)
+        # nothing to reclaim until leases expire
+        self.assertEqual(leases.reclaim_expired(self.db), 0)
+        self.db.learnuplet.update_one(
+            {"uuid": "id_0"}, {"$set": {"lease_expires": time.time() - 1}})
+        self.assertEqual(leases.reclaim_expired(self.db), 1)
+        learnuplet = self.db.learnuplet.find_one({"uuid": "id_0"})
+        self.assertEqual(learnuplet["status"], "todo")
+        self.assertIsNone(learnuplet["worker"])
+        self.assertNotIn("lease_expires", learnuplet)
+        # reclaimed learnuplet is pushed again to Compute
+        self.db.learnuplet.update_one(
+            {"uuid": "id_1"}, {"$set": {"lease_expires": time.time() - 1}})
+        self.assertEqual(leases.reclaim_expired(self.db, "http://compute"), 1)
+        self.assertEqual(self.db.dispatch.find_one()["uplet"]["uuid"], "id_1")
+        # uplets of workers which never send heartbeats are left pending
+        rv = self.app.post('/worker/learnuplet/id_2',
+                           data=json.dumps({"worker": "legacy"}),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        # long after, only the preduplet leased by heartbeats is reclaimed
+        with unittest.mock.patch('time.time',
+                                 return_value=time.time() + 3600):
+            self.assertEqual(leases.reclaim_expired(self.db), 1)
+        self.assertEqual(self.db.preduplet.find_one()["status"], "todo")
+        learnuplet = self.db.learnuplet.find_one({"uuid": "id_2"})
+        self.assertEqual(learnuplet["status"], "pending")
+        self.assertEqual(learnuplet["worker"], "legacy")
+
     def test_report_perf_learnuplet_1(self):
         n_train = 5
         n_test = 5
@@ -355,6 +654,18 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertEqual(self.db.learnuplet.find({"uuid": "id_0",
                                                   "perf": 0.9}).count(), 1)
+        # same output again, the learnuplet is not modified
+        revision = self.db.learnuplet.find_one(
+            {"uuid": "id_0"})[revisions.REVISION_FIELD]
+        rv = self.app.post('/learndone/id_0',
+                           data=json.dumps({"status": "done", "perf": 0.9,
+                                            "train_perf": train_perf,
+                                            "test_perf": test_perf}),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(self.db.learnuplet.find_one(
+            {"uuid": "id_0"})[revisions.REVISION_FIELD], revision)
         # wrong learnuplet uuid
         rv = self.app.post('/learndone/ad_0',
                            data=json.dumps({"status": "done", "perf": 0.9,
@@ -412,6 +723,184 @@ class APITestCase(unittest.TestCase):
                                                   "model_start": 'B0_e'})
                          .count(), 1)
 
+    def test_report_perf_learnuplet_round_trips(self):
+        learnuplet_list = generate_list_learnuplets(
+            1, uuid_prefix="id0_", status="pending", rank=0, worker="bobor")
+        learnuplet_list += generate_list_learnuplets(
+            1, uuid_prefix="id1_", status="todo", rank=1, model_prefix='N')
+        self.db.learnuplet.insert_many(learnuplet_list)
+        rv = self.app.post('/learndone/id0_0',
+                           data=json.dumps({"status": "done", "perf": 0.9,
+                                            "train_perf": {},
+                                            "test_perf": {}}),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self.db.learnuplet.find_one(
+            {"uuid": "id1_0"})["model_start"], "MD_0_e")
+        # update of learnuplet, of leaderboard and of next learnuplet
+        self.assertLessEqual(instrumentation.command_counter.total(), 3)
+        # failed learning only updates the learnuplet
+        self.db.learnuplet.update_one({"uuid": "id1_0"},
+                                      {"$set": {"status": "pending"}})
+        rv = self.app.post('/learndone/id1_0',
+                           data=json.dumps({"status": "failed"}),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertLessEqual(instrumentation.command_counter.total(), 1)
+        # a new best model of an algo does not look for better ones
+        self.db.learnuplet.update_one({"uuid": "id1_0"},
+                                      {"$set": {"status": "pending"}})
+        rv = self.app.post('/learndone/id1_0',
+                           data=json.dumps({"status": "done", "perf": 0.95,
+                                            "train_perf": {},
+                                            "test_perf": {}}),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self.db.leaderboard.find_one(
+            {"algo": learnuplet_list[1]["algo"]})["best"]["perf"], 0.95)
+        self.assertLessEqual(instrumentation.command_counter.total(), 3)
+
+    def test_mongo_debug_headers(self):
+        rv = self.app.get('/problem', headers=headers)
+        self.assertNotIn('X-Mongo-Commands', rv.headers)
+        app.config['MONGO_DEBUG_HEADERS'] = True
+        try:
+            rv = self.app.get('/problem', headers=headers)
+        finally:
+            app.config['MONGO_DEBUG_HEADERS'] = False
+        self.assertEqual(int(rv.headers['X-Mongo-Commands']),
+                         instrumentation.command_counter.total())
+        self.assertIn('X-Mongo-Time', rv.headers)
+
+    def test_slow_command_log(self):
+        slow_command_log = instrumentation.SlowCommandLog(threshold_ms=10)
+        find = {"find": "learnuplet", "filter": {"status": "todo"},
+                "$db": "test_orchestrator"}
+        for i in range(2):
+            slow_command_log.started(CommandEvent(
+                "find", find, "test_orchestrator", 1, i, None))
+        # commands of a background thread are logged right away
+        with self.assertLogs('instrumentation', 'WARNING') as logs:
+            slow_command_log.succeeded(CommandEvent(
+                "find", None, None, 1, 1, 20000))
+        self.assertIn('background thread', logs.output[0])
+        self.assertIn('{"status": "todo"}', logs.output[0])
+        # commands of a request are logged at its end, only if slow
+        slow_command_log.start_request('GET /learnuplet')
+        for i, duration in enumerate([1000, 20000]):
+            slow_command_log.started(CommandEvent(
+                "find", find, "test_orchestrator", 1, i, None))
+            slow_command_log.succeeded(CommandEvent(
+                "find", None, None, 1, i, duration))
+        with self.assertLogs('instrumentation', 'WARNING') as logs:
+            slow_command_log.end_request()
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('GET /learnuplet', logs.output[0])
+        self.assertIn('20.0 ms', logs.output[0])
+        # with a client, they are explained and logged by a background thread
+        client = unittest.mock.MagicMock()
+        client.__getitem__.return_value.command.return_value = {
+            "queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}
+        slow_command_log.start_request('GET /learnuplet')
+        slow_command_log.started(CommandEvent(
+            "find", find, "test_orchestrator", 1, 2, None))
+        slow_command_log.succeeded(CommandEvent(
+            "find", None, None, 1, 2, 20000))
+        with self.assertLogs('instrumentation', 'WARNING') as logs:
+            slow_command_log.end_request(client)
+            slow_command_log.explainer.queue.join()
+        self.assertIn('plan COLLSCAN', logs.output[0])
+        # requests over budget
+        budget = instrumentation.MONGO_QUERY_BUDGET
+        instrumentation.MONGO_QUERY_BUDGET = 1
+        try:
+            instrumentation.start_request('POST /data')
+            for i in range(2):
+                instrumentation.command_counter.started(CommandEvent(
+                    "find", find, "test_orchestrator", 1, i, None))
+            with self.assertLogs('instrumentation', 'WARNING') as logs:
+                self.assertEqual(instrumentation.end_request()[0], 2)
+        finally:
+            instrumentation.MONGO_QUERY_BUDGET = budget
+        self.assertIn('POST /data sent 2 commands', logs.output[0])
+
+    def test_plan_summary(self):
+        explanation = {"queryPlanner": {"winningPlan": {
+            "stage": "LIMIT", "inputStage": {
+                "stage": "FETCH", "inputStage": {
+                    "stage": "IXSCAN",
+                    "indexName": "status_1_timestamp_creation_1"}}}}}
+        self.assertEqual(
+            instrumentation.plan_summary(explanation),
+            "LIMIT > FETCH > IXSCAN status_1_timestamp_creation_1")
+        self.assertEqual(instrumentation.plan_summary(
+            {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}),
+            "COLLSCAN")
+
+    def test_leaderboard(self):
+        # two algos of the same problem
+        learnuplets = generate_list_learnuplets(
+            2, status="pending", worker="bobor", perf=[None, None])
+        learnuplets += generate_list_learnuplets(
+            2, status="todo", rank=1, model_prefix="MD_N", uuid_prefix="idN_")
+        self.db.learnuplet.insert_many(learnuplets)
+        rv = self.app.post('/learndone/id_0',
+                           data=json.dumps({"status": "done", "perf": 0.7,
+                                            "train_perf": {},
+                                            "test_perf": {}}),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        rv = self.app.post('/learndone/id_1',
+                           data=json.dumps({"status": "done", "perf": 0.8,
+                                            "train_perf": {},
+                                            "test_perf": {}}),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        rv = self.app.get('/leaderboard/PB', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        top = json.loads(rv.get_data(as_text=True))["leaderboard"]
+        self.assertEqual([m["perf"] for m in top], [0.8, 0.7])
+        self.assertEqual([m["algo"] for m in top], ["MD_1_s", "MD_0_s"])
+        self.assertEqual(top[0]["model_end"], "MD_1_e")
+        rv = self.app.get('/leaderboard/PB?k=1', headers=headers)
+        self.assertEqual(
+            len(json.loads(rv.get_data(as_text=True))["leaderboard"]), 1)
+        rv = self.app.get('/leaderboard/PB?k=oups', headers=headers)
+        self.assertEqual(rv.status_code, 400)
+        # not mistaken for the changes of a collection
+        rv = self.app.get('/leaderboard/changes', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(
+            json.loads(rv.get_data(as_text=True))["leaderboard"], [])
+        # a worse perf does not replace the best model of an algo
+        learnuplet = dict(learnuplets[0], perf=0.1, model_end="worse",
+                          uuid="id_worse")
+        self.assertEqual(
+            leaderboard.record(self.db, learnuplet)["best"]["perf"], 0.7)
+        learnuplet.update(perf=0.9, model_end="better")
+        self.assertEqual(
+            leaderboard.record(self.db, learnuplet)["best"]["model_end"],
+            "better")
+        self.assertEqual(
+            leaderboard.best_model(self.db, "PB")["model_end"], "better")
+        # learnuplets trained before the leaderboard existed
+        self.db.leaderboard.drop()
+        self.assertEqual(leaderboard.rebuild(self.db), 2)
+        self.assertEqual(
+            leaderboard.best_model(self.db, "PB", "MD_0_s")["perf"], 0.7)
+        # the first learnuplet recorded for an algo does not hide a better
+        # one trained before the leaderboard existed, recorded at startup
+        self.db.leaderboard.drop()
+        migrate.prepare_db(self.db)
+        learnuplet = dict(learnuplets[0], perf=0.1, uuid="id_worse")
+        self.assertEqual(
+            leaderboard.record(self.db, learnuplet)["best"]["perf"], 0.7)
+
     def test_update_preduplet(self):
         # add preduplet
         preduplet = generate_list_preduplets(
@@ -426,6 +915,13 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertEqual(self.db.preduplet.find({"uuid": "id_0",
                                                  "status": "done"}).count(), 1)
+        # status already updated
+        rv = self.app.post('/preddone/id_0',
+                           data=json.dumps({"status": "done",
+                                            "prediction_storage_uuid": "id"}),
+                           content_type='application/json',
+                           headers=headers)
+        self.assertEqual(rv.status_code, 400)
         # wrong learnuplet uuid
         rv = self.app.post('/preddone/ad_0',
                            data=json.dumps({"status": "done",
@@ -466,6 +962,352 @@ class APITestCase(unittest.TestCase):
                           headers=headers)
         self.assertFalse(json.loads(rv.get_data(as_text=True))["learnuplets"])
 
+    def test_get_paginated_documents(self):
+        learnuplets = generate_list_learnuplets(10)
+        self.db.learnuplet.insert_many(learnuplets)
+        # follow next cursors until the last page
+        uuids = []
+        url = '/learnuplet?limit=4'
+        for n_expected in [4, 4, 2]:
+            rv = self.app.get(url, headers=headers)
+            self.assertEqual(rv.status_code, 200)
+            page = json.loads(rv.get_data(as_text=True))
+            self.assertEqual(len(page["learnuplets"]), n_expected)
+            uuids += [d["uuid"] for d in page["learnuplets"]]
+            url = '/learnuplet?limit=4&after=%s' % page["next"]
+        self.assertIsNone(page["next"])
+        self.assertEqual(sorted(uuids), sorted(d["uuid"] for d in learnuplets))
+        # filters still apply
+        rv = self.app.get('/learnuplet?limit=4&uuid=id_3', headers=headers)
+        self.assertEqual(
+            len(json.loads(rv.get_data(as_text=True))["learnuplets"]), 1)
+        # wrong cursor or limit
+        for url in ['/learnuplet?after=oups', '/learnuplet?limit=-1']:
+            rv = self.app.get(url, headers=headers)
+            self.assertEqual(rv.status_code, 400)
+
+    def test_get_streamed_documents(self):
+        learnuplets = generate_list_learnuplets(10)
+        self.db.learnuplet.insert_many(learnuplets)
+        # newline delimited json
+        rv = self.app.get('/learnuplet?stream=ndjson', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, 'application/x-ndjson')
+        lines = rv.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 10)
+        self.assertNotIn("_id", json.loads(lines[0]))
+        rv = self.app.get('/learnuplet',
+                          headers=dict(headers,
+                                       Accept='application/x-ndjson'))
+        self.assertEqual(len(rv.get_data(as_text=True).splitlines()), 10)
+        # chunked json, with pagination
+        rv = self.app.get('/learnuplet?stream=json&limit=6', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        page = json.loads(rv.get_data(as_text=True))
+        self.assertEqual(len(page["learnuplets"]), 6)
+        rv = self.app.get('/learnuplet?stream=json&limit=6&after=%s' %
+                          page["next"], headers=headers)
+        page = json.loads(rv.get_data(as_text=True))
+        self.assertEqual(len(page["learnuplets"]), 4)
+        self.assertIsNone(page["next"])
+
+    def test_get_projected_documents(self):
+        learnuplets = generate_list_learnuplets(3, status="done",
+                                                perf=[0.1, 0.2, 0.3])
+        self.db.learnuplet.insert_many(learnuplets)
+        fields = ["perf", "rank", "status", "uuid"]
+        rv = self.app.get('/learnuplet?fields=uuid,status,rank,perf',
+                          headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        for d in json.loads(rv.get_data(as_text=True))["learnuplets"]:
+            self.assertEqual(sorted(d), fields)
+        rv = self.app.get('/learnuplet?fields=uuid,status,rank,perf&limit=2',
+                          headers=headers)
+        self.assertIsNotNone(json.loads(rv.get_data(as_text=True))["next"])
+        rv = self.app.get('/learnuplet/id_1?fields=uuid,status,rank,perf',
+                          headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        d = json.loads(rv.get_data(as_text=True))
+        self.assertEqual(sorted(d), fields)
+        self.assertEqual(d["perf"], 0.2)
+        # non-existing document
+        rv = self.app.get('/learnuplet/id_9', headers=headers)
+        self.assertEqual(rv.status_code, 404)
+
+    def test_get_changes(self):
+        # documents written before revisions are stamped
+        self.db.learnuplet.insert_many(generate_list_learnuplets(4))
+        self.assertEqual(revisions.stamp_missing(self.db, ['learnuplet']), 4)
+        self.assertEqual(revisions.stamp_missing(self.db, ['learnuplet']), 0)
+        rv = self.app.get('/learnuplet/changes?limit=3', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        output = json.loads(rv.get_data(as_text=True))
+        self.assertEqual(len(output["learnuplets"]), 3)
+        self.assertNotIn("revision", output["learnuplets"][0])
+        rv = self.app.get('/learnuplet/changes?since=%s' % output["next"],
+                          headers=headers)
+        output = json.loads(rv.get_data(as_text=True))
+        self.assertEqual([d["uuid"] for d in output["learnuplets"]],
+                         ["id_3"])
+        # no new change
+        since = output["next"]
+        rv = self.app.get('/learnuplet/changes?since=%s' % since,
+                          headers=headers)
+        output = json.loads(rv.get_data(as_text=True))
+        self.assertEqual(output, {"learnuplets": [], "next": since})
+        # modified documents are listed again, in order of modification
+        rv = self.app.post('/worker/learnuplet/id_2',
+                           data=json.dumps({"worker": "W1"}),
+                           content_type='application/json', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        rv = self.app.post('/learndone/id_0',
+                           data=json.dumps({"status": "failed"}),
+                           content_type='application/json', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        rv = self.app.get('/learnuplet/changes?since=%s&fields=uuid,status'
+                          % since, headers=headers)
+        output = json.loads(rv.get_data(as_text=True))
+        self.assertEqual(output["learnuplets"],
+                         [{"uuid": "id_2", "status": "pending"},
+                          {"uuid": "id_0", "status": "failed"}])
+        # documents inserted after an update are listed after it
+        self.db.learnuplet.insert_one(revisions.stamp(
+            generate_list_learnuplets(1, uuid_prefix="new_")[0]))
+        rv = self.app.get('/learnuplet/changes?since=%s' % output["next"],
+                          headers=headers)
+        output = json.loads(rv.get_data(as_text=True))
+        self.assertEqual([d["uuid"] for d in output["learnuplets"]],
+                         ["new_0"])
+        # the empty timestamp is the first field (after _id), the only ones
+        # replaced by MongoDB before 5.0
+        self.assertEqual(list(revisions.stamp({"uuid": "PB"})),
+                         [revisions.REVISION_FIELD, "uuid"])
+        # documents created through the API have a revision
+        rv = self.app.post('/problem', data=json.dumps(
+            {"uuid": "PB", "workflow": "PW", "test_dataset": [],
+             "size_train_dataset": 1}),
+            content_type='application/json', headers=headers)
+        self.assertEqual(rv.status_code, 201)
+        self.assertNotEqual(self.db.problem.find_one(
+            {"uuid": "PB"})[revisions.REVISION_FIELD], Timestamp(0, 0))
+        rv = self.app.get('/problem/changes', headers=headers)
+        self.assertEqual(len(json.loads(rv.get_data(as_text=True))
+                             ["problems"]), 1)
+        # wrong parameters
+        for args in ['since=wrong', 'limit=0', 'since=%s' %
+                     pagination.encode_cursor('wrong')]:
+            rv = self.app.get('/learnuplet/changes?%s' % args,
+                              headers=headers)
+            self.assertEqual(rv.status_code, 400)
+        rv = self.app.get('/dummy/changes', headers=headers)
+        self.assertEqual(rv.status_code, 404)
+
+    def test_cached_responses(self):
+        self.db.problem.insert_one({"uuid": "PB", "workflow": "PW"})
+        rv = self.app.get('/problem', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        etag = rv.headers['ETag']
+        # document added behind the API: cached response is still served
+        self.db.problem.insert_one({"uuid": "PB2", "workflow": "PW"})
+        rv = self.app.get('/problem', headers=headers)
+        self.assertEqual(rv.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(rv.get_data(as_text=True))
+                             ["problems"]), 1)
+        rv = self.app.get('/problem', headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.get_data(), b'')
+        # other query parameters, other response
+        rv = self.app.get('/problem?uuid=PB2', headers=headers)
+        self.assertEqual(len(json.loads(rv.get_data(as_text=True))
+                             ["problems"]), 1)
+        # posted problem invalidates cached responses
+        rv = self.app.post('/problem', data=json.dumps(
+            {"uuid": "PB3", "workflow": "PW", "test_dataset": [],
+             "size_train_dataset": 1}),
+            content_type='application/json', headers=headers)
+        self.assertEqual(rv.status_code, 201)
+        rv = self.app.get('/problem', headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(rv.get_data(as_text=True))
+                             ["problems"]), 3)
+        # errors are not cached
+        rv = self.app.get('/problem/PB4', headers=headers)
+        self.assertEqual(rv.status_code, 404)
+        self.db.problem.insert_one({"uuid": "PB4", "workflow": "PW"})
+        rv = self.app.get('/problem/PB4', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+
+    def test_problem_cache(self):
+        problem_cache = cache.problem_cache
+        self.db.problem.insert_one({"uuid": "PB", "workflow": "PW"})
+        self.assertEqual(problem_cache.get(self.db, "PB")["workflow"], "PW")
+        self.assertNotIn("_id", problem_cache.get(self.db, "PB"))
+        self.assertIsNone(problem_cache.get(self.db, "PB2"))
+        self.assertEqual((problem_cache.hits, problem_cache.misses), (1, 2))
+        # posted problems are cached when they are created
+        rv = self.app.post('/problem', data=json.dumps(
+            [{"uuid": "PB%s" % i, "workflow": "PW", "test_dataset": [],
+              "size_train_dataset": 1} for i in range(2, 4)]),
+            content_type='application/json', headers=headers)
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(
+            sorted(problem_cache.get_many(self.db, ["PB", "PB2", "PB3"])),
+            ["PB", "PB2", "PB3"])
+        self.assertEqual((problem_cache.hits, problem_cache.misses), (4, 2))
+        # and exported in /metrics
+        rv = self.app.get('/metrics', headers=headers)
+        lines = rv.get_data(as_text=True).splitlines()
+        for result in ['hit', 'miss']:
+            prefix = ('orchestrator_document_cache_lookups_total{'
+                      'collection="problem",result="%s"}' % result)
+            self.assertTrue(any(line.startswith(prefix) for line in lines),
+                            prefix)
+        # number of cached problems is bounded
+        small_cache = cache.DocumentCache('problem', max_size=1, ttl=60)
+        small_cache.get_many(self.db, ["PB", "PB2"])
+        self.assertEqual(len(small_cache), 1)
+        # expired problems are read again
+        small_cache.ttl = 0
+        small_cache.get(self.db, "PB")
+        small_cache.get(self.db, "PB")
+        self.assertEqual(small_cache.hits, 0)
+
+    def test_serializers(self):
+        learnuplets = generate_list_learnuplets(3, status="done", perf=0.5)
+        learnuplets[0]["worker"] = uuid.UUID(int=1)
+        for name in serializer.SERIALIZERS:
+            dumps = serializer.get_serializer(name)
+            output = json.loads(dumps({"learnuplets": learnuplets}).decode())
+            self.assertEqual(output["learnuplets"][0]["worker"],
+                             str(uuid.UUID(int=1)))
+            self.assertEqual(output["learnuplets"][1:], learnuplets[1:])
+        # unknown serializer
+        self.assertEqual(serializer.get_serializer("dummy"),
+                         serializer.json_dumps)
+        # responses are not indented
+        rv = self.app.get('/problem', headers=headers)
+        self.assertEqual(rv.get_data(), b'{"problems":[]}')
+
+    def test_compressed_responses(self):
+        self.db.learnuplet.insert_many(generate_list_learnuplets(50))
+        rv = self.app.get('/learnuplet', headers=headers)
+        self.assertNotIn('Content-Encoding', rv.headers)
+        self.assertIn('Accept-Encoding', rv.headers['Vary'])
+        data = json.loads(rv.get_data(as_text=True))
+        decompress = {'gzip': gzip.decompress, 'deflate': zlib.decompress}
+        if compression.brotli:
+            decompress['br'] = compression.brotli.decompress
+        for encoding, decompress_data in decompress.items():
+            rv = self.app.get('/learnuplet', headers=dict(
+                headers, **{'Accept-Encoding': encoding}))
+            self.assertEqual(rv.headers['Content-Encoding'], encoding)
+            self.assertEqual(int(rv.headers['Content-Length']),
+                             len(rv.get_data()))
+            self.assertEqual(json.loads(decompress_data(rv.get_data())
+                                        .decode()), data)
+            etag = rv.headers['ETag']
+            self.assertTrue(etag.endswith('-%s"' % encoding))
+            rv = self.app.get('/learnuplet', headers=dict(
+                headers, **{'Accept-Encoding': encoding,
+                            'If-None-Match': etag}))
+            self.assertEqual(rv.status_code, 304)
+            self.assertEqual(rv.headers['ETag'], etag)
+        # weak comparison of If-None-Match
+        rv = self.app.get('/learnuplet', headers=dict(
+            headers, **{'Accept-Encoding': 'gzip',
+                        'If-None-Match': 'W/%s' % etag}))
+        self.assertEqual(rv.status_code, 304)
+        # ETags of other data do not match
+        rv = self.app.get('/learnuplet', headers=dict(
+            headers, **{'Accept-Encoding': 'gzip',
+                        'If-None-Match': '"dummy-gzip"'}))
+        self.assertEqual(rv.status_code, 200)
+        # preferred encoding of the client
+        rv = self.app.get('/learnuplet', headers=dict(
+            headers, **{'Accept-Encoding': 'gzip;q=0.5, deflate'}))
+        self.assertEqual(rv.headers['Content-Encoding'], 'deflate')
+        # streamed response
+        rv = self.app.get('/learnuplet?stream=ndjson', headers=dict(
+            headers, **{'Accept-Encoding': 'gzip'}))
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', rv.headers)
+        lines = gzip.decompress(rv.get_data()).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         data["learnuplets"])
+        # small response
+        rv = self.app.get('/problem', headers=dict(
+            headers, **{'Accept-Encoding': 'gzip'}))
+        self.assertNotIn('Content-Encoding', rv.headers)
+
+    def test_metrics(self):
+        self.db.learnuplet.insert_many(
+            generate_list_learnuplets(3, problem="PB1") +
+            generate_list_learnuplets(2, problem="PB2", status="done",
+                                      uuid_prefix="id2_"))
+        self.app.get('/learnuplet', headers=headers)
+        self.app.get('/dummy', headers=headers)
+        rv = self.app.get('/metrics', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.headers['Content-Type'].startswith('text/plain'))
+        lines = rv.get_data(as_text=True).splitlines()
+        for line in [
+                'orchestrator_uplets{problem="PB1",status="todo",'
+                'type="learnuplet"} 3.0',
+                'orchestrator_uplets{problem="PB2",status="done",'
+                'type="learnuplet"} 2.0']:
+            self.assertIn(line, lines)
+        for prefix in [
+                'orchestrator_requests_total{method="GET",'
+                'route="/<collection_name>",status="200"}',
+                'orchestrator_requests_total{method="GET",'
+                'route="/<collection_name>",status="404"}',
+                'orchestrator_request_duration_seconds_count{method="GET",'
+                'route="/<collection_name>"}']:
+            self.assertTrue(any(line.startswith(prefix) for line in lines),
+                            prefix)
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.status_code, 401)
+
+    def test_response_cache_lru(self):
+        response_cache = cache.ResponseCache(max_bytes=10, ttl=60)
+        response_cache.put('a', 'problem', 0, b'aaaa', 'application/json')
+        response_cache.put('b', 'algo', 0, b'bbbb', 'application/json')
+        self.assertIsNotNone(response_cache.get('a'))
+        # least recently used response is evicted
+        response_cache.put('c', 'algo', 0, b'cccc', 'application/json')
+        self.assertEqual(response_cache.size, 8)
+        self.assertIsNone(response_cache.get('b'))
+        self.assertIsNotNone(response_cache.get('a'))
+        # response read before an invalidation is not cached
+        generation = response_cache.generation('algo')
+        response_cache.invalidate('algo')
+        self.assertIsNone(response_cache.get('c'))
+        response_cache.put('c', 'algo', generation, b'cccc',
+                           'application/json')
+        self.assertIsNone(response_cache.get('c'))
+        self.assertEqual(len(response_cache), 1)
+        # expired response
+        response_cache.ttl = 0
+        response_cache.put('d', 'data', 0, b'dd', 'application/json')
+        self.assertIsNone(response_cache.get('d'))
+
+    def test_preload_app(self):
+        # a preloaded app creates its MongoDB client in create_app, called
+        # by each worker after fork
+        code = (
+            "import api\n"
+            "assert 'MONGO' not in api.app.extensions.get('pymongo', {})\n"
+            "assert api.create_app() is api.create_app()\n"
+            "cx = api.app.extensions['pymongo']['MONGO'][0]\n"
+            "print(cx.max_pool_size, api.uplet_collector is not None)\n")
+        env = dict(os.environ, PRELOAD_APP="T", MONGO_POOL_SIZE="7")
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         env=env)
+        self.assertEqual(output.split(), [b'7', b'True'])
+
 
 if __name__ == '__main__':
     unittest.main()
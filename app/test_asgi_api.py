@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+import unittest
+
+# test_api sets the environment of the tests before importing the apps
+import test_api
+
+try:
+    from starlette.testclient import TestClient
+    import asgi_api
+except ImportError:
+    asgi_api = None
+
+
+class ASGIResponse(object):
+    """
+    Response of ASGIClient, with the attributes of a Flask test response
+    used by test_api
+    """
+
+    def __init__(self, response, data):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.mimetype = response.headers.get('content-type',
+                                             '').split(';')[0]
+        self.data = data
+
+    def get_data(self, as_text=False):
+        return self.data.decode() if as_text else self.data
+
+
+class ASGIClient(object):
+    """
+    Client of asgi_api.app with the interface of the Flask test client, so
+    that the scenarios of test_api run against both apps
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def open(self, method, url, data=None, content_type=None, headers=None):
+        headers = dict(headers or {})
+        if content_type:
+            headers['Content-Type'] = content_type
+        if isinstance(data, str):
+            data = data.encode()
+        # raw body, not decoded by httpx, as Flask's get_data
+        with self.client.stream(method, url, content=data,
+                                headers=headers) as response:
+            return ASGIResponse(response, b''.join(response.iter_raw()))
+
+    def get(self, url, **kwargs):
+        return self.open('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.open('POST', url, **kwargs)
+
+
+@unittest.skipIf(asgi_api is None, 'starlette, motor or httpx not installed')
+class ASGIAPITestCase(test_api.APITestCase):
+    """
+    Scenarios of test_api, against the asyncio app
+    """
+
+    def setUp(self):
+        super(ASGIAPITestCase, self).setUp()
+        self.test_client = TestClient(asgi_api.app)
+        # as the Flask test client, do not accept compressed responses by
+        # default
+        del self.test_client.headers['accept-encoding']
+        self.test_client.__enter__()
+        self.app = ASGIClient(self.test_client)
+
+    def tearDown(self):
+        self.test_client.__exit__(None, None, None)
+        super(ASGIAPITestCase, self).tearDown()
+
+    @unittest.skip('MongoDB commands are not attributed to requests')
+    def test_report_perf_learnuplet_round_trips(self):
+        pass
+
+    @unittest.skip('MongoDB commands are not attributed to requests')
+    def test_mongo_debug_headers(self):
+        pass
+
+    @unittest.skip('only the Flask app is preloaded by gunicorn')
+    def test_preload_app(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+import os
+import unittest
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pymongo import MongoClient
+from base64 import b64encode
+
+os.environ['TESTING'] = "T"
+os.environ['USER_AUTH'] = "test"
+os.environ['PWD_AUTH'] = "test"
+import api
+import dispatch
+from test_api import generate_list_learnuplets
+
+headers = {
+    'Authorization': 'Basic %s' % b64encode(b"test:test").decode("ascii")
+}
+
+
+class ComputeStub(HTTPServer):
+    """Local HTTP server recording uplets posted to it"""
+
+    def __init__(self, status_codes=None, accept_batches=True):
+        super(ComputeStub, self).__init__(('127.0.0.1', 0), ComputeHandler)
+        self.url = 'http://127.0.0.1:%s' % self.server_port
+        # status codes to answer successively, then 200
+        self.status_codes = list(status_codes or [])
+        self.accept_batches = accept_batches
+        self.n_requests = 0
+        self.posted = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class ComputeHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])).decode())
+        self.server.n_requests += 1
+        status_code = 200
+        if self.server.status_codes:
+            status_code = self.server.status_codes.pop(0)
+        if type(body) is list and not self.server.accept_batches:
+            status_code = 400
+        if status_code == 200:
+            uplets = body if type(body) is list else [body]
+            self.server.posted += [(self.path, uplet) for uplet in uplets]
+        self.send_response(status_code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class DispatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MongoClient()
+        self.db = self.client[api.app.config["MONGO_DBNAME"]]
+        self.dispatcher = dispatch.Dispatcher(self.db, backoff=0)
+
+    def tearDown(self):
+        self.client.drop_database(api.app.config["MONGO_DBNAME"])
+        api.compute_url = None
+
+    def test_dispatch(self):
+        compute = ComputeStub()
+        learnuplets = generate_list_learnuplets(10)
+        self.assertEqual(
+            dispatch.enqueue(self.db, learnuplets, compute.url, 'learn'), 10)
+        self.assertEqual(self.db.dispatch.find({"status": "queued"}).count(),
+                         10)
+        self.assertEqual(self.dispatcher.dispatch(), 10)
+        compute.stop()
+        self.assertEqual(sorted(uplet["uuid"] for _, uplet in compute.posted),
+                         sorted(uplet["uuid"] for uplet in learnuplets))
+        self.assertEqual(set(path for path, _ in compute.posted), {'/learn'})
+        self.assertEqual(self.db.dispatch.find().count(), 0)
+
+    def test_dispatch_retry(self):
+        # fails twice then succeeds
+        compute = ComputeStub([503, 503])
+        dispatch.enqueue(self.db, generate_list_learnuplets(1), compute.url,
+                         'pred')
+        for n_attempts in [1, 2]:
+            self.dispatcher.dispatch()
+            self.assertEqual(self.db.dispatch.find_one()["attempts"],
+                             n_attempts)
+        self.dispatcher.dispatch()
+        self.assertEqual(len(compute.posted), 1)
+        self.assertEqual(self.db.dispatch.find().count(), 0)
+        # rejected uplet is not retried
+        compute.status_codes = [400]
+        dispatch.enqueue(self.db, generate_list_learnuplets(1), compute.url,
+                         'pred')
+        self.dispatcher.dispatch()
+        self.assertEqual(self.db.dispatch.find({"status": "failed"}).count(),
+                         1)
+        compute.stop()
+        # unreachable Compute, given up after max_attempts
+        self.db.dispatch.delete_many({})
+        dispatch.enqueue(self.db, generate_list_learnuplets(1), compute.url,
+                         'pred')
+        dispatcher = dispatch.Dispatcher(self.db, backoff=0, max_attempts=2,
+                                         timeout=1)
+        dispatcher.dispatch()
+        dispatcher.dispatch()
+        self.assertEqual(self.db.dispatch.find_one()["status"], "failed")
+
+    def test_dispatch_batch(self):
+        compute = ComputeStub()
+        learnuplets = generate_list_learnuplets(10)
+        dispatch.enqueue(self.db, learnuplets, compute.url, 'learn')
+        dispatcher = dispatch.Dispatcher(self.db, batch_size=4)
+        self.assertEqual(dispatcher.dispatch(), 10)
+        # 3 requests of 4, 4 and 2 uplets
+        self.assertEqual(compute.n_requests, 3)
+        self.assertEqual(sorted(uplet["uuid"] for _, uplet in compute.posted),
+                         sorted(uplet["uuid"] for uplet in learnuplets))
+        self.assertEqual(self.db.dispatch.find().count(), 0)
+        compute.stop()
+        # Compute which does not accept batches
+        compute = ComputeStub(accept_batches=False)
+        dispatch.enqueue(self.db, learnuplets, compute.url, 'learn')
+        self.assertEqual(dispatcher.dispatch(), 10)
+        self.assertIn(compute.url + '/learn', dispatcher.unbatched_urls)
+        self.assertEqual(len(compute.posted), 10)
+        self.assertEqual(self.db.dispatch.find().count(), 0)
+        # then uplets are directly posted one by one
+        dispatch.enqueue(self.db, learnuplets[:4], compute.url, 'learn')
+        n_requests = compute.n_requests
+        dispatcher.dispatch()
+        compute.stop()
+        self.assertEqual(compute.n_requests, n_requests + 4)
+
+    def test_api_dispatch(self):
+        compute = ComputeStub()
+        api.compute_url = compute.url
+        app = api.app.test_client()
+        self.db.problem.insert_one({"uuid": "P", "workflow": "W",
+                                    "test_dataset": ["DT1"],
+                                    "size_train_dataset": 2})
+        self.db.data.insert_many([{"uuid": "D%s" % i, "problems": ["P"]}
+                                  for i in range(4)])
+        rv = app.post('/algo', data=json.dumps({"uuid": "A", "problem": "P",
+                                                "name": "A"}),
+                      content_type='application/json', headers=headers)
+        self.assertEqual(rv.status_code, 201)
+        # first learnuplet is queued but not posted during the request
+        self.assertEqual(self.db.dispatch.find().count(), 1)
+        self.assertFalse(compute.posted)
+        self.dispatcher.dispatch()
+        compute.stop()
+        self.assertEqual(len(compute.posted), 1)
+        self.assertEqual(compute.posted[0][1]["rank"], 0)
+
+    def test_dispatcher_thread(self):
+        compute = ComputeStub()
+        dispatcher = dispatch.Dispatcher(self.db, poll_interval=0.05)
+        dispatcher.start()
+        dispatch.enqueue(self.db, generate_list_learnuplets(5), compute.url,
+                         'learn')
+        for _ in range(100):
+            if len(compute.posted) == 5:
+                break
+            threading.Event().wait(0.05)
+        dispatcher.stop()
+        dispatcher.join()
+        compute.stop()
+        self.assertEqual(len(compute.posted), 5)
+
+    def test_dispatcher_thread_error(self):
+        # unexpected errors are logged, and the dispatcher keeps polling
+        compute = ComputeStub()
+        dispatcher = dispatch.Dispatcher(self.db, poll_interval=0.05)
+        dispatch_uplets = dispatcher.dispatch
+        errors = [ValueError("bad uplet")]
+
+        def dispatch_failing_once():
+            if errors:
+                raise errors.pop()
+            return dispatch_uplets()
+        dispatcher.dispatch = dispatch_failing_once
+        with self.assertLogs('dispatch', 'ERROR'):
+            dispatcher.start()
+            dispatch.enqueue(self.db, generate_list_learnuplets(5),
+                             compute.url, 'learn')
+            for _ in range(100):
+                if len(compute.posted) == 5:
+                    break
+                threading.Event().wait(0.05)
+        dispatcher.stop()
+        dispatcher.join()
+        compute.stop()
+        self.assertEqual(len(compute.posted), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+'''
+
+import json
+import os
+import subprocess
+import sys
+import time
+import unittest
+from base64 import b64encode
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+# Delay (in seconds) of the answers of the slow Compute
+COMPUTE_DELAY = 1
+# Uplets posted to Compute, and requests sent to the API meanwhile
+N_UPLETS = 8
+N_REQUESTS = 20
+DISPATCH_CONCURRENCY = 4
+
+headers = {
+    'Authorization': 'Basic %s' % b64encode(b"test:test").decode("ascii")
+}
+
+
+def slow_compute_scenario():
+    """
+    Post uplets to a slow Compute while the API serves other requests, in
+    a process patched by gevent as gunicorn gevent workers, and print the
+    durations as JSON
+    """
+    from gevent.pool import Group
+    from gevent.pywsgi import WSGIServer
+    import requests
+    from pymongo import MongoClient
+
+    compute = {'active': 0, 'max_active': 0, 'posted': 0}
+
+    def slow_compute(environ, start_response):
+        compute['active'] += 1
+        compute['max_active'] = max(compute['max_active'], compute['active'])
+        # patched, so only this greenlet waits
+        time.sleep(COMPUTE_DELAY)
+        compute['active'] -= 1
+        compute['posted'] += 1
+        start_response('200 OK', [('Content-Length', '0')])
+        return [b'']
+
+    compute_server = WSGIServer(('127.0.0.1', 0), slow_compute, log=None)
+    compute_server.start()
+    os.environ['COMPUTE_URL'] = 'http://127.0.0.1:%s' % \
+        compute_server.server_port
+    os.environ['DISPATCH_CONCURRENCY'] = str(DISPATCH_CONCURRENCY)
+    import api
+    import dispatch
+    api_server = WSGIServer(('127.0.0.1', 0), api.app, log=None)
+    api_server.start()
+    url = 'http://127.0.0.1:%s/problem' % api_server.server_port
+    client = MongoClient(api.mongo_host)
+    try:
+        start = time.time()
+        dispatch.enqueue(client[api.app.config['MONGO_DBNAME']],
+                         [{'uuid': 'L%s' % i} for i in range(N_UPLETS)],
+                         api.compute_url, 'learn')
+        # wait for the first posts to Compute
+        while not compute['active']:
+            time.sleep(0.01)
+        requests_start = time.time()
+        responses = Group().map(lambda _: requests.get(url, headers=headers),
+                                range(N_REQUESTS))
+        requests_duration = time.time() - requests_start
+        while compute['posted'] < N_UPLETS and \
+                time.time() - start < 10 * COMPUTE_DELAY:
+            time.sleep(0.01)
+        print(json.dumps({
+            'executor': type(dispatch._dispatcher.executor).__name__,
+            'status_codes': [r.status_code for r in responses],
+            'requests_duration': requests_duration,
+            'max_active': compute['max_active'],
+            'posted': compute['posted'],
+            'posts_duration': time.time() - start}))
+    finally:
+        client.drop_database(api.app.config['MONGO_DBNAME'])
+        api_server.stop()
+        compute_server.stop()
+
+
+@unittest.skipIf(gevent is None, 'gevent is not installed')
+class GeventTestCase(unittest.TestCase):
+
+    def test_slow_compute(self):
+        code = ("from gevent import monkey\n"
+                "monkey.patch_all()\n"
+                "import test_gevent\n"
+                "test_gevent.slow_compute_scenario()\n")
+        env = dict(os.environ, TESTING="T", USER_AUTH="test", PWD_AUTH="test")
+        output = subprocess.check_output(
+            [sys.executable, '-c', code], env=env,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        result = json.loads(output.decode().splitlines()[-1])
+        # uplets are posted by a pool of greenlets
+        self.assertEqual(result['executor'], 'Pool')
+        self.assertEqual(result['status_codes'], [200] * N_REQUESTS)
+        # requests are not served after the posts to Compute
+        self.assertLess(result['requests_duration'], COMPUTE_DELAY / 2)
+        # posts are concurrent, within the limit of the pool
+        self.assertEqual(result['posted'], N_UPLETS)
+        self.assertEqual(result['max_active'], DISPATCH_CONCURRENCY)
+        self.assertLess(result['posts_duration'],
+                        (N_UPLETS / DISPATCH_CONCURRENCY + 1) * COMPUTE_DELAY)
+
+
+if __name__ == '__main__':
+    unittest.main()
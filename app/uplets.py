@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+'''
+ Copyright Morpheo Org. 2017
+
+ contact@morpheo.co
+
+ This software is part of the Morpheo project, an open-source machine
+ learning platform.
+
+ This software is governed by the CeCILL license, compatible with the
+ GNU GPL, under French law and abiding by the rules of distribution of
+ free software. You can  use, modify and/ or redistribute the software
+ under the terms of the CeCILL license as circulated by CEA, CNRS and
+ INRIA at the following URL "http://www.cecill.info".
+
+ As a counterpart to the access to the source code and  rights to copy,
+ modify and redistribute granted by the license, users are provided only
+ with a limited warranty  and the software's author,  the holder of the
+ economic rights,  and the successive licensors  have only  limited
+ liability.
+
+ In this respect, the user's attention is drawn to the risks associated
+ with loading,  using,  modifying and/or developing or reproducing the
+ software by the user in light of its specific status of free software,
+ that may mean  that it is complicated to manipulate,  and  that  also
+ therefore means  that it is reserved for developers  and  experienced
+ professionals having in-depth computer knowledge. Users are therefore
+ encouraged to load and test the software's suitability as regards their
+ requirements in conditions enabling the security of their systems and/or
+ data to be ensured and,  more generally, to use and operate it in the
+ same conditions as regards security.
+
+ The fact that you are presently reading this means that you have had
+ knowledge of the CeCILL license and that you accept its terms.
+
+ Building of learnuplets and preduplets, without access to the db, shared by
+ tasks.py and asgi_tasks.py
+'''
+
+import time
+import uuid
+import numpy as np
+
+
+# Maximum number of learnuplets written to db in one insert_many
+INSERT_CHUNK_SIZE = 1000
+
+
+def build_learnuplets(new_data, sz_batch, test_data, problem_uuid,
+                      workflow_uuid, algo_uuid, model_uuid_start, start_rank):
+    """
+    Function used to build learnuplets, without writing them to db
+
+    :param new_data: list of data UUIDs on which to do the training
+    :param sz_batch: mini-batch size
+    :param test_data: list of test data UUIDs
+    :param problem_uuid: UUID of the problem
+    :param workflow_uuid: UUID of the workflow
+    :param algo_uuid: UUID of the submitted algorithm (before any training)
+    :param model_uuid_start: UUID of model from which to start the training\
+        (equals algo_uuid if start_rank=0)
+    :param start_rank: first rank of newly created learnuplets
+
+    :type new_data: list of UUIDs
+    :type sz_batch: integer
+    :type test_data: list of UUIDs
+    :type problem_uuid: UUID
+    :type workflow_uuid: UUID
+    :type algo_uuid: UUID
+    :type model_uuid_start: UUID
+    :type start_rank: integer
+    :return: list of learnuplets
+    :rtype: list
+    """
+    # returns empty list of algo_uuid different from model_uuid_start and
+    # rank=0
+    if start_rank == 0 and model_uuid_start != algo_uuid:
+        return []
+    list_new_learnuplets = []
+    batchs_uuid = [list(np.array(new_data)[i: i + int(sz_batch)])
+                   for i in range(0, len(new_data), int(sz_batch))]
+    timestamp = int(time.time())
+    # for each batch of data create a learnuplet
+    for i, train_data in enumerate(batchs_uuid):
+        j = i + start_rank
+        # TODO create model_uuid_end function of model_uuid_start...
+        # for now we only generate random UUID....which has to be modified
+        model_uuid_end = str(uuid.uuid4())
+        if j == start_rank:
+            model_start = model_uuid_start
+        else:
+            model_start = None
+        new_learnuplet = {"uuid": str(uuid.uuid4()),
+                          "problem": problem_uuid,
+                          "workflow": workflow_uuid,
+                          "algo": algo_uuid,
+                          "model_start": model_start,
+                          "model_end": model_uuid_end,
+                          "train_data": train_data,
+                          "test_data": test_data,
+                          "worker": None,
+                          "perf": None,
+                          "train_perf": None,
+                          "test_perf": None,
+                          "status": 'todo',
+                          'rank': j,
+                          'timestamp_creation': timestamp,
+                          'timestamp_done': None}
+        list_new_learnuplets.append(new_learnuplet)
+        model_uuid_start = model_uuid_end
+    return list_new_learnuplets
+
+
+def first_learnuplets(list_learnuplets, start_ranks):
+    """
+    Learnuplets which can be trained right away (which have a model_start)
+
+    :param list_learnuplets: learnuplets built by build_learnuplets
+    :param start_ranks: first rank of learnuplets for each algo
+    :type list_learnuplets: list
+    :type start_ranks: dictionary
+    :rtype: list
+    """
+    return [learnuplet for learnuplet in list_learnuplets
+            if learnuplet['rank'] == start_ranks[learnuplet['algo']]]
+
+
+def active_data(problem, problem_data):
+    """
+    Train data of a problem
+
+    :param problem: problem
+    :param problem_data: UUIDs of the data of the problem
+    :type problem: dictionary
+    :type problem_data: list
+    :rtype: list
+    """
+    # Filter out test data...
+    return list(set(problem_data) - set(problem["test_dataset"]))
+
+
+def algo_learnuplets(algo, problem, train_data):
+    """
+    Learnuplets of a new algo, on the active data of its problem
+
+    :param algo: new algo
+    :param problem: problem of the algo
+    :param train_data: active data of the problem (see active_data)
+    :rtype: list
+    """
+    # Create learnuplet for each fold if enough data exist
+    return build_learnuplets(
+        train_data, problem["size_train_dataset"], problem["test_dataset"],
+        problem["uuid"], problem["workflow"], algo["uuid"], algo["uuid"], 0)
+
+
+def chain_learnuplets(problem, data_uuids, chain_tails):
+    """
+    Learnuplets of new data of a problem, following the last learnuplet of
+    each algo
+
+    :param problem: problem of the data
+    :param data_uuids: UUIDs of the new data
+    :param chain_tails: last learnuplet of each algo of the problem (see
+        chain_tails_pipeline)
+    :type problem: dictionary
+    :type data_uuids: list
+    :type chain_tails: iterable
+    :return: learnuplets, and their first rank for each algo
+    :rtype: tuple
+    """
+    list_new_learnuplets = []
+    start_ranks = {}
+    for last_learnuplet in chain_tails:
+        uuid_algo = last_learnuplet["_id"]
+        last_rank = last_learnuplet["rank"]
+        # TODO modify. Problem: what if pending models????
+        last_model = last_learnuplet["model_end"]
+        list_new_learnuplets += build_learnuplets(
+            data_uuids, problem["size_train_dataset"],
+            problem["test_dataset"], problem["uuid"], problem["workflow"],
+            uuid_algo, last_model, last_rank + 1)
+        start_ranks[uuid_algo] = last_rank + 1
+    return list_new_learnuplets, start_ranks
+
+
+def chain_tails_pipeline(problem_uuid):
+    """
+    Aggregation pipeline finding the last learnuplet of each algo of a
+    problem (its *_id* is the algo)
+
+    :param problem_uuid: uuid of the problem
+    :type problem_uuid: uuid
+    :rtype: list
+    """
+    return [
+        {'$match': {'problem': problem_uuid, 'rank': {'$exists': True}}},
+        {'$sort': {'algo': 1, 'rank': 1}},
+        {'$group': {'_id': '$algo',
+                    'rank': {'$last': '$rank'},
+                    'model_end': {'$last': '$model_end'}}}]
+
+
+def build_preduplet(new_preduplet, best_model, problem):
+    """
+    Complete a requested preduplet, to be predicted with the best model
+
+    :param new_preduplet: requested preduplet (data, problem,
+        timestamp_request)
+    :param best_model: best model of the problem (see leaderboard.py)
+    :param problem: problem of the preduplet
+    :type new_preduplet: dictionary
+    :type best_model: dictionary
+    :type problem: dictionary
+    :return: the preduplet
+    :rtype: dictionary
+    """
+    new_preduplet["uuid"] = str(uuid.uuid4())
+    new_preduplet["model"] = best_model["model_end"]
+    new_preduplet["status"] = "todo"
+    new_preduplet["worker"] = None
+    new_preduplet["timestamp_done"] = None
+    new_preduplet["workflow"] = problem["workflow"]
+    new_preduplet["prediction_storage_uuid"] = None
+    return new_preduplet